@@ -0,0 +1,238 @@
+""" Adaptive command rate per bridge, learned from how the bridge answers
+
+A fixed RateLimiter rate is a guess: too low for a new bridge, too high for an old one, which answers
+the excess with internal errors (901). An AdaptiveRateController steers the bridge's shared
+RateLimiter by additive increase, multiplicative decrease: every WINDOW calls answered in time raise the
+rate by INCREASE calls per second, a 901, a failed connection or an answer slower than SLOW_RESPONSE
+cuts it by DECREASE. Further cuts wait COOLDOWN seconds, the calls already in flight when the bridge
+got overloaded report the same overload.
+
+Controllers watch the calls through an instrumentation post call hook. enable gives the bridge an
+outbound queue and keeps it, so every write to the bridge, not only those of the bulk helpers, waits
+for the limiter. The learned rate is saved to the datastore from a thread of its own, never from the
+calls themselves, so a restart picks up where it left off instead of starting over from
+ratelimit.DEFAULT_RATE.
+
+Sample Usage:
+
+    import adaptive
+
+    adaptive.enable(url)
+    dr_hue.turn_all_lights_off(url, username, sleep_interval=0.1)
+    print adaptive.get_controller(url).rate
+"""
+
+import logging
+import threading
+import time
+
+import instrumentation
+from outbound  import INTERNAL_ERROR, get_outbound_queue, queue_for
+from ratelimit import bridge_key, get_rate_limiter
+
+MIN_RATE         = 1.0
+MAX_RATE         = 30.0
+INCREASE         = 0.5     # calls per second added after every window of good calls
+DECREASE         = 0.5     # factor the rate is cut by on overload
+WINDOW           = 10      # good calls per increase
+SLOW_RESPONSE    = 1.0     # seconds
+COOLDOWN         = 2.0     # seconds between two cuts
+PERSIST_INTERVAL = 30.0    # seconds between two saves of a changing rate
+SETTING_NAME     = "adaptive_rate"
+
+_controllers      = {}
+_controllers_lock = threading.Lock()
+_log              = logging.getLogger("dr_hue.adaptive")
+_log.addHandler(logging.NullHandler())
+
+def overloaded(error, duration, slow=SLOW_RESPONSE):
+    """ Whether a call's outcome says the bridge is taking too many commands
+
+    Hue errors other than 901 are about the command itself. Errors without a hue error type, failed
+    or timed out connections and http errors, are blamed on load.
+    """
+    if error is not None:
+        error_types = getattr(error, 'error_types', None)
+        return error_types is None or INTERNAL_ERROR in error_types
+    return duration is not None and duration > slow
+
+class AdaptiveRateController(object):
+    """ AIMD control of one RateLimiter """
+
+    def __init__(self, limiter, rate=None, minimum=MIN_RATE, maximum=MAX_RATE, increase=INCREASE,
+                 decrease=DECREASE, window=WINDOW, slow=SLOW_RESPONSE, cooldown=COOLDOWN, on_change=None):
+        self.limiter   = limiter
+        self.minimum   = minimum
+        self.maximum   = maximum
+        self.increase  = increase
+        self.decrease  = decrease
+        self.window    = window
+        self.slow      = slow
+        self.cooldown  = cooldown
+        self.on_change = on_change
+        self.rate      = max(minimum, min(maximum, rate if rate is not None else limiter.rate))
+        self.cuts      = 0
+        self._good     = 0
+        self._last_cut = None
+        self._lock     = threading.Lock()
+        self.limiter.set_rate(self.rate)
+
+    def observe(self, error=None, duration=None, now=None):
+        """ Account for one finished call, returns the rate to use from now on """
+        now = time.time() if now is None else now
+        with self._lock:
+            rate = self.rate
+            if overloaded(error, duration, self.slow):
+                self._good = 0
+                if self._last_cut is None or now - self._last_cut >= self.cooldown:
+                    self._last_cut = now
+                    self.cuts     += 1
+                    rate           = max(self.minimum, rate * self.decrease)
+            elif error is None:
+                self._good += 1
+                if self._good >= self.window:
+                    self._good = 0
+                    rate       = min(self.maximum, rate + self.increase)
+
+            if rate == self.rate:
+                return rate
+            self.rate = rate
+            self.limiter.set_rate(rate)
+
+        if self.on_change is not None:
+            self.on_change(rate)
+        return rate
+
+class _Persister(object):
+    """ Saves a bridge's rate to the datastore every `interval` seconds while it changes
+
+    Called with every new rate from the calls' post call hook, which only notes the rate down. A thread
+    of its own does the saving.
+    """
+
+    def __init__(self, bridge, interval=PERSIST_INTERVAL):
+        self.bridge   = bridge
+        self.interval = interval
+        self.pending  = None
+        self._lock    = threading.Lock()
+        self._stop    = threading.Event()
+        self._thread  = None
+
+    def __call__(self, rate):
+        with self._lock:
+            self.pending = rate
+            if self._thread is None and not self._stop.is_set():
+                self._thread        = threading.Thread(target=self._run, name="dr_hue rate %s" % self.bridge)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        import datastore
+        try:
+            while not self._stop.wait(self.interval):
+                try:
+                    self.flush()
+                except Exception as exc:
+                    # Nobody to raise to here, the rate is tried again next interval and on stop
+                    _log.warning("Saving the command rate of %s failed: %s", self.bridge, exc)
+        finally:
+            datastore.remove_session()
+
+    def flush(self):
+        """ Save the pending rate now, raises if the datastore fails """
+        with self._lock:
+            rate, self.pending = self.pending, None
+        if rate is None:
+            return
+
+        import datastore
+        try:
+            datastore.set_bridge_setting(self.bridge, SETTING_NAME, rate)
+        except Exception:
+            with self._lock:
+                if self.pending is None:
+                    self.pending = rate
+            raise
+
+    def stop(self):
+        """ Stop the saving thread and save what is pending """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+def _load_rate(bridge):
+    """ The rate learned for a bridge before, None if there is none """
+    import datastore
+    return datastore.get_bridge_setting(bridge, SETTING_NAME)
+
+def _post_call(info):
+    """ instrumentation post call hook, feeds the call to its bridge's controller """
+    controller = _controllers.get(info.bridge)
+    if controller is not None:
+        controller.observe(info.error, info.duration)
+
+def enable(url, rate=None, persist=True, **kwargs):
+    """ Adapt the rate of the bridge at url from now on
+
+    :param str url: the bridge
+    :param float rate: the rate to start from, by default the saved one or the limiter's current rate
+    :param bool persist: load and save the learned rate in the datastore
+    :param kwargs: passed on to AdaptiveRateController
+
+    :rtype: AdaptiveRateController
+    :raises: the datastore's exception when persist is set and the saved rate cannot be read
+    """
+    key = bridge_key(url)
+    with _controllers_lock:
+        controller = _controllers.get(key)
+        if controller is not None:
+            return controller
+
+        persister = _Persister(key) if persist else None
+        if rate is None and persist:
+            rate = _load_rate(key)
+        controller = AdaptiveRateController(get_rate_limiter(url), rate=rate, on_change=persister, **kwargs)
+        if not _controllers:
+            instrumentation.add_post_call_hook(_post_call)
+        _controllers[key] = controller
+
+        # Writes to a bridge without a queue go straight out, past the limiter
+        get_outbound_queue(url, retain=True)
+    return controller
+
+def disable(url):
+    """ Stop adapting the rate of the bridge at url, saving the rate it got to. The limiter keeps it
+
+    :raises: the datastore's exception when the rate could not be saved
+    """
+    key = bridge_key(url)
+    with _controllers_lock:
+        controller = _controllers.pop(key, None)
+        if not _controllers:
+            instrumentation.remove_hook(_post_call)
+    if controller is None:
+        return
+
+    queue = queue_for(key)
+    if queue is not None:
+        queue.release()
+    if controller.on_change is not None:
+        controller.on_change.stop()
+
+def reset_after_fork():
+    """ Start a forked child without the parent's controllers, the lock may have been held
+
+    Their persisting threads did not survive the fork, the parent saves their rates.
+    """
+    global _controllers_lock
+    _controllers.clear()
+    _controllers_lock = threading.Lock()
+
+def get_controller(url):
+    """ The controller of the bridge at url, None if its rate is fixed """
+    return _controllers.get(bridge_key(url))
+
+def get_rates():
+    """ The current rate of every adapted bridge, keyed by bridge """
+    return dict((key, controller.rate) for key, controller in _controllers.items())
@@ -0,0 +1,135 @@
+""" Batching of light and group state changes
+
+Every turn_light_on/set_light_brightness/set_light_hue call is its own PUT against the bridge rate
+limit. A LightBatch records the changes instead and sends one merged body per light or group.
+
+Sample Usage:
+
+    from batch import light_batch
+
+    with light_batch(url, username) as b:
+        b.turn_light_on(1)
+        b.set_light_brightness(1, 200)
+        b.set_light_hue(1, 50000)
+        b.set_group(2, on=False)
+
+    # On exit: one set_group_state for group 2, one set_light_state for light 1
+"""
+
+from collections import OrderedDict
+from contextlib  import contextmanager
+
+import dr_hue
+from profiling import profiled
+
+class BatchFlushException(Exception):
+    """ Exception raised when a flush stops at a failed call
+
+    The calls made before it are not undone, their responses are in sent. The failed body and the ones
+    after it stay in the batch, pending, for another flush.
+    """
+    def __init__(self, msg, sent=None, failed=None, pending=None, error=None, **kwargs):
+        super(BatchFlushException, self).__init__(msg, **kwargs)
+        self.sent    = sent or OrderedDict()
+        self.failed  = failed
+        self.pending = pending or OrderedDict()
+        self.error   = error
+
+class LightBatch(object):
+    """ Records state changes per light and group until flush() """
+
+    def __init__(self, url, username):
+        self.url      = url
+        self.username = username
+        self._lights  = OrderedDict()
+        self._groups  = OrderedDict()
+
+    def __len__(self):
+        """ Number of calls a flush would make """
+        return len(self._lights) + len(self._groups)
+
+    def set_light(self, light_id, **state):
+        """ Merge state fields into the body sent to a light, later values win """
+        self._lights.setdefault(str(light_id), {}).update(state)
+        return self
+
+    def set_group(self, group_id, **action):
+        """ Merge action fields into the body sent to a group, later values win """
+        self._groups.setdefault(str(group_id), {}).update(action)
+        return self
+
+    def turn_light_on(self, light_id):
+        """ Turn the light on """
+        return self.set_light(light_id, on=True)
+
+    def turn_light_off(self, light_id):
+        """ Turn the light off """
+        return self.set_light(light_id, on=False)
+
+    def set_light_brightness(self, light_id, brightness):
+        """ Set the brightness of an individual light """
+        return self.set_light(light_id, bri=brightness)
+
+    def set_light_hue(self, light_id, hue):
+        """ Set the hue of an individual light """
+        return self.set_light(light_id, hue=hue)
+
+    def turn_group_on(self, group_id):
+        """ Turn every light in the group on """
+        return self.set_group(group_id, on=True)
+
+    def turn_group_off(self, group_id):
+        """ Turn every light in the group off """
+        return self.set_group(group_id, on=False)
+
+    def pending(self):
+        """ The bodies that would be sent, keyed by ('lights'|'groups', id) """
+        bodies = OrderedDict((('groups', group_id), dict(body)) for group_id, body in self._groups.items())
+        bodies.update((('lights', light_id), dict(body)) for light_id, body in self._lights.items())
+        return bodies
+
+    def discard(self):
+        """ Drop everything recorded so far """
+        self._lights.clear()
+        self._groups.clear()
+
+    @profiled("batch.LightBatch.flush")
+    def flush(self):
+        """ Send one merged body per target. Groups go first so per light changes win over them.
+
+        A body is only dropped from the batch once it was sent, so a flush that failed can be repeated.
+
+        :rtype: OrderedDict
+        :returns: The bridge responses keyed by ('lights'|'groups', id)
+        :raises BatchFlushException: when a call fails, with what was sent before it
+        """
+        responses = OrderedDict()
+        for kind, bodies, send in (('groups', self._groups, dr_hue.set_group_state),
+                                   ('lights', self._lights, dr_hue.set_light_state)):
+            while bodies:
+                target_id, body = next(bodies.iteritems())
+                try:
+                    responses[(kind, target_id)] = send(self.url, target_id, self.username, body)
+                except Exception as exc:
+                    msg = "Sending %s %s failed after %s calls: %s" % (kind, target_id, len(responses), exc)
+                    raise BatchFlushException(msg, sent=responses, failed=(kind, target_id),
+                                              pending=self.pending(), error=exc)
+                del bodies[target_id]
+
+        return responses
+
+@contextmanager
+def light_batch(url, username):
+    """ Record light and group changes in a LightBatch and send them when the block exits.
+
+    Nothing is sent if the block raises. If one of the calls fails, BatchFlushException says which one,
+    what was sent before it, which stays applied, and what was not sent.
+
+    :param str url: The url of the Hue system
+    :param str username: the username that has access to the hue system
+
+    :rtype: LightBatch
+    """
+    batch = LightBatch(url, username)
+    yield batch
+    batch.flush()
@@ -0,0 +1,57 @@
+""" Import time benchmark for the dr_hue modules
+
+Every sample runs in a fresh interpreter, the way a cron driven light toggle does. Run from the
+repository root:
+
+    python benchmarks/import_time.py [samples]
+"""
+
+import os
+import subprocess
+import sys
+
+ROOT    = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLES = 15
+
+# Modules that should only be loaded once they are actually needed
+HEAVY_MODULES = ['requests', 'sqlalchemy', 'elixir', 'multiprocessing', 'datastore']
+
+SNIPPET = """
+import sys, time
+start = time.time()
+%s
+elapsed = time.time() - start
+heavy = [name for name in %r if name in sys.modules]
+print "%%f %%s" %% (elapsed, ",".join(heavy))
+"""
+
+CASES = [
+    ("import dr_hue", "import dr_hue"),
+    ("import dr_hue, bridge, batch, scenes", "import dr_hue, bridge, batch, scenes"),
+    ("import requests (what dr_hue used to pay)", "import requests"),
+    ("import datastore", "import datastore"),
+    ("import datastore + first query", "import datastore; datastore.get_groups()")
+]
+
+def run_case(statement, samples):
+    """ Time a statement in fresh interpreters, returns (sorted timings, heavy modules loaded) """
+    timings = []
+    heavy   = ""
+    for _ in range(samples):
+        output = subprocess.check_output([sys.executable, "-c", SNIPPET % (statement, HEAVY_MODULES)],
+                                         cwd=ROOT)
+        elapsed, heavy = output.strip().split(" ", 1) if " " in output.strip() else (output.strip(), "")
+        timings.append(float(elapsed))
+    return sorted(timings), heavy
+
+def main():
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else SAMPLES
+
+    print "%-45s %10s %10s  %s" % ("case", "median ms", "min ms", "heavy modules loaded")
+    for label, statement in CASES:
+        timings, heavy = run_case(statement, samples)
+        print "%-45s %10.1f %10.1f  %s" % (label, timings[len(timings) // 2] * 1000, timings[0] * 1000,
+                                          heavy or "-")
+
+if __name__ == "__main__":
+    main()
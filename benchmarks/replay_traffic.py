@@ -0,0 +1,57 @@
+""" Replay a recorded traffic log against a fake bridge and compare with the recording
+
+Without a log a short synthetic one is recorded first, a sweep of light commands and state reads
+against a fake bridge with a 20 ms round trip. Run from the repository root:
+
+    python benchmarks/replay_traffic.py [log] [speed] [latency ms]
+
+A speed of 0 replays as fast as possible.
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dr_hue
+import request_wrapper
+import traffic
+from fakebridge import FakeBridge
+
+def record_sample(path, latency):
+    """ Record 200 calls against a fake bridge """
+    bridge   = FakeBridge(lights=50, latency=latency).start()
+    recorder = traffic.TrafficRecorder(path)
+    request_wrapper.set_recorder(recorder)
+    try:
+        for sweep in range(4):
+            dr_hue.get_full_state(bridge.url, "benchmark")
+            for light_id in range(1, 50):
+                dr_hue.set_light_state(bridge.url, light_id, "benchmark", {'on': True, 'bri': sweep * 60})
+    finally:
+        request_wrapper.set_recorder(None)
+        recorder.close()
+        bridge.stop()
+
+def main():
+    path    = sys.argv[1] or None if len(sys.argv) > 1 else None
+    speed   = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    latency = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.02
+
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(), "sample.log.gz")
+        record_sample(path, latency)
+        print "Recorded a sample log at %s" % path
+
+    bridge = FakeBridge(lights=50, latency=latency).start()
+    try:
+        report = traffic.replay(path, bridge.url, speed=speed or None)
+    finally:
+        bridge.stop()
+
+    print "Replayed at %s" % ("full speed" if not speed else "%sx" % speed)
+    print report.format()
+
+if __name__ == "__main__":
+    main()
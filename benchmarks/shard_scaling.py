@@ -0,0 +1,96 @@
+""" Throughput of a ShardedFleet against fake bridges, for a growing number of worker processes
+
+The fake bridges run in processes of their own, so they do not compete with the coordinator for the
+GIL. Every bridge gets the same mix of light commands and state reads. Run from the repository root:
+
+    python benchmarks/shard_scaling.py [bridges] [calls per bridge] [latency ms]
+
+Throughput only grows with the processes while there are cores for them, see the cores line.
+"""
+
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dr_hue
+from fakebridge import FakeBridge
+from sharding   import ShardedFleet
+
+BRIDGES_PER_HOST = 8
+
+def host_bridges(count, latency, connection, stop):
+    """ Serve `count` fake bridges until stop is set, their urls go back over connection """
+    bridges = [FakeBridge(lights=20, latency=latency).start() for _ in range(count)]
+    connection.send([bridge.url for bridge in bridges])
+    stop.wait()
+    for bridge in bridges:
+        bridge.stop()
+
+def start_hosts(bridges, latency):
+    """ Start processes serving `bridges` fake bridges, returns their urls and the stop event """
+    stop  = multiprocessing.Event()
+    urls  = []
+    hosts = []
+    for first in range(0, bridges, BRIDGES_PER_HOST):
+        parent, child = multiprocessing.Pipe()
+        host = multiprocessing.Process(target=host_bridges,
+                                       args=(min(BRIDGES_PER_HOST, bridges - first), latency, child, stop))
+        host.daemon = True
+        host.start()
+        hosts.append(host)
+        urls.extend(parent.recv())
+    return urls, stop, hosts
+
+def workload(urls, calls_per_bridge):
+    """ Alternating commands and reads, interleaved over the bridges """
+    calls = []
+    for index in range(calls_per_bridge):
+        light_id = str(index % 20 + 1)
+        for url in urls:
+            if index % 2:
+                calls.append((dr_hue.get_light_attr, (url, (light_id, "benchmark"))))
+            else:
+                calls.append((dr_hue.set_light_state, (url, (light_id, "benchmark", {'bri': index % 254}))))
+    return calls
+
+def run(urls, processes, calls):
+    """ Calls per second with `processes` workers """
+    with ShardedFleet([(url, "benchmark") for url in urls], processes=processes) as fleet:
+        # Warm up the connections of every worker
+        fleet.broadcast(dr_hue.get_configuration)
+
+        started = time.time()
+        for func in (dr_hue.set_light_state, dr_hue.get_light_attr):
+            outcomes = fleet.map(func, [call for call_func, call in calls if call_func is func])
+            errors   = [error for _, error in outcomes if error is not None]
+            if errors:
+                raise errors[0]
+        return len(calls) / (time.time() - started)
+
+def main():
+    bridges  = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    per      = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    latency  = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.005
+    cores    = multiprocessing.cpu_count()
+    sweep    = sorted(set([1, 2, 4, cores]))
+
+    urls, stop, hosts = start_hosts(bridges, latency)
+    try:
+        calls = workload(urls, per)
+        print "%s bridges, %s calls, %.0f ms per call at the bridge, %s cores" % (bridges, len(calls),
+                                                                                latency * 1000, cores)
+        baseline = None
+        for processes in sweep:
+            throughput = run(urls, processes, calls)
+            baseline   = baseline or throughput
+            print "%2d processes %8.1f calls/s %6.2fx" % (processes, throughput, throughput / baseline)
+    finally:
+        stop.set()
+        for host in hosts:
+            host.join()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+""" Memory benchmark for state records against the plain response dictionaries
+
+Builds a get_full_state style 'lights' object, parses it back from json the way a response is, and
+compares the deep size, parse time and field access time of both representations. Run from the
+repository root:
+
+    python benchmarks/state_memory.py [lights]
+"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import states
+
+LIGHTS = 10000
+
+def make_response(count):
+    """ A json 'lights' object with count lights """
+    lights = {}
+    for index in range(1, count + 1):
+        lights[str(index)] = {
+            "name": "Hue Lamp %s" % index,
+            "type": "Extended color light",
+            "modelid": "LCT001",
+            "swversion": "66009461",
+            "state": {"on": index % 2 == 0, "bri": index % 255, "hue": index * 7 % 65535, "sat": 254,
+                      "ct": 153 + index % 347, "xy": [0.3227, 0.329], "effect": "none", "alert": "none",
+                      "colormode": "hs", "reachable": True}
+        }
+    return json.dumps(lights)
+
+def deep_size(obj, seen=None):
+    """ sys.getsizeof of an object and everything it references, each object counted once """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen) for key, value in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, '__slots__'):
+        for cls in type(obj).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                size += deep_size(getattr(obj, name, None), seen)
+    return size
+
+def timed(func):
+    """ Run func, returns (result, seconds) """
+    start  = time.time()
+    result = func()
+    return result, time.time() - start
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else LIGHTS
+    text  = make_response(count)
+
+    raw, raw_parse         = timed(lambda: json.loads(text))
+    records, record_parse  = timed(lambda: states.parse_lights(json.loads(text)))
+    _, raw_access          = timed(lambda: sum(light['state']['bri'] for light in raw.itervalues()))
+    _, record_access       = timed(lambda: sum(light.bri for light in records.itervalues()))
+
+    # Booleans, small integers and the like are shared by the interpreter either way, leave them out
+    shared    = set(id(value) for value in (True, False, None))
+    raw_size  = deep_size(raw, set(shared))
+    rec_size  = deep_size(records, set(shared))
+
+    print "%s lights" % count
+    print "%-10s %10s %10s %12s" % ("", "MB", "parse ms", "access ms")
+    print "%-10s %10.2f %10.1f %12.2f" % ("dicts", raw_size / 1048576.0, raw_parse * 1000, raw_access * 1000)
+    print "%-10s %10.2f %10.1f %12.2f" % ("records", rec_size / 1048576.0, record_parse * 1000,
+                                          record_access * 1000)
+    print "records use %.0f%% of the memory" % (100.0 * rec_size / raw_size)
+
+if __name__ == "__main__":
+    main()
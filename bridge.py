@@ -0,0 +1,292 @@
+""" Object model for a bridge and the lights and groups on it
+
+The flat calls in dr_hue need the url and username on every call, and re-fetch attributes every time a
+field is read. Bridge carries the url/username around, and Light/Group load their attributes on first
+access, cache them, and queue up state changes until flush() sends them as a single PUT.
+
+Sample Usage:
+
+    from bridge import Bridge
+
+    hue   = Bridge(url, username)
+    light = hue.light(1)
+
+    if not light.on:
+        light.on  = True
+        light.bri = 200
+        light.hue = 50000
+    light.flush()         # a single set_light_state call
+"""
+
+from abc import ABCMeta, abstractmethod
+
+import dr_hue
+
+def _state_property(field):
+    """ Read from the pending changes first, then the cached state. Writes are queued until flush """
+    def getter(self):
+        if field in self._pending:
+            return self._pending[field]
+        return self._lookup(field, self._section)
+
+    def setter(self, value):
+        self._pending[field] = value
+
+    return property(getter, setter, doc="'%s' field, changes are sent on flush" % field)
+
+def _attribute_property(field):
+    """ Read only top level attribute """
+    def getter(self):
+        return self._lookup(field)
+
+    return property(getter, doc="'%s' attribute" % field)
+
+class _BridgeResource(object):
+    """ Common lazy loading and change tracking for lights and groups
+
+    Subclasses say how their attributes are read and their changes are sent by overriding _fetch and
+    _send, and name the object holding their settable fields in _section.
+    """
+    __metaclass__ = ABCMeta
+    __slots__     = ('bridge', 'id', '_attrs', '_complete', '_pending')
+
+    # Name of the nested object holding the settable fields
+    _section = None
+
+    def __init__(self, bridge, resource_id, attrs=None):
+        self.bridge    = bridge
+        self.id        = str(resource_id)
+        self._attrs    = attrs or {}
+        self._complete = False
+        self._pending  = {}
+
+    def __repr__(self):
+        return "<%s %s %r>" % (self.__class__.__name__, self.id, self._attrs.get('name'))
+
+    @abstractmethod
+    def _fetch(self):
+        """ Get the full attributes from the bridge
+
+        :rtype: dict
+        :returns: The attributes as the bridge returns them, with the _section object in them
+        """
+
+    @abstractmethod
+    def _send(self, params):
+        """ Send a state change to the bridge
+
+        :param dict params: the changes, fields of the _section object
+        :returns: The bridge response
+        """
+
+    def _lookup(self, field, section=None):
+        """ Get a field, loading the full attributes if it has not been seen yet """
+        while True:
+            container = self._attrs if section is None else self._attrs.get(section, {})
+            if field in container:
+                return container[field]
+            if self._complete:
+                return None
+            self.load()
+
+    def load(self):
+        """ (Re)load the attributes from the bridge """
+        self._attrs    = self._fetch()
+        self._complete = True
+        return self._attrs
+
+    def refresh(self):
+        """ Forget the cached attributes, they are reloaded on next access """
+        self._attrs    = {}
+        self._complete = False
+
+    @property
+    def attributes(self):
+        """ Full attribute dictionary, as returned by the bridge """
+        if not self._complete:
+            self.load()
+        return self._attrs
+
+    @property
+    def pending(self):
+        """ Changes that have been set but not flushed yet """
+        return dict(self._pending)
+
+    @property
+    def dirty(self):
+        """ Whether there are changes waiting for a flush """
+        return bool(self._pending)
+
+    def set(self, **changes):
+        """ Queue several changes at once, e.g. light.set(on=True, bri=200) """
+        self._pending.update(changes)
+        return self
+
+    def flush(self):
+        """ Send every queued change in a single call
+
+        :rtype: list
+        :returns: The bridge response, or None if there was nothing to send
+        """
+        if not self._pending:
+            return None
+
+        changes       = self._pending
+        self._pending = {}
+        try:
+            response = self._send(changes)
+        except Exception:
+            # Put the changes back, including any made while the call was out
+            changes.update(self._pending)
+            self._pending = changes
+            raise
+
+        # Keep a cached state in line with what was just sent. One that was never loaded stays unloaded,
+        # the changes alone are not the full state
+        section = self._attrs.get(self._section)
+        if section is not None:
+            section.update((key, value) for key, value in changes.items() if key != 'transitiontime')
+        else:
+            self._complete = False
+        return response
+
+class Light(_BridgeResource):
+    """ A single light, state fields are readable and settable as attributes """
+    __slots__ = ()
+    _section  = 'state'
+
+    name       = _attribute_property('name')
+    type       = _attribute_property('type')
+    modelid    = _attribute_property('modelid')
+    swversion  = _attribute_property('swversion')
+
+    on         = _state_property('on')
+    bri        = _state_property('bri')
+    hue        = _state_property('hue')
+    sat        = _state_property('sat')
+    xy         = _state_property('xy')
+    ct         = _state_property('ct')
+    alert      = _state_property('alert')
+    effect     = _state_property('effect')
+    colormode  = _state_property('colormode')
+    reachable  = _state_property('reachable')
+
+    def _fetch(self):
+        return dr_hue.get_light_attr(self.bridge.url, self.id, self.bridge.username)
+
+    def _send(self, params):
+        return dr_hue.set_light_state(self.bridge.url, self.id, self.bridge.username, params)
+
+    @property
+    def state(self):
+        """ Current state including the pending changes """
+        state = dict(self._lookup_section())
+        state.update(self._pending)
+        return state
+
+    def _lookup_section(self):
+        """ The cached state object, loading it if needed """
+        if self._section not in self._attrs and not self._complete:
+            self.load()
+        return self._attrs.get(self._section, {})
+
+class Group(_BridgeResource):
+    """ A bridge group, its last action is readable and settable as attributes """
+    __slots__ = ()
+    _section  = 'action'
+
+    name       = _attribute_property('name')
+
+    on         = _state_property('on')
+    bri        = _state_property('bri')
+    hue        = _state_property('hue')
+    sat        = _state_property('sat')
+    xy         = _state_property('xy')
+    ct         = _state_property('ct')
+    alert      = _state_property('alert')
+    effect     = _state_property('effect')
+    colormode  = _state_property('colormode')
+
+    def _fetch(self):
+        return dr_hue.get_group_attributes(self.bridge.url, self.id, self.bridge.username)
+
+    def _send(self, params):
+        return dr_hue.set_group_state(self.bridge.url, self.id, self.bridge.username, params)
+
+    @property
+    def lights(self):
+        """ The Light objects in this group """
+        return [self.bridge.light(light_id) for light_id in self._lookup('lights') or []]
+
+class Bridge(object):
+    """ A Hue bridge reachable at url with a whitelisted username """
+    __slots__ = ('url', 'username', '_lights', '_groups', '_listed_lights', '_listed_groups')
+
+    def __init__(self, url, username):
+        self.url            = url
+        self.username       = username
+        self._lights        = {}
+        self._groups        = {}
+        self._listed_lights = False
+        self._listed_groups = False
+
+    def __repr__(self):
+        return "<Bridge %s>" % self.url
+
+    def light(self, light_id):
+        """ Get the Light object for an id, nothing is fetched until an attribute is read """
+        light_id = str(light_id)
+        light    = self._lights.get(light_id)
+        if light is None:
+            light = self._lights[light_id] = Light(self, light_id)
+        return light
+
+    def group(self, group_id):
+        """ Get the Group object for an id, group 0 always contains every light """
+        group_id = str(group_id)
+        group    = self._groups.get(group_id)
+        if group is None:
+            group = self._groups[group_id] = Group(self, group_id)
+        return group
+
+    @property
+    def lights(self):
+        """ Every light on the bridge, keyed by id. The listing is fetched once """
+        if not self._listed_lights:
+            for light_id, attrs in dr_hue.get_all_lights(self.url, self.username).items():
+                light = self.light(light_id)
+                if not light._complete:
+                    light._attrs.update(attrs)
+            self._listed_lights = True
+        return dict(self._lights)
+
+    @property
+    def groups(self):
+        """ Every group on the bridge, keyed by id. The listing is fetched once """
+        if not self._listed_groups:
+            for group_id, attrs in dr_hue.get_all_groups(self.url, self.username).items():
+                group = self.group(group_id)
+                if not group._complete:
+                    group._attrs.update(attrs)
+            self._listed_groups = True
+        return dict(self._groups)
+
+    def flush(self):
+        """ Flush every light and group with queued changes
+
+        :rtype: dict
+        :returns: The bridge responses keyed by ('lights'|'groups', id)
+        """
+        responses = {}
+        for kind, resources in (('lights', self._lights), ('groups', self._groups)):
+            for resource_id, resource in resources.items():
+                if resource.dirty:
+                    responses[(kind, resource_id)] = resource.flush()
+        return responses
+
+    def refresh(self):
+        """ Forget every cached attribute and listing """
+        for resource in self._lights.values() + self._groups.values():
+            resource.refresh()
+        self._listed_lights = False
+        self._listed_groups = False
@@ -0,0 +1,190 @@
+""" Memory bounded cache of bridge GET responses
+
+Dashboards read the same lights, groups, schedules and configuration over and over, and every read
+takes a share of the few commands per second a bridge can handle. Installed with
+request_wrapper.set_cache, a ResponseCache answers repeated GETs from memory for a short time per
+endpoint (DEFAULT_TTLS, endpoints without a ttl are never cached) and keeps at most max_bytes of
+responses, dropping the least recently used first.
+
+A PUT, POST or DELETE through json_rpc_call invalidates every cached response of the same bridge whose
+resource path contains the written one or is contained in it: a write to /lights/1/state drops
+/lights/1, /lights and the full state, a write to /groups/2/action also drops the cached lights.
+Responses are kept as the bytes the bridge sent and decoded on every hit, so callers never share, and
+never change, the cached copy.
+
+Sample Usage:
+
+    import cache, request_wrapper
+
+    responses = cache.ResponseCache(max_bytes=4 * 1024 * 1024)
+    request_wrapper.set_cache(responses)
+    ...
+    print responses.stats()
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from urlparse    import urlparse
+
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024
+ENTRY_OVERHEAD    = 200      # bytes of bookkeeping per entry, counted against max_bytes
+
+# Seconds a response stays fresh, keyed by endpoint template
+DEFAULT_TTLS = {
+    ''              : 1.0,
+    'lights'        : 2.0,
+    'lights/<id>'   : 1.0,
+    'groups'        : 10.0,
+    'groups/<id>'   : 2.0,
+    'schedules'     : 30.0,
+    'schedules/<id>': 30.0,
+    'config'        : 10.0
+}
+
+# Writes under the first root change what is read under the others: a group action sets its lights, a
+# light's state, name or removal shows in the action and light list of its groups
+_AFFECTS = {'groups': ('lights',), 'lights': ('groups',)}
+
+def _resource(url):
+    """ ('10.0.0.2', ('lights', '1')) for http://10.0.0.2/api/user/lights/1 """
+    parsed = urlparse(url)
+    parts  = tuple(part for part in parsed.path.split('/') if part)
+    return parsed.netloc, parts[2:] if parts[:1] == ('api',) else parts
+
+class _Entry(object):
+    __slots__ = ('content', 'expires', 'size')
+
+    def __init__(self, content, expires, size):
+        self.content  = content
+        self.expires  = expires
+        self.size     = size
+
+class ResponseCache(object):
+    """ LRU cache of GET responses keyed by url """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttls=None):
+        self.max_bytes     = max_bytes
+        self.ttls          = dict(DEFAULT_TTLS if ttls is None else ttls)
+        self.size          = 0
+        self.evictions     = 0
+        self.expirations   = 0
+        self.invalidations = 0
+        self._entries      = OrderedDict()
+        self._roots        = {}     # (bridge, first path part) -> urls cached under it
+        self._generations  = {}     # bridge -> writes seen, responses read across a write are not kept
+        self._counts       = {}     # endpoint -> [hits, misses]
+        self._lock         = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _count(self, endpoint, hit):
+        """ Caller holds the lock """
+        counts = self._counts.get(endpoint)
+        if counts is None:
+            counts = self._counts[endpoint] = [0, 0]
+        counts[0 if hit else 1] += 1
+
+    def _drop(self, url):
+        """ Caller holds the lock """
+        entry = self._entries.pop(url)
+        self.size -= entry.size
+        bridge, parts = _resource(url)
+        urls          = self._roots.get((bridge, parts[:1]))
+        if urls is not None:
+            urls.discard(url)
+            if not urls:
+                del self._roots[(bridge, parts[:1])]
+
+    def cacheable(self, endpoint):
+        return endpoint in self.ttls
+
+    def get(self, endpoint, url, now=None):
+        """ The decoded cached response for url, None on a miss """
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None and entry.expires <= now:
+                self._drop(url)
+                self.expirations += 1
+                entry = None
+            self._count(endpoint, entry is not None)
+            if entry is None:
+                return None
+            self._entries[url] = self._entries.pop(url)
+            content = entry.content
+        return json.loads(content)
+
+    def generation(self, url):
+        """ Taken before a GET goes out and handed back to store """
+        return self._generations.get(_resource(url)[0], 0)
+
+    def store(self, endpoint, url, content, generation, now=None):
+        """ Keep a response, unless a write to the bridge went out since its GET did """
+        ttl = self.ttls.get(endpoint)
+        if ttl is None or content is None:
+            return
+        bridge, parts = _resource(url)
+        size          = len(content) + len(url) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        now = time.time() if now is None else now
+        with self._lock:
+            if self._generations.get(bridge, 0) != generation:
+                return
+            if url in self._entries:
+                self._drop(url)
+            self._entries[url] = _Entry(content, now + ttl, size)
+            self._roots.setdefault((bridge, parts[:1]), set()).add(url)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, url):
+        """ Drop the cached responses a write to url makes stale """
+        bridge, parts = _resource(url)
+        with self._lock:
+            self._generations[bridge] = self._generations.get(bridge, 0) + 1
+            roots = [parts[:1], ()] + [(root,) for root in _AFFECTS.get(parts[0] if parts else None, ())]
+            if not parts:
+                roots = [root for (cached_bridge, root) in self._roots if cached_bridge == bridge]
+            for root in roots:
+                for cached in list(self._roots.get((bridge, root), ())):
+                    cached_parts = _resource(cached)[1]
+                    shorter      = min(len(cached_parts), len(parts))
+                    if root != parts[:1] or cached_parts[:shorter] == parts[:shorter]:
+                        self._drop(cached)
+                        self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._roots.clear()
+            self.size = 0
+
+    def stats(self):
+        """ Hit and miss counts per endpoint, and for the cache as a whole
+
+        :rtype: dict
+        :returns: {'hits': 120, 'misses': 14, 'hit_rate': 0.9, 'entries': 9, 'bytes': 5120,
+                   'evictions': 0, 'expirations': 5, 'invalidations': 3,
+                   'endpoints': {'lights/<id>': {'hits': 100, 'misses': 10}, ...}}
+        """
+        with self._lock:
+            hits   = sum(counts[0] for counts in self._counts.values())
+            misses = sum(counts[1] for counts in self._counts.values())
+            return {
+                'hits'         : hits,
+                'misses'       : misses,
+                'hit_rate'     : float(hits) / (hits + misses) if hits + misses else 0.0,
+                'entries'      : len(self._entries),
+                'bytes'        : self.size,
+                'evictions'    : self.evictions,
+                'expirations'  : self.expirations,
+                'invalidations': self.invalidations,
+                'endpoints'    : dict((endpoint, {'hits': counts[0], 'misses': counts[1]})
+                                      for endpoint, counts in self._counts.items())
+            }
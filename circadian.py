@@ -0,0 +1,329 @@
+""" Lights that follow the sun: color temperature and brightness curves per site
+
+The position of the sun is worked out with the NOAA solar calculator equations. The slowly changing
+part, the sun's declination and the equation of time, is computed once per day, leaving an hour angle
+and a cosine per minute, so a site's whole day of color temperature (in mireds, the unit of 'ct') and
+brightness is a 1440 entry table built in a few milliseconds. Tables are kept per site, profile and
+date.
+
+A CircadianEngine walks zones of lights along their table. A zone's command is only sent when its target
+has moved by a perceptible amount, CT_THRESHOLD mireds or BRI_THRESHOLD brightness steps, from what was
+sent last, which comes down to a command every few minutes around sunrise and sunset and hardly any
+around noon and midnight. A zone that is a whole group of the bridge, or all of its lights, is set with
+a single group command; other zones go light by light through the outbound queue.
+
+Lights that are off refuse the command with error 201, they pick up the curve on a later step once
+turned on, so that is not a failure. Any other error leaves its zone to be sent again on the next step
+and is kept in the engine's errors, the other zones go ahead regardless.
+
+Sample Usage:
+
+    import circadian
+
+    site   = circadian.Site(51.5, -0.12)
+    engine = circadian.CircadianEngine(url, username, site, [circadian.Zone("all"),
+                                                             circadian.Zone("desk", light_ids=["4", "5"])])
+    engine.start()
+    print circadian.sun_times(site, datetime.date.today())
+"""
+
+import logging
+import math
+import threading
+import time
+from array       import array
+from collections import OrderedDict, namedtuple
+from datetime    import date, datetime, timedelta
+
+import dr_hue
+from outbound import map_outbound
+
+MINUTES_PER_DAY    = 1440
+SUNRISE_ZENITH     = 90.833   # degrees, the sun's upper edge on the horizon after refraction
+CT_THRESHOLD       = 8        # mireds, about the smallest color temperature step people notice
+BRI_THRESHOLD      = 6
+TRANSITION_TIME    = 40       # deciseconds, spreads each step so it is not seen as a jump
+STEP_INTERVAL      = 60       # seconds
+TABLE_CACHE_SIZE   = 64
+DEVICE_OFF         = 201      # hue error type of a command a light refuses while it is off
+
+# Where the lights are: degrees north and east, and minutes ahead of UTC, the local time zone if None
+Site = namedtuple('Site', 'latitude longitude utc_offset')
+Site.__new__.__defaults__ = (None,)
+
+# Targets in full daylight and at night, and the solar elevation in degrees where night starts. In between
+# the targets follow the sun's elevation relative to its highest point of the day
+Profile = namedtuple('Profile', 'ct_day ct_night bri_day bri_night twilight')
+
+DEFAULT_PROFILE = Profile(ct_day=233, ct_night=447, bri_day=254, bri_night=77, twilight=-6.0)
+
+_tables      = OrderedDict()
+_tables_lock = threading.Lock()
+_log         = logging.getLogger("dr_hue.circadian")
+_log.addHandler(logging.NullHandler())
+
+def _julian_day(moment):
+    """ Julian day of a UTC datetime """
+    delta = moment - datetime(2000, 1, 1, 12)
+    return 2451545.0 + delta.days + delta.seconds / 86400.0
+
+def _day_constants(moment):
+    """ The sun's declination, in radians, and the equation of time, in minutes, at a UTC datetime """
+    t         = (_julian_day(moment) - 2451545.0) / 36525.0
+    mean_long = math.radians((280.46646 + t * (36000.76983 + t * 0.0003032)) % 360)
+    anomaly   = math.radians(357.52911 + t * (35999.05029 - 0.0001537 * t))
+    eccentric = 0.016708634 - t * (0.000042037 + 0.0000001267 * t)
+    center    = (math.sin(anomaly) * (1.914602 - t * (0.004817 + 0.000014 * t)) +
+                 math.sin(2 * anomaly) * (0.019993 - 0.000101 * t) + math.sin(3 * anomaly) * 0.000289)
+    omega     = math.radians(125.04 - 1934.136 * t)
+    apparent  = math.radians(math.degrees(mean_long) + center - 0.00569 - 0.00478 * math.sin(omega))
+    obliquity = math.radians(23 + (26 + (21.448 - t * (46.815 + t * (0.00059 - t * 0.001813))) / 60) / 60 +
+                             0.00256 * math.cos(omega))
+
+    declination = math.asin(math.sin(obliquity) * math.sin(apparent))
+    y           = math.tan(obliquity / 2) ** 2
+    equation    = 4 * math.degrees(y * math.sin(2 * mean_long) - 2 * eccentric * math.sin(anomaly) +
+                                   4 * eccentric * y * math.sin(anomaly) * math.cos(2 * mean_long) -
+                                   0.5 * y * y * math.sin(4 * mean_long) -
+                                   1.25 * eccentric * eccentric * math.sin(2 * anomaly))
+    return declination, equation
+
+def _utc_offset(site, day):
+    """ Minutes the site is ahead of UTC on day """
+    if site.utc_offset is not None:
+        return site.utc_offset
+    local_noon = time.mktime((day.year, day.month, day.day, 12, 0, 0, 0, 0, -1))
+    return -(time.altzone if time.localtime(local_noon).tm_isdst else time.timezone) // 60
+
+def solar_elevation(site, moment):
+    """ Degrees of the sun above the horizon at a UTC datetime, refraction left out """
+    declination, equation = _day_constants(moment)
+    minutes  = moment.hour * 60 + moment.minute + moment.second / 60.0
+    angle    = math.radians((minutes + equation + 4 * site.longitude) % MINUTES_PER_DAY / 4 - 180)
+    latitude = math.radians(site.latitude)
+    cosine   = (math.sin(latitude) * math.sin(declination) +
+                math.cos(latitude) * math.cos(declination) * math.cos(angle))
+    return 90 - math.degrees(math.acos(max(-1.0, min(1.0, cosine))))
+
+def sun_times(site, day):
+    """ Sunrise, solar noon and sunset of a date in the site's local time
+
+    :rtype: dict
+    :returns: {'sunrise': datetime, 'noon': datetime, 'sunset': datetime}, sunrise and sunset are None
+              while the sun stays up or down all day
+    """
+    offset                = _utc_offset(site, day)
+    declination, equation = _day_constants(datetime(day.year, day.month, day.day, 12) -
+                                           timedelta(minutes=offset))
+    latitude = math.radians(site.latitude)
+    noon     = 720 - 4 * site.longitude - equation + offset
+    midnight = datetime(day.year, day.month, day.day)
+    cosine   = (math.cos(math.radians(SUNRISE_ZENITH)) / (math.cos(latitude) * math.cos(declination)) -
+                math.tan(latitude) * math.tan(declination))
+
+    times = {'noon': midnight + timedelta(minutes=noon), 'sunrise': None, 'sunset': None}
+    if -1 <= cosine <= 1:
+        half_day         = 4 * math.degrees(math.acos(cosine))
+        times['sunrise'] = midnight + timedelta(minutes=noon - half_day)
+        times['sunset']  = midnight + timedelta(minutes=noon + half_day)
+    return times
+
+class DailyTable(object):
+    """ Targets for every minute of a local day """
+    __slots__ = ('site', 'day', 'profile', 'ct', 'bri', 'elevation')
+
+    def __init__(self, site, day, profile=DEFAULT_PROFILE):
+        self.site    = site
+        self.day     = day
+        self.profile = profile
+
+        offset                = _utc_offset(site, day)
+        declination, equation = _day_constants(datetime(day.year, day.month, day.day, 12) -
+                                               timedelta(minutes=offset))
+        latitude  = math.radians(site.latitude)
+        sin_part  = math.sin(latitude) * math.sin(declination)
+        cos_part  = math.cos(latitude) * math.cos(declination)
+        # True solar time of local midnight in minutes, the hour angle moves a quarter degree a minute
+        start     = equation + 4 * site.longitude - offset
+        angles    = [math.radians((start + minute) % MINUTES_PER_DAY / 4 - 180)
+                     for minute in range(MINUTES_PER_DAY)]
+        elevation = [90 - math.degrees(math.acos(max(-1.0, min(1.0, sin_part + cos_part * math.cos(angle)))))
+                     for angle in angles]
+
+        # Targets follow the elevation from the start of the night up to the day's highest point
+        bottom = profile.twilight
+        span   = max(max(elevation) - bottom, 1e-6)
+        ct     = array('H')
+        bri    = array('B')
+        for degrees in elevation:
+            share = min(1.0, max(0.0, (degrees - bottom) / span))
+            ct.append(int(round(profile.ct_night + (profile.ct_day - profile.ct_night) * share)))
+            bri.append(int(round(profile.bri_night + (profile.bri_day - profile.bri_night) * share)))
+        self.elevation = array('f', elevation)
+        self.ct        = ct
+        self.bri       = bri
+
+    def at(self, minute):
+        """ (ct, bri) for a minute of the day, 0 to 1439 """
+        return self.ct[minute], self.bri[minute]
+
+def daily_table(site, day, profile=DEFAULT_PROFILE):
+    """ The DailyTable of a site and date, built once and kept for the next TABLE_CACHE_SIZE lookups """
+    key = (site, day, profile)
+    with _tables_lock:
+        table = _tables.pop(key, None)
+        if table is None:
+            table = DailyTable(site, day, profile)
+        _tables[key] = table
+        while len(_tables) > TABLE_CACHE_SIZE:
+            _tables.popitem(last=False)
+    return table
+
+def local_minute(site, moment):
+    """ The local date and minute of the day of a UTC datetime """
+    local = moment + timedelta(minutes=_utc_offset(site, moment.date()))
+    return local.date(), local.hour * 60 + local.minute
+
+class Zone(object):
+    """ Lights that follow the same profile
+
+    light_ids  list     the lights, every light of the bridge if None and no group_id is given
+    group_id   str      a bridge group to command instead, found for light_ids by resolve if None
+    profile    Profile  the zone's curve
+    """
+    __slots__ = ('name', 'light_ids', 'group_id', 'profile', 'sent')
+
+    def __init__(self, name, light_ids=None, group_id=None, profile=DEFAULT_PROFILE):
+        self.name      = name
+        self.light_ids = sorted(str(light_id) for light_id in light_ids) if light_ids is not None else None
+        self.group_id  = str(group_id) if group_id is not None else None
+        self.profile   = profile
+        self.sent      = None
+
+class CircadianEngine(object):
+    """ Keeps zones of lights on their circadian curve with as few commands as it can """
+
+    def __init__(self, url, username, site, zones, ct_threshold=CT_THRESHOLD, bri_threshold=BRI_THRESHOLD,
+                 transition=TRANSITION_TIME):
+        self.url           = url
+        self.username      = username
+        self.site          = site
+        self.zones         = list(zones)
+        self.ct_threshold  = ct_threshold
+        self.bri_threshold = bri_threshold
+        self.transition    = transition
+        self.commands      = 0
+        self.errors        = {}     # zone name -> exception, of the last step
+        self._resolved     = False
+        self._stop         = threading.Event()
+        self._thread       = None
+
+    def resolve(self):
+        """ Find a group for every zone that has one, reading the bridge once """
+        groups = None
+        for zone in self.zones:
+            if zone.group_id is not None:
+                continue
+            if zone.light_ids is None:
+                zone.group_id = dr_hue.ALL_LIGHTS_GROUP
+                continue
+            if groups is None:
+                full_state = dr_hue.get_full_state(self.url, self.username)
+                groups     = dict((tuple(sorted(attrs.get('lights', []))), group_id)
+                                  for group_id, attrs in sorted(full_state.get('groups', {}).items(),
+                                                                reverse=True))
+                groups[tuple(sorted(full_state.get('lights', {})))] = dr_hue.ALL_LIGHTS_GROUP
+            zone.group_id = groups.get(tuple(zone.light_ids))
+        self._resolved = True
+
+    def _due(self, zone, target):
+        if zone.sent is None:
+            return True
+        if target != zone.sent and target in ((zone.profile.ct_day, zone.profile.bri_day),
+                                              (zone.profile.ct_night, zone.profile.bri_night)):
+            # The last small step onto the day or night level, the lights stay there for hours
+            return True
+        return (abs(target[0] - zone.sent[0]) >= self.ct_threshold or
+                abs(target[1] - zone.sent[1]) >= self.bri_threshold)
+
+    def _send(self, zone, target):
+        """ Send a zone its target, returns the first error other than lights being off, None if none """
+        params = {'ct': target[0], 'bri': target[1], 'transitiontime': self.transition}
+        if zone.group_id is not None:
+            self.commands += 1
+            try:
+                dr_hue.set_group_state(self.url, zone.group_id, self.username, params)
+            except Exception as exc:
+                errors = [exc]
+            else:
+                errors = []
+        else:
+            outcomes       = map_outbound(self.url, dr_hue.set_light_state,
+                                          [(self.url, light_id, self.username, params)
+                                           for light_id in zone.light_ids])
+            self.commands += len(outcomes)
+            errors         = [error for _, error in outcomes if error is not None]
+
+        for error in errors:
+            if set(getattr(error, 'error_types', None) or [None]) != set([DEVICE_OFF]):
+                return error
+        return None
+
+    def step(self, now=None, force=False):
+        """ Send the zones whose target moved far enough since their last command
+
+        A zone that fails is left out of the result and kept in errors, by zone name, and is sent again
+        on the next step.
+
+        :param datetime now: UTC time, the current time if None
+        :param bool force: send every zone
+
+        :rtype: dict
+        :returns: The (ct, bri) sent, keyed by zone name
+        """
+        if not self._resolved:
+            self.resolve()
+        day, minute = local_minute(self.site, now or datetime.utcnow())
+        sent        = {}
+        errors      = {}
+        for zone in self.zones:
+            target = daily_table(self.site, day, zone.profile).at(minute)
+            if force or self._due(zone, target):
+                error = self._send(zone, target)
+                if error is not None:
+                    errors[zone.name] = error
+                    zone.sent         = None
+                    continue
+                zone.sent       = target
+                sent[zone.name] = target
+        self.errors = errors
+        return sent
+
+    def start(self, interval=STEP_INTERVAL):
+        """ Step every interval seconds on a background thread, the first step sends every zone """
+        def run():
+            force = True
+            while True:
+                try:
+                    # Zones that fail are never marked sent, so they are due again without forcing
+                    self.step(force=force)
+                    for name, error in sorted(self.errors.items()):
+                        _log.warning("Circadian zone %s on %s failed: %s", name, self.url, error)
+                except Exception as exc:
+                    # A bridge that is away for a moment should not end the schedule, try again next time
+                    _log.warning("Circadian step on %s failed: %s", self.url, exc)
+                force = False
+                if self._stop.wait(interval):
+                    return
+
+        self._stop.clear()
+        self._thread        = threading.Thread(target=run, name="dr_hue circadian %s" % self.url)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,344 @@
+""" Command line interface for dr_hue, with an optional long running daemon
+
+Every command can run on its own, but a fresh interpreter has to import everything and open new
+connections each time. Started with `daemon`, a process keeps the connections, rate limiters, bridge
+objects and datastore engine warm and listens on a unix socket. Later invocations find the socket and
+hand their arguments to the daemon instead of doing the work themselves.
+
+Sample Usage:
+
+    export DR_HUE_URL=http://192.168.1.37 DR_HUE_USERNAME=1234567890
+
+    python cli.py daemon &
+    python cli.py lights on 1 2 3
+    python cli.py lights set 4 bri=200 hue=50000
+    python cli.py scenes restore "movie night"
+
+    # Also available as
+    python dr_hue.py lights off 1
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+SOCKET_LOCATION = "$HOME/.config/dr_hue.sock"
+STATE_TTL       = 30
+CLIENT_TIMEOUT  = 30      # seconds the daemon waits on a client that went quiet
+
+_bridges      = {}
+_bridges_lock = threading.Lock()
+
+class CliException(Exception):
+    """ Exception raised for bad arguments or a failed command """
+    def __init__(self, msg, **kwargs):
+        super(CliException, self).__init__(msg, **kwargs)
+
+class _Parser(argparse.ArgumentParser):
+    """ Argument parser that raises instead of exiting, so the daemon survives bad input """
+    def error(self, message):
+        raise CliException("%s: error: %s" % (self.prog, message))
+
+def _value(text):
+    """ Parse a key=value argument value as json, falling back to a plain string """
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+def _changes(pairs):
+    """ Turn ['bri=200', 'on=true'] into {'bri': 200, 'on': True} """
+    changes = {}
+    for pair in pairs:
+        if '=' not in pair:
+            raise CliException("Expected key=value, got '%s'" % pair)
+        key, value = pair.split('=', 1)
+        changes[key] = _value(value)
+    return changes
+
+def _bridge(args):
+    """ Get the Bridge object for the arguments, reused (and refreshed now and then) in the daemon """
+    from bridge import Bridge
+
+    if not args.url or not args.username:
+        raise CliException("A bridge url and username are needed, use --url/--username or "
+                           "DR_HUE_URL/DR_HUE_USERNAME")
+
+    key = (args.url, args.username)
+    with _bridges_lock:
+        entry = _bridges.get(key)
+        if entry is None or time.time() - entry[1] > STATE_TTL:
+            entry = _bridges[key] = (Bridge(args.url, args.username), time.time())
+    return entry[0]
+
+#########################################################################################################
+# Commands                                                                                              #
+#########################################################################################################
+
+def _lights_list(args):
+    return dict((light_id, light.name) for light_id, light in _bridge(args).lights.items())
+
+def _lights_state(args):
+    light = _bridge(args).light(args.id)
+    return light.load()
+
+def _lights_set(args, changes=None):
+    import dr_hue
+
+    # `lights set 1 2 bri=200` mixes the ids and the changes in a single list
+    ids     = [arg for arg in args.ids if '=' not in arg]
+    changes = changes or _changes([arg for arg in args.ids if '=' in arg])
+    if not changes or not (ids or args.action in ('on', 'off')):
+        raise CliException("Give at least one light id and one key=value change")
+
+    # Without ids `lights on`/`lights off` mean every light, which is a single group 0 command
+    hue  = _bridge(args)
+    sent = dr_hue.set_lights_state(hue.url, hue.username, changes, light_ids=ids or None)
+    if sent['group'] is not None:
+        return "%s lights updated through group %s" % (len(ids) or "All", sent['group'])
+    return "%s lights updated" % len(ids)
+
+def _groups_list(args):
+    return dict((group_id, group.name) for group_id, group in _bridge(args).groups.items())
+
+def _groups_set(args, changes=None):
+    group = _bridge(args).group(args.id)
+    group.set(**(changes or _changes(args.changes)))
+    return group.flush()
+
+def _groups_sync(args):
+    from group_sync import sync_groups
+    hue = _bridge(args)
+    return sync_groups(hue.url, hue.username, dry_run=args.dry_run)
+
+def _schedules_list(args):
+    import dr_hue
+    return dr_hue.get_all_schedules(args.url, args.username)
+
+def _schedules_delete(args):
+    from schedules import delete_schedules_bulk
+    return delete_schedules_bulk(args.url, args.username, args.ids)
+
+def _scenes_list(args):
+    import datastore
+    return datastore.get_scenes()
+
+def _scenes_capture(args):
+    from scenes import capture_scene
+    return capture_scene(args.url, args.username, args.name, light_ids=args.ids or None)
+
+def _scenes_restore(args):
+    from scenes import restore_scene
+    return "%s commands sent" % len(restore_scene(args.url, args.username, args.name))
+
+def build_parser():
+    """ The argument parser for every command """
+    parser = _Parser(prog="dr_hue", description="Control Philips Hue lights")
+    parser.add_argument('--url', default=os.environ.get('DR_HUE_URL'),
+                        help="url of the bridge, e.g. http://192.168.1.37 (DR_HUE_URL)")
+    parser.add_argument('--username', default=os.environ.get('DR_HUE_USERNAME'),
+                        help="whitelisted username on the bridge (DR_HUE_USERNAME)")
+    parser.add_argument('--socket', default=os.environ.get('DR_HUE_SOCKET', SOCKET_LOCATION),
+                        help="unix socket of the daemon (DR_HUE_SOCKET)")
+    parser.add_argument('--no-daemon', action='store_true', help="do not forward to a running daemon")
+
+    areas = parser.add_subparsers(dest='area')
+
+    lights  = areas.add_parser('lights', help="list, switch and change lights").add_subparsers(dest='action')
+    command = lights.add_parser('list', help="ids and names of every light")
+    command.set_defaults(func=_lights_list)
+    command = lights.add_parser('state', help="attributes and state of a light")
+    command.add_argument('id')
+    command.set_defaults(func=_lights_state)
+    for action, on in (('on', True), ('off', False)):
+        command = lights.add_parser(action, help="turn lights %s, every light if no ids are given" % action)
+        command.add_argument('ids', nargs='*')
+        command.set_defaults(func=lambda args, on=on: _lights_set(args, {'on': on}))
+    command = lights.add_parser('set', help="set state fields, e.g. set 1 2 bri=200 hue=50000")
+    command.add_argument('ids', nargs='+', metavar='id|key=value')
+    command.set_defaults(func=_lights_set)
+
+    groups  = areas.add_parser('groups', help="list and switch groups").add_subparsers(dest='action')
+    command = groups.add_parser('list', help="ids and names of every group")
+    command.set_defaults(func=_groups_list)
+    for action, on in (('on', True), ('off', False)):
+        command = groups.add_parser(action, help="turn a group %s" % action)
+        command.add_argument('id')
+        command.set_defaults(func=lambda args, on=on: _groups_set(args, {'on': on}))
+    command = groups.add_parser('set', help="set action fields, e.g. bri=200")
+    command.add_argument('id')
+    command.add_argument('changes', nargs='+')
+    command.set_defaults(func=_groups_set)
+    command = groups.add_parser('sync', help="keep a bridge group for every datastore group")
+    command.add_argument('--dry-run', action='store_true', help="only report what would change")
+    command.set_defaults(func=_groups_sync)
+
+    schedules = areas.add_parser('schedules', help="list and delete schedules").add_subparsers(dest='action')
+    command   = schedules.add_parser('list', help="ids and names of every schedule")
+    command.set_defaults(func=_schedules_list)
+    command   = schedules.add_parser('delete', help="delete schedules")
+    command.add_argument('ids', nargs='+')
+    command.set_defaults(func=_schedules_delete)
+
+    scenes  = areas.add_parser('scenes', help="capture and restore scenes").add_subparsers(dest='action')
+    command = scenes.add_parser('list', help="names of the stored scenes")
+    command.set_defaults(func=_scenes_list)
+    command = scenes.add_parser('capture', help="store the current state of lights as a scene")
+    command.add_argument('name')
+    command.add_argument('ids', nargs='*')
+    command.set_defaults(func=_scenes_capture)
+    command = scenes.add_parser('restore', help="bring lights back to a stored scene")
+    command.add_argument('name')
+    command.set_defaults(func=_scenes_restore)
+
+    command = areas.add_parser('daemon', help="keep running and serve commands over the unix socket")
+    command.add_argument('--adaptive-rate', action='store_true',
+                         help="learn the command rate of the bridge from its answers, see adaptive.py")
+    command.set_defaults(func=None)
+
+    command = areas.add_parser('gateway', help="serve the bridge api locally for many clients")
+    command.add_argument('--host', default="127.0.0.1")
+    command.add_argument('--port', type=int, default=8000)
+    command.set_defaults(func=None)
+
+    return parser
+
+def execute(argv):
+    """ Run a command in this process
+
+    :param list argv: the arguments, without the program name
+    :returns: Something json serializable
+    """
+    args = build_parser().parse_args(argv)
+    if args.func is None:
+        raise CliException("The daemon and gateway cannot be started from within the daemon")
+    return args.func(args)
+
+#########################################################################################################
+# Daemon                                                                                                #
+#########################################################################################################
+
+def _send_line(sock, obj):
+    """ Write a single json message """
+    sock.sendall(json.dumps(obj, separators=(',', ':')) + "\n")
+
+def _read_line(sock_file):
+    """ Read a single json message """
+    line = sock_file.readline()
+    if not line:
+        raise CliException("Connection closed before a reply was received")
+    return json.loads(line)
+
+def serve(socket_path):
+    """ Run the daemon in the foreground until interrupted """
+    import signal
+    import SocketServer
+
+    class Handler(SocketServer.StreamRequestHandler):
+        timeout = CLIENT_TIMEOUT
+
+        def handle(self):
+            try:
+                request = _read_line(self.rfile)
+                reply   = {'ok': True, 'result': execute(request['argv'])}
+            except Exception as exc:
+                reply   = {'ok': False, 'error': str(exc)}
+            _send_line(self.request, reply)
+
+    # Commands in progress are finished before the process exits, rather than torn down mid reply
+    class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        daemon_threads = False
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    old_umask = os.umask(0077)
+    try:
+        server = Server(socket_path, Handler)
+    finally:
+        os.umask(old_umask)
+
+    # Clean up the socket when stopped with a plain kill as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+def forward(socket_path, argv):
+    """ Hand a command to the running daemon
+
+    :returns: The daemon's reply, or None if no daemon is listening
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except socket.error:
+        client.close()
+        return None
+
+    try:
+        _send_line(client, {'argv': argv})
+        return _read_line(client.makefile('r'))
+    finally:
+        client.close()
+
+def main(argv=None):
+    """ Entry point, forwards to a daemon when one is running """
+    argv = list(sys.argv[1:] if argv is None else argv)
+    try:
+        args        = build_parser().parse_args(argv)
+        socket_path = os.path.expandvars(args.socket)
+
+        if args.area == 'daemon':
+            if args.adaptive_rate and not args.url:
+                raise CliException("The adaptive rate needs a bridge url")
+            if args.adaptive_rate:
+                import adaptive
+                adaptive.enable(args.url)
+            try:
+                serve(socket_path)
+            finally:
+                if args.adaptive_rate:
+                    adaptive.disable(args.url)
+            return 0
+
+        if args.area == 'gateway':
+            from gateway import run_gateway
+            if not args.url or not args.username:
+                raise CliException("The gateway needs a bridge url and username")
+            run_gateway(args.url, args.username, host=args.host, port=args.port)
+            return 0
+
+        # The daemon fills in the url/username from its own environment unless they are given here
+        forwarded = ['--url', args.url, '--username', args.username] if args.url and args.username else []
+        reply     = None
+        if not args.no_daemon and os.path.exists(socket_path):
+            reply = forward(socket_path, forwarded + [arg for arg in argv if arg != '--no-daemon'])
+
+        if reply is None:
+            reply = {'ok': True, 'result': args.func(args)}
+    except CliException as exc:
+        sys.stderr.write("%s\n" % exc)
+        return 2
+    except KeyboardInterrupt:
+        return 130
+    except Exception as exc:
+        reply = {'ok': False, 'error': str(exc)}
+
+    if not reply['ok']:
+        sys.stderr.write("%s\n" % reply['error'])
+        return 1
+
+    print json.dumps(reply['result'], indent=2, sort_keys=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,231 @@
+""" Commissioning new lights on many bridges at once
+
+search_for_new_lights only starts a search, the bridge keeps looking for about a minute and reports
+the outcome through get_new_lights, whose 'lastscan' reads "active" until the search is over. A
+CommissioningJob starts the searches on every bridge at the same time and polls each bridge with a
+growing interval until its search has finished, so a dozen bridges take about as long as one. The
+new lights can then be renamed in bulk and are registered in the datastore in one transaction.
+
+The datastore knows lights by name, so new lights whose name is taken, such as the "Hue Lamp 1" every
+bridge starts out with, are not registered. They are listed in the bridge's unregistered, and fail it;
+a namer that gives every light a name of its own avoids that. A light is registered under the name the
+bridge answers the rename with, which ends in " 1" when the requested one is taken on the bridge.
+
+Sample Usage:
+
+    import commissioning
+
+    job = commissioning.start_commissioning([(url_1, username_1), (url_2, username_2)],
+                                            namer=lambda url, light_id, name: "Office %s" % light_id)
+    ...                                       # the searches run in the background
+    results = job.wait()
+    print results[url_1].new_lights           # {"7": "Office 7"}
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import dr_hue
+from outbound  import map_outbound
+from ratelimit import bridge_key
+
+SCAN_ACTIVE       = "active"
+POLL_INTERVAL     = 5.0
+MAX_POLL_INTERVAL = 20.0
+BACKOFF           = 1.5
+SEARCH_TIMEOUT    = 150
+
+class CommissioningException(Exception):
+    """ Exception raised when commissioning failed on some of the bridges """
+    def __init__(self, msg, errors=None, results=None, **kwargs):
+        super(CommissioningException, self).__init__(msg, **kwargs)
+        self.errors  = errors or {}
+        self.results = results or {}
+
+class BridgeResult(object):
+    """ The outcome of commissioning one bridge """
+    __slots__ = ('url', 'username', 'new_lights', 'renamed', 'unregistered', 'polls', 'error')
+
+    def __init__(self, url, username):
+        self.url          = url
+        self.username     = username
+        self.new_lights   = {}
+        self.renamed      = {}
+        self.unregistered = {}
+        self.polls        = 0
+        self.error        = None
+
+def search_finished(response):
+    """ Whether a get_new_lights response belongs to a search that is over """
+    return response.get('lastscan') not in (SCAN_ACTIVE, None)
+
+def new_lights(response):
+    """ The {id: name} of the lights in a get_new_lights response """
+    return dict((light_id, attrs.get('name')) for light_id, attrs in response.items()
+                if light_id != 'lastscan')
+
+def given_name(response, name):
+    """ The name a rename_light response, [{"success":{"/lights/1/name":"Office 7 1"}}], says the light got,
+    name if it does not say """
+    for item in response or []:
+        success = item.get('success') if isinstance(item, dict) else None
+        if isinstance(success, dict):
+            for path, value in success.items():
+                if path.rstrip('/').split('/')[-1] == 'name':
+                    return value
+    return name
+
+class CommissioningJob(object):
+    """ Searches running on many bridges, see start_commissioning """
+
+    def __init__(self, bridges, namer=None, group_name=None, register=True, poll_interval=POLL_INTERVAL,
+                 max_poll_interval=MAX_POLL_INTERVAL, timeout=SEARCH_TIMEOUT):
+        self.results           = OrderedDict((url, BridgeResult(url, username)) for url, username in bridges)
+        self.namer             = namer
+        self.group_name        = group_name
+        self.register          = register
+        self.poll_interval     = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout           = timeout
+        self.registered        = 0
+        self._cancel           = threading.Event()
+        self._done             = threading.Event()
+        self._threads          = []
+
+    def start(self):
+        """ Start the search on every bridge, returns right away """
+        for result in self.results.values():
+            thread = threading.Thread(target=self._commission, args=(result,),
+                                      name="dr_hue commissioning %s" % result.url)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        finisher = threading.Thread(target=self._finish, name="dr_hue commissioning")
+        finisher.daemon = True
+        finisher.start()
+        return self
+
+    def cancel(self):
+        """ Stop polling, the bridges finish their searches on their own """
+        self._cancel.set()
+
+    def done(self):
+        """ Whether every bridge is done and the lights are registered """
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ Block until the job is done
+
+        :rtype: OrderedDict
+        :returns: A BridgeResult per bridge url
+        :raises CommissioningException: if any bridge failed, after the others were registered
+        """
+        if not self._done.wait(timeout):
+            raise CommissioningException("Commissioning still running after %s seconds" % timeout)
+
+        errors = dict((url, result.error) for url, result in self.results.items() if result.error is not None)
+        if errors:
+            raise CommissioningException("Commissioning failed on %s of %s bridges" % (len(errors),
+                                                                                       len(self.results)),
+                                         errors=errors, results=self.results)
+        return self.results
+
+    def _poll(self, result):
+        """ Poll get_new_lights with a growing interval until the search is over """
+        deadline = time.time() + self.timeout
+        interval = self.poll_interval
+        while not self._cancel.wait(min(interval, max(deadline - time.time(), 0))):
+            response      = dr_hue.get_new_lights(result.url, result.username)
+            result.polls += 1
+            if search_finished(response):
+                return new_lights(response)
+            if time.time() >= deadline:
+                raise CommissioningException("Search on %s still active after %s seconds" % (result.url,
+                                                                                           self.timeout))
+            interval = min(interval * BACKOFF, self.max_poll_interval)
+        raise CommissioningException("Search on %s cancelled" % result.url)
+
+    def _commission(self, result):
+        """ Search, wait for and rename the new lights of one bridge """
+        try:
+            dr_hue.search_for_new_lights(result.url, result.username)
+            result.new_lights = self._poll(result)
+
+            if self.namer is not None and result.new_lights:
+                renames  = [(light_id, self.namer(result.url, light_id, name))
+                            for light_id, name in sorted(result.new_lights.items())]
+                renames  = [(light_id, name) for light_id, name in renames if name]
+                outcomes = map_outbound(result.url, dr_hue.rename_light,
+                                        [(result.url, light_id, name, result.username)
+                                         for light_id, name in renames])
+                for (light_id, name), (response, error) in zip(renames, outcomes):
+                    if error is None:
+                        name                        = given_name(response, name)
+                        result.renamed[light_id]    = name
+                        result.new_lights[light_id] = name
+                    elif result.error is None:
+                        result.error = error
+        except Exception as exc:
+            result.error = exc
+
+    def _finish(self):
+        """ Wait for every bridge, then register all new lights in one transaction """
+        for thread in self._threads:
+            thread.join()
+
+        try:
+            lights = [{'name': name, 'base_id': light_id, 'bridge': bridge_key(result.url)}
+                      for result in self.results.values()
+                      for light_id, name in sorted(result.new_lights.items())]
+            if self.register and lights:
+                # The datastore pulls in elixir and sqlalchemy, only import it when lights are registered
+                import datastore
+                group_name      = self.group_name or datastore.UNCATEGORIZED
+                refused         = datastore.register_lights(lights, group_name)
+                self.registered = len(lights) - len(refused)
+                self._refused(refused)
+        except Exception as exc:
+            for result in self.results.values():
+                if result.new_lights and result.error is None:
+                    result.error = exc
+        finally:
+            self._done.set()
+
+    def _refused(self, refused):
+        """ Fail the bridges with lights the datastore refused because their names are taken """
+        by_bridge = dict((bridge_key(url), result) for url, result in self.results.items())
+        for light in refused:
+            by_bridge[light['bridge']].unregistered[str(light['base_id'])] = light['name']
+
+        for result in self.results.values():
+            if result.unregistered and result.error is None:
+                names        = ", ".join(sorted(set(result.unregistered.values())))
+                result.error = CommissioningException("%s new lights on %s were not registered, their names "
+                                                      "are taken: %s" % (len(result.unregistered), result.url,
+                                                                         names))
+
+def start_commissioning(bridges, namer=None, group_name=None, register=True, **polling):
+    """ Start searching for new lights on many bridges at once
+
+    :param list bridges: (url, username) pairs
+    :param namer: called as namer(url, light_id, name) for every new light, returns the name to give it
+                  or None to keep the one the bridge chose. Lights are not renamed if namer is None
+    :param str group_name: the datastore group to register the lights in, uncategorized if None
+    :param bool register: whether to register the new lights in the datastore
+    :param polling: poll_interval, max_poll_interval and timeout overrides, in seconds
+
+    :rtype: CommissioningJob
+    """
+    return CommissioningJob(bridges, namer=namer, group_name=group_name, register=register,
+                            **polling).start()
+
+def commission(bridges, namer=None, group_name=None, register=True, **polling):
+    """ Commission new lights on many bridges and wait for the outcome, see start_commissioning
+
+    :rtype: OrderedDict
+    :returns: A BridgeResult per bridge url
+    """
+    return start_commissioning(bridges, namer=namer, group_name=group_name, register=register,
+                               **polling).wait()
@@ -1,7 +1,5 @@
 """ This is where all the library constants will live """
 
-import re
-
 HTTP_DELETE  = "DELETE"
 HTTP_GET     = "GET"
 HTTP_HEAD    = "HEAD"
@@ -34,6 +32,6 @@ def sanitize_error_messages(response_dict, keys):
     error_msg  = HUE_ERRORS[error_type]
 
     for key in keys:
-        error_msg = re.sub('<'+key+'>', keys[key], error_msg)
+        error_msg = error_msg.replace('<'+key+'>', unicode(keys[key]))
 
     return error_msg
\ No newline at end of file
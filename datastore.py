@@ -1,13 +1,32 @@
-""" Data store for dr_hue """
+""" Data store for dr_hue
 
-from elixir import *
+The engine is created on first use rather than at import, along with any table or column the database
+does not have yet, so a database made by an older version picks up new entities and fields. It keeps a
+small pool of SQLite connections in WAL mode, so readers do not block each other or a writer. Every
+thread gets its own session from the scoped elixir session; worker threads should call remove_session()
+when they are done with it.
+
+Reads of whole tables (get_lights, get_groups, get_lights_in_group) skip the ORM and run plain selects
+on a pooled connection.
+"""
+
+from contextlib import contextmanager
+from functools  import wraps
+from elixir     import *
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
+from sqlalchemy.pool    import QueuePool
+import json
 import os
+import threading
 
 DATABASE_LOCATION = "$HOME/.config/dr_hue.db"
 UNCATEGORIZED     = "uncatagorized"
+POOL_SIZE         = 5
+BUSY_TIMEOUT      = 30
 
-metadata.bind = "sqlite:///%s" % os.path.expandvars(DATABASE_LOCATION)
-#metadata.bind.echo = True
+_engine      = None
+_engine_lock = threading.Lock()
 
 class Group(Entity):
     """ Group Object """
@@ -17,11 +36,109 @@ class Group(Entity):
     belongs_to('group', of_kind='Group')
 
 class Light(Entity):
-    """ Light object """
+    """ Light object, bridge is the network location of the bridge it is on """
     name = Field(String)
     base_id = Field(Integer)
+    bridge = Field(String)
     belongs_to('group', of_kind='Group')
 
+class Scene(Entity):
+    """ Scene object, the light states are kept as compact json keyed by light id """
+    name   = Field(String)
+    states = Field(Text)
+
+class BridgeSetting(Entity):
+    """ A value learned or configured for one bridge, kept as json """
+    bridge = Field(String)
+    name   = Field(String)
+    value  = Field(Text)
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """ Put every new connection in WAL mode """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+def _add_missing_columns(engine):
+    """ Add the columns of fields added to an entity after its table was created """
+    for table in metadata.sorted_tables:
+        present = set(row[1] for row in engine.execute("PRAGMA table_info(%s)" % table.name))
+        for column in table.columns:
+            if present and column.name not in present:
+                engine.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table.name, column.name,
+                                                                    column.type.compile(engine.dialect)))
+
+def get_engine():
+    """ Get the engine, creating it, binding the entities and creating missing tables on first use """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                engine = create_engine("sqlite:///%s" % os.path.expandvars(DATABASE_LOCATION),
+                                       poolclass=QueuePool, pool_size=POOL_SIZE,
+                                       connect_args={'check_same_thread': False, 'timeout': BUSY_TIMEOUT})
+                event.listen(engine, 'connect', _set_sqlite_pragmas)
+                #engine.echo = True
+
+                metadata.bind = engine
+                session.configure(bind=engine)
+                setup_all()
+                create_all()
+                _add_missing_columns(engine)
+                _engine = engine
+    return _engine
+
+def _database_call(func):
+    """ Make sure the engine is up, and roll the thread's session back if the call fails """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        get_engine()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            session.rollback()
+            raise
+    return wrapper
+
+def _read(statement):
+    """ Run a select and fetch the rows
+
+    Changes pending in this thread's session are not visible to other connections, so those are
+    flushed and read through the session. Otherwise a pooled connection is used and nothing is left
+    open afterwards.
+    """
+    get_engine()
+    if session.registry.has():
+        current = session()
+        if current.new or current.dirty or current.deleted:
+            current.flush()
+            return current.execute(statement).fetchall()
+
+    with get_engine().connect() as connection:
+        return connection.execute(statement).fetchall()
+
+@contextmanager
+def session_scope():
+    """ Work with the entities directly on this thread's session, committed as one transaction
+
+        with session_scope():
+            kitchen = Group(name="Kitchen")
+            Light(name="Kitchen 1", base_id=3, group=kitchen)
+    """
+    get_engine()
+    try:
+        yield session()
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+def remove_session():
+    """ Close and forget this thread's session, worker threads call this when they finish """
+    session.remove()
+
+@_database_call
 def setup_database():
     """ Initialize the database with the tables """
     setup_all()
@@ -32,15 +149,17 @@ def setup_database():
 
     session.commit()
 
+@_database_call
 def add_all_lights(lights):
     """ Add all lights to the database, defaulting to uncategorized """
     # Add all lights to uncatagorized cluster
     for light in lights:
         new_light = Light()
         new_light.name = light['name']
-        new_light.base_station_id = light['base_id']
+        new_light.base_id = light['base_id']
     session.commit()
 
+@_database_call
 def add_light_to_group(light_obj, group_name):
     """ Add a light to a group """
     group = Group.get_by(name=group_name)
@@ -53,7 +172,7 @@ def add_light_to_group(light_obj, group_name):
         else:
             new_light = Light()
             new_light.name = light_name
-            new_light.base_station_id = light_id
+            new_light.base_id = light_id
             new_light.group_id = group.id
     else:
         raise Exception("Group name not found")
@@ -64,6 +183,43 @@ def add_lights_to_group(lights, group_name):
     """ Add all lights to a group """
     _ = [add_light_to_group(light, group_name) for light in lights]
 
+@_database_call
+def register_lights(lights, group_name=UNCATEGORIZED):
+    """ Add or update many lights in a group in a single transaction
+
+    A light is known by its bridge and id, {'name': "Office 7", 'base_id': "7", 'bridge': "10.0.0.2"}.
+    Every other call looks lights up by name, so a light is not registered under a name another light
+    already has. A light stored before lights had a bridge is taken over when its name and id match.
+
+    :rtype: list
+    :returns: The lights that were not registered because their name is taken
+    """
+    group = Group.get_by(name=group_name)
+    if group is None:
+        raise Exception("Group name not found")
+
+    refused = []
+    for light_obj in lights:
+        base_id = int(light_obj['base_id'])
+        bridge  = light_obj.get('bridge')
+        light   = Light.get_by(bridge=bridge, base_id=base_id) if bridge is not None else None
+        named   = Light.get_by(name=light_obj['name'])
+        if named is not None and named is not light:
+            if light is not None or named.base_id != base_id or named.bridge not in (None, bridge):
+                refused.append(light_obj)
+                continue
+            light = named
+        if light is None:
+            light = Light()
+        light.name    = light_obj['name']
+        light.base_id = base_id
+        light.bridge  = bridge
+        light.group   = group
+
+    session.commit()
+    return refused
+
+@_database_call
 def add_group_to_group(group_to_add, group_to_contain):
     """ Add a group to a group """
     # Find the cluster by name
@@ -76,40 +232,152 @@ def add_group_to_group(group_to_add, group_to_contain):
 
     session.commit()
 
+def _group_id(group_name, groups):
+    """ Find the id of a group by name, in (id, name, parent id) rows
+
+    :raises NoResultFound: when no group has the name
+    :raises MultipleResultsFound: when more than one group has the name
+    """
+    found = [group_id for group_id, name, _ in groups if name == group_name]
+    if not found:
+        raise NoResultFound("No group named '%s'" % group_name)
+    if len(found) > 1:
+        raise MultipleResultsFound("%s groups are named '%s'" % (len(found), group_name))
+    return found[0]
+
+@_database_call
 def get_light_in_group(light_name, group_name):
-    """ Get a light in a given group """
+    """ Get a light in a given group
 
-    group = Group.query.filter_by(name=group_name).one()
-    light = Light.query.filter_by(name=light_name).one()
+    :rtype: dict
+    :returns: {name: base_id}, empty if the light is in another group
+    :raises NoResultFound: when there is no such group or light
+    :raises MultipleResultsFound: when the group or the light name is not unique
+    """
 
-    if group.id == light.group_id:
-        return {light.name:light.base_id}
+    group_id = _group_id(group_name, _read(select([Group.table.c.id, Group.table.c.name,
+                                                   Group.table.c.group_id])))
+    light    = Light.table.c
+    rows     = _read(select([light.name, light.base_id, light.group_id]).where(light.name == light_name))
+    if not rows:
+        raise NoResultFound("No light named '%s'" % light_name)
+    if len(rows) > 1:
+        raise MultipleResultsFound("%s lights are named '%s'" % (len(rows), light_name))
+
+    name, base_id, light_group_id = rows[0]
+    if group_id == light_group_id:
+        return {name:base_id}
     else:
         return {}
 
-def get_lights_in_group(group_name):
-    """ Get all lights within a group """
+def _on_bridge(light, bridge):
+    """ The where clause for the lights on a bridge, lights stored before lights had a bridge count for
+    every bridge """
+    return (light.bridge == bridge) | (light.bridge == None)
+
+@_database_call
+def get_lights_in_group(group_name, bridge=None):
+    """ Get all lights within a group and the groups inside it
+
+    :param str bridge: only the lights on this bridge, a bridge_key, every light if None
+
+    :raises NoResultFound: when there is no such group
+    :raises MultipleResultsFound: when the group name is not unique
+    """
+
+    # Two selects, the group tree is walked in memory rather than with a query per group
+    groups   = _read(select([Group.table.c.id, Group.table.c.name, Group.table.c.group_id]))
+    group_id = _group_id(group_name, groups)
 
-    group    = Group.query.filter_by(name=group_name).one()
-    group_id = group.id
-    lights   = {light.name:light.base_id for light in Light.query.filter_by(group_id=group_id)}
+    children = {}
+    for child_id, _, parent_id in groups:
+        children.setdefault(parent_id, []).append(child_id)
 
-    # For all the groups inside the given group, grab the lights
-    for i in Group.query.filter_by(group_id=group_id):
-        lights.update(get_lights_in_group(i.name))
+    wanted  = set()
+    to_walk = [group_id]
+    while to_walk:
+        current = to_walk.pop()
+        if current not in wanted:
+            wanted.add(current)
+            to_walk.extend(children.get(current, []))
 
-    return lights
+    light     = Light.table.c
+    statement = select([light.name, light.base_id, light.group_id])
+    if bridge is not None:
+        statement = statement.where(_on_bridge(light, bridge))
+    return dict((name, base_id) for name, base_id, light_group_id in _read(statement)
+                if light_group_id in wanted)
 
-def get_lights():
-    """ Get all lights in the database """
-    return {light.name:light.base_id for light in Light.query.all()}
+@_database_call
+def get_lights(bridge=None):
+    """ Get all lights in the database, {name: base_id}
 
+    :param str bridge: only the lights on this bridge, a bridge_key, every light if None
+    """
+    light     = Light.table.c
+    statement = select([light.name, light.base_id])
+    if bridge is not None:
+        statement = statement.where(_on_bridge(light, bridge))
+    return dict(_read(statement))
+
+@_database_call
 def get_groups():
     """ Get all groups in the database """
-    return [group.name for group in Group.query.all()]
+    return [name for (name,) in _read(select([Group.table.c.name]))]
+
+@_database_call
+def save_scene(scene_name, states):
+    """ Store a scene, replacing any scene with the same name """
+    scene = Scene.get_by(name=scene_name)
+    if scene is None:
+        scene = Scene(name=scene_name)
+    scene.states = json.dumps(states, separators=(',', ':'), sort_keys=True)
+    session.commit()
+
+@_database_call
+def get_scene(scene_name):
+    """ Get the light states of a scene, keyed by light id """
+    scene = Scene.get_by(name=scene_name)
+    if scene is None:
+        raise Exception("Scene name not found")
+    return json.loads(scene.states)
+
+@_database_call
+def get_scenes():
+    """ Get all scene names in the database """
+    return [scene.name for scene in Scene.query.all()]
+
+@_database_call
+def delete_scene(scene_name):
+    """ Remove a scene """
+    scene = Scene.get_by(name=scene_name)
+    if scene is None:
+        raise Exception("Scene name not found")
+    scene.delete()
+    session.commit()
+
+@_database_call
+def set_bridge_setting(bridge, name, value):
+    """ Store a setting of a bridge, replacing the one with the same name """
+    setting = BridgeSetting.get_by(bridge=bridge, name=name)
+    if setting is None:
+        setting = BridgeSetting(bridge=bridge, name=name)
+    setting.value = json.dumps(value, separators=(',', ':'), sort_keys=True)
+    session.commit()
+
+@_database_call
+def get_bridge_setting(bridge, name, default=None):
+    """ Get a setting of a bridge, default if it was never stored """
+    setting = BridgeSetting.table.c
+    rows    = _read(select([setting.value]).where((setting.bridge == bridge) & (setting.name == name)))
+    return json.loads(rows[0][0]) if rows else default
 
+@_database_call
 def purge():
-    """ Reset to zero """
+    """ Reset to zero: every light, group and scene and every learned or configured bridge setting, such
+    as the rates kept by adaptive.py, is deleted """
     _ = [light.delete() for light in Light.query.all()]
     _ = [group.delete() for group in Group.query.all()]
+    _ = [scene.delete() for scene in Scene.query.all()]
+    _ = [setting.delete() for setting in BridgeSetting.query.all()]
     session.commit()
\ No newline at end of file
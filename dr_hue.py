@@ -1,7 +1,10 @@
 """ Python Library for calling the Hue API """
 
 from constants import HTTP_DELETE, HTTP_GET, HTTP_POST, HTTP_PUT, PORTAL_URL
-from request_wrapper import json_rpc_call, request_get
+from request_wrapper import json_rpc_call, request_get, JsonRpcGetException
+import outbound
+import profiling
+from profiling import profiled
 
 #########################################################################################################
 # Lights API                                                                                            #
@@ -171,7 +174,7 @@ def rename_light(url, light_id, light_name, username):
     unreachable or off.
 
     URL /api/<username>/lights/<id>
-    Method  GET
+    Method  PUT
     Version 1.0
     Permission  Whitelist
 
@@ -191,7 +194,7 @@ def rename_light(url, light_id, light_name, username):
     keys        = {'username': username, 'id': light_id}
     params      = {'name': light_name}
 
-    return json_rpc_call(url, HTTP_GET, method_name, params, keys)
+    return json_rpc_call(url, HTTP_PUT, method_name, params, keys)
 
 def search_for_new_lights(url, username):
     """ Starts a search for new lights.
@@ -305,13 +308,57 @@ def get_all_groups(url, username):
 
     return json_rpc_call(url, HTTP_GET, method_name, params, keys)
 
-def create_group(url, username):
-    """ Create Group: To be added in the future """
-    print "create_group call not implemented in 1.0 release (%s, %s)" % (url, username)
+def create_group(url, username, params):
+    """ Creates a new group containing the lights specified and optional name. The bridge can store up
+    to 16 groups besides group 0.
+
+    URL /api/<username>/groups
+    Method  POST
+    Version 1.0
+    Permission  Whitelist
+
+    Request example:
+
+        {"name":"Living room","lights":["1","2"]}
+
+    :param str url: The url of the Hue system
+    :param str username: the username that has access to the hue system
+    :param dict params: the name and lights of the new group
+
+    :rtype: dict
+    :returns: The id of the new group. Error 301 is returned if the group table is full, error 302 if a
+              light's own group table is full.
+
+        [{"success":{"id":"/groups/1"}}]
+    """
+
+    method_name = 'groups'
+    keys        = {'username': username}
+
+    return json_rpc_call(url, HTTP_POST, method_name, params, keys)
 
 def delete_group(url, username, group_id):
-    """ Delete Group: To be added in the future """
-    print "delete_group call not implemented in 1.0 release (%s, %s, %s)" % (url, username, group_id)
+    """ Deletes the specified group from the bridge.
+
+    URL /api/<username>/groups/<id>
+    Method  DELETE
+    Version 1.0
+    Permission  Whitelist
+
+    :param str url: The url of the Hue system
+    :param str username: the username that has access to the hue system
+    :param int group_id: the id of the group you wish to delete
+
+    :rtype: dict
+    :returns:
+        [{"success":"/groups/1 deleted."}]
+    """
+
+    method_name = 'groups/<id>'
+    keys        = {'username': username, 'id': group_id}
+    params      = {}
+
+    return json_rpc_call(url, HTTP_DELETE, method_name, params, keys)
 
 def get_group_attributes(url, group_id, username):
     """ Gets the name, light membership and last command for a given group.
@@ -411,7 +458,7 @@ def set_group_state(url, group_id, username, params):
     priority is used: xy > ct > hs. All included parameters will be updated but the 'colormode' will be
     set using the priority system.
 
-    URL /api/<username>/groups/<id>
+    URL /api/<username>/groups/<id>/action
     Method  PUT
     Version 1.0
     Permission  Whitelist
@@ -484,7 +531,7 @@ def set_group_state(url, group_id, username, params):
 
     """
 
-    method_name = 'groups/<id>'
+    method_name = 'groups/<id>/action'
     keys        = {'username': username, 'id': group_id}
 
     return json_rpc_call(url, HTTP_PUT, method_name, params, keys)
@@ -572,7 +619,7 @@ def delete_schedule(url, schedule_id, username):
     keys        = {'username': username, 'id': schedule_id}
     params      = {}
 
-    return json_rpc_call(url, HTTP_GET, method_name, params, keys)
+    return json_rpc_call(url, HTTP_DELETE, method_name, params, keys)
 
 def get_all_schedules(url, username):
     """ Gets a list of all schedules that have been added to the bridge.
@@ -847,7 +894,7 @@ def get_full_state(url, username):
 
     """
 
-    base_url    = 'api/<username>'
+    base_url    = '%s/api/<username>' % url
     method_name = ""
     keys        = {'username': username}
     params      = {}
@@ -945,29 +992,139 @@ def get_username():
     
     return response[0]['success']['username']
 
-def turn_all_lights_on(url, username, sleep_interval=0):
-    """ All inclusive method that will get a user name, find all lights, turn on all lights"""
-    from time import sleep 
+# Group 0 is a special group containing every light known by the bridge
+ALL_LIGHTS_GROUP = "0"
+
+# Fields of a state change the light does not keep in its state
+_TRANSIENT_FIELDS = ('alert', 'transitiontime')
+
+def _state_matches(state, params):
+    """ Whether a light state shows the change in params, fields the state does not have are ignored """
+    if not params.get('on', True):
+        return not state.get('on')
+    return all(state[field] == value for field, value in params.items()
+               if field in state and field not in _TRANSIENT_FIELDS)
+
+@profiled("dr_hue.set_lights_state")
+def _refused_lights(error, params, light_ids):
+    """ The lights a failed group command has to be sent to one by one
+
+    Errors naming lights, /lights/<id>/..., only concern those lights. Errors naming some of the
+    attributes, /groups/<id>/action/bri, leave the others applied and name no light to resend to. Any
+    other failure, the group being gone or an overloaded bridge, is a failure of the whole command.
+    """
+    named, attributes = set(), set()
+    for entry in error.errors:
+        parts = [part for part in str(entry.get('address', '')).split('/') if part]
+        if len(parts) > 1 and parts[0] == 'lights':
+            named.add(parts[1])
+        elif parts and parts[-1] in params:
+            attributes.add(parts[-1])
+
+    if named:
+        return named & light_ids
+    if attributes and attributes != set(params):
+        return set()
+    return light_ids
+
+def set_lights_state(url, username, params, light_ids=None, verify=False):
+    """ Set the state of many lights with as few commands as possible
+
+    Every light of the bridge (light_ids of None) is set with a single command to group 0, and so is any
+    set of lights that is exactly one of the bridge's groups. Lights are only set one by one when the
+    group command could not do it: the lights its errors name, every light if it failed as a whole, and
+    with verify the ones a read afterwards still shows in another state. A verification read that fails
+    sends nothing more. Other sets of lights are set one by one.
+
+    :param str url: The url of the Hue system
+    :param str username: the username that has access to the hue system
+    :param dict params: the state change, see set_light_state
+    :param list light_ids: the lights to change, every light on the bridge if None
+    :param bool verify: read the state back after a group command
+
+    :rtype: dict
+    :returns: The group used (None if there was none) and the lights that were set one by one, with
+            verify whether the group command was read back, False if the read failed
+            {"group": "0", "fallback": ["7"], "verified": True}
+    """
+    group_id = None
+    if light_ids is None:
+        group_id = ALL_LIGHTS_GROUP
+    else:
+        light_ids = set(str(light_id) for light_id in light_ids)
+        for candidate, attrs in sorted(get_all_groups(url, username).items()):
+            if set(attrs.get('lights', [])) == light_ids:
+                group_id = candidate
+                break
+        if group_id is None and light_ids == set(get_all_lights(url, username)):
+            group_id = ALL_LIGHTS_GROUP
+
+    fallback = light_ids
+    verified = None
+    if group_id is not None:
+        try:
+            set_group_state(url, group_id, username, params)
+            fallback = set()
+        except JsonRpcGetException as exc:
+            targets  = light_ids if light_ids is not None else set(get_all_lights(url, username))
+            fallback = _refused_lights(exc, params, targets)
+
+    if verify and group_id is not None and not fallback:
+        # A bridge too busy to answer the read would only be made busier by resending to every light
+        try:
+            lights = get_full_state(url, username).get('lights', {})
+        except JsonRpcGetException:
+            verified = False
+        else:
+            verified = True
+            targets  = light_ids if light_ids is not None else set(lights)
+            fallback = set(light_id for light_id in targets
+                           if light_id in lights and not _state_matches(lights[light_id].get('state', {}),
+                                                                        params))
+
+    for light_id in sorted(fallback):
+        set_light_state(url, light_id, username, params)
+
+    sent = {'group': group_id, 'fallback': sorted(fallback)}
+    if verified is not None:
+        sent['verified'] = verified
+    return sent
+
+@profiled("dr_hue.turn_all_lights_on")
+def turn_all_lights_on(url, username, sleep_interval=0, verify=False):
+    """ All inclusive method that will turn on all lights, with a single group command unless a
+    sleep_interval asks for them to be turned on one by one """
+    if not sleep_interval:
+        print "Turning all lights on with a single group command"
+        return set_lights_state(url, username, {"on": True}, verify=verify)
 
     lights = {}
     lights.update(get_all_lights(url, username))
 
     print "Turning %s lights on one by one with interval of '%s' seconds" % (len(lights), sleep_interval)
-    for light in lights.keys():
-        turn_light_on(url, light, username)
-        sleep(sleep_interval)
-
-def turn_all_lights_off(url, username, sleep_interval=0):
-    """ All inclusive method that will get a user name, find all lights, turn off all lights"""
-    from time import sleep 
+    # Sweeping every light should not hold up commands from anyone else
+    with outbound.priority(outbound.BACKGROUND):
+        for light in lights.keys():
+            turn_light_on(url, light, username)
+            profiling.sleep(sleep_interval)
+
+@profiled("dr_hue.turn_all_lights_off")
+def turn_all_lights_off(url, username, sleep_interval=0, verify=False):
+    """ All inclusive method that will turn off all lights, with a single group command unless a
+    sleep_interval asks for them to be turned off one by one """
+    if not sleep_interval:
+        print "Turning all lights off with a single group command"
+        return set_lights_state(url, username, {"on": False}, verify=verify)
 
     lights = {}
     lights.update(get_all_lights(url, username))
 
     print "Turning %s lights off one by one with interval of '%s' seconds" % (len(lights), sleep_interval)
-    for light in lights.keys():
-        turn_light_off(url, light, username)
-        sleep(sleep_interval)
+    # Sweeping every light should not hold up commands from anyone else
+    with outbound.priority(outbound.BACKGROUND):
+        for light in lights.keys():
+            turn_light_off(url, light, username)
+            profiling.sleep(sleep_interval)
 
 def turn_light_off(url, light_id, username):
     """ Turn the light off
@@ -1029,4 +1186,9 @@ def set_light_hue(url, light_id, username, hue):
     """
 
     params = { "hue": hue }
-    return set_light_state(url, light_id, username, params)
\ No newline at end of file
+    return set_light_state(url, light_id, username, params)
+
+if __name__ == "__main__":
+    import sys
+    from cli import main
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,183 @@
+""" An in memory stand-in for a bridge, for load tests and replays
+
+FakeBridge answers the /api/<username>/... calls the library makes with the bridge's own response
+formats, from a state dictionary in memory. Any username is accepted. An optional latency is added to
+every request to stand in for a remote link, and the requests served are counted per method.
+
+Sample Usage:
+
+    from fakebridge import FakeBridge
+
+    fake = FakeBridge(lights=50, latency=0.05).start()
+    dr_hue.turn_all_lights_on(fake.url, "anyone")
+    print fake.requests
+    fake.stop()
+"""
+
+import copy
+import json
+import socket
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer   import ThreadingMixIn
+
+from constants import sanitize_error_messages
+
+def make_state(lights):
+    """ A full state with `lights` lights, all off """
+    return {
+        'lights': dict((str(index), {'name': "Hue Lamp %s" % index, 'type': "Extended color light",
+                                     'modelid': "LCT001", 'swversion': "66009461",
+                                     'state': {'on': False, 'bri': 0, 'hue': 0, 'sat': 0, 'ct': 153,
+                                               'xy': [0.0, 0.0], 'alert': "none", 'effect': "none",
+                                               'colormode': "hs", 'reachable': True}})
+                       for index in range(1, lights + 1)),
+        'groups': {},
+        'schedules': {},
+        'config': {'name': "Fake bridge", 'swversion': "01005215", 'whitelist': {}, 'linkbutton': False}
+    }
+
+def _error(error_type, address, **keys):
+    return [{'error': {'type': error_type, 'address': address,
+                       'description': sanitize_error_messages({'error': {'type': error_type}}, keys)}}]
+
+class _Handler(BaseHTTPRequestHandler):
+    """ Serves one request against server.bridge """
+
+    protocol_version        = "HTTP/1.1"
+    # Send each reply in one piece, split writes stall on delayed acks
+    wbufsize                = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, body):
+        payload = json.dumps(body, separators=(',', ':'))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _handle(self):
+        bridge = self.server.bridge
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body   = self.rfile.read(length) if length else ""
+        if bridge.latency:
+            time.sleep(bridge.latency)
+
+        parts = [part for part in self.path.split('?')[0].split('/') if part]
+        if len(parts) < 2 or parts[0] != 'api':
+            return self._reply(_error(4, self.path, method_name=self.command, resource=self.path))
+        try:
+            body = json.loads(body) if body else {}
+        except ValueError:
+            return self._reply(_error(2, self.path))
+        self._reply(bridge.handle(self.command, parts[2:], body))
+
+    do_GET    = _handle
+    do_PUT    = _handle
+    do_POST   = _handle
+    do_DELETE = _handle
+
+class _Server(ThreadingMixIn, HTTPServer):
+    allow_reuse_address = True
+    request_queue_size  = 128
+
+    def process_request(self, request, client_address):
+        """ Serve each connection in a thread of its own, both kept so stop can close them """
+        thread        = threading.Thread(target=self.process_request_thread, args=(request, client_address))
+        thread.daemon = True
+        self.connections[request] = thread
+        thread.start()
+
+    def shutdown_request(self, request):
+        self.connections.pop(request, None)
+        HTTPServer.shutdown_request(self, request)
+
+class FakeBridge(object):
+    """ A bridge served from memory on a local port """
+
+    def __init__(self, lights=10, state=None, latency=0.0, host="127.0.0.1", port=0):
+        self.state    = copy.deepcopy(state) if state is not None else make_state(lights)
+        self.latency  = latency
+        self.requests = {}
+        self._lock    = threading.Lock()
+        self._server  = _Server((host, port), _Handler)
+        self._server.bridge      = self
+        self._server.connections = {}
+        self._thread  = None
+
+    @property
+    def url(self):
+        """ The url to hand to dr_hue """
+        return "http://%s:%s" % self._server.server_address
+
+    def start(self):
+        """ Serve in a background thread, returns self """
+        self._thread        = threading.Thread(target=self._server.serve_forever, name="dr_hue fake bridge")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stop serving and free the port, kept alive connections are closed as well """
+        self._server.shutdown()
+        self._server.server_close()
+        for connection, thread in self._server.connections.items():
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join(1)
+
+    def handle(self, method, parts, body):
+        """ The response to a call on /api/<username>/<parts> """
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            path = "/" + "/".join(parts)
+
+            # Group 0 is not listed but every light is in it
+            if method == "PUT" and parts == ['groups', '0', 'action'] and isinstance(body, dict):
+                for light in self.state['lights'].values():
+                    light['state'].update(body)
+                return [{'success': {"%s/%s" % (path, key): value}} for key, value in body.items()]
+
+            if not parts and method != "GET":
+                return _error(4, path, method_name=method, resource=path)
+
+            parent, node = None, self.state
+            for part in parts:
+                if not isinstance(node, dict) or part not in node:
+                    return _error(3, path, resource=path)
+                parent, node = node, node[part]
+
+            if method == "GET":
+                return copy.deepcopy(node)
+
+            if method == "DELETE":
+                del parent[parts[-1]]
+                return [{'success': "%s deleted." % path}]
+
+            if method == "POST":
+                if parts == ['lights']:
+                    return [{'success': {'/lights': "Searching for new devices"}}]
+                new_id       = str(max([int(key) for key in node if key.isdigit()] + [0]) + 1)
+                node[new_id] = body
+                return [{'success': {'id': new_id if parts == ['schedules'] else "%s/%s" % (path, new_id)}}]
+
+            # PUT
+            if not isinstance(node, dict) or not isinstance(body, dict):
+                return _error(7, path, value=json.dumps(body), parameter=path)
+            response = []
+            for key, value in body.items():
+                node[key] = value
+                response.append({'success': {"%s/%s" % (path, key): value}})
+
+            # A group action changes every light of the group
+            if len(parts) == 3 and parts[0] == 'groups' and parts[2] == 'action':
+                for light_id in self.state['groups'][parts[1]].get('lights', []):
+                    self.state['lights'].get(light_id, {}).get('state', {}).update(body)
+            return response
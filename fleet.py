@@ -0,0 +1,212 @@
+""" Configuration and whitelist maintenance across many bridges
+
+Cleaning a whitelist by hand means a get_configuration and then a delete_user_from_whitelist per user,
+bridge after bridge. plan_maintenance reads the configuration of every bridge at the same time and
+works out per bridge which configuration values differ from the wanted ones and which whitelisted
+users are stale. apply_maintenance then makes those changes on all bridges at once, the deletes of each
+bridge going through its outbound queue and rate limiter. maintain does both, or only the planning for
+a dry run, and format_report turns the outcome into a readable report.
+
+Sample Usage:
+
+    import fleet
+
+    bridges = [(url_1, username_1), (url_2, username_2)]
+    results = fleet.maintain(bridges, config={'proxyport': 0}, stale_after=90, dry_run=True)
+    print fleet.format_report(results)
+"""
+
+# strptime imports _strptime on first use, which can fail when the first uses are on several threads
+import _strptime
+from collections import OrderedDict
+from datetime    import datetime, timedelta
+from fnmatch     import fnmatch
+
+import dr_hue
+from outbound  import map_outbound
+from ratelimit import map_rate_limited
+
+FLEET_WORKERS = 16
+DATE_FORMAT   = "%Y-%m-%dT%H:%M:%S"
+NEVER_USED    = "none"
+
+class FleetException(Exception):
+    """ Exception raised when maintenance failed on some of the bridges """
+    def __init__(self, msg, errors=None, results=None, **kwargs):
+        super(FleetException, self).__init__(msg, **kwargs)
+        self.errors  = errors or {}
+        self.results = results or {}
+
+class BridgeMaintenance(object):
+    """ What is to change, and what changed, on one bridge
+
+    changes  dict  configuration values to set, {"proxyport": 0}
+    remove   dict  whitelisted users to delete, {"1234567890": "iPhone Web 1"}
+    applied  bool  whether the changes were made
+    failed   dict  what could not be changed, keyed by user id or "config", with the exception
+    error    obj   the exception that stopped the bridge from being read or changed at all
+    """
+    __slots__ = ('url', 'username', 'changes', 'remove', 'applied', 'failed', 'error')
+
+    def __init__(self, url, username):
+        self.url      = url
+        self.username = username
+        self.changes  = {}
+        self.remove   = {}
+        self.applied  = False
+        self.failed   = {}
+        self.error    = None
+
+def _parse_date(value):
+    """ A whitelist date, None for a user that was never used """
+    if not value or value == NEVER_USED:
+        return None
+    return datetime.strptime(value[:19], DATE_FORMAT)
+
+def stale_users(config, username, stale_after=None, names=(), keep=(), now=None):
+    """ The whitelisted users of a configuration that can go
+
+    A user is stale when it was last used more than stale_after days ago, or never and created that
+    long ago, or when its name matches one of the names patterns. The username doing the maintenance
+    and the users in keep are never stale.
+
+    :param dict config: a get_configuration response
+    :param str username: the user the maintenance runs as
+    :param int stale_after: days without use, None to not look at use
+    :param list names: fnmatch patterns of device names to remove, e.g. ["iPhone Web *"]
+    :param list keep: user ids to keep whatever they look like
+    :param datetime now: the bridge's time in UTC, config['utc'] or the local clock if None
+
+    :rtype: dict
+    :returns: {"1234567890": "iPhone Web 1"}
+    """
+    now     = now or _parse_date(config.get('utc')) or datetime.utcnow()
+    cutoff  = now - timedelta(days=stale_after) if stale_after is not None else None
+    skipped = set(keep) | set([username])
+    stale   = {}
+    for user_id, attrs in config.get('whitelist', {}).items():
+        if user_id in skipped:
+            continue
+        name = attrs.get('name', '')
+        if any(fnmatch(name, pattern) for pattern in names):
+            stale[user_id] = name
+            continue
+        if cutoff is not None:
+            used = _parse_date(attrs.get('last use date')) or _parse_date(attrs.get('create date'))
+            if used is not None and used < cutoff:
+                stale[user_id] = name
+    return stale
+
+def config_changes(config, wanted):
+    """ The values of wanted that differ from the configuration, what modify_configuration needs """
+    return dict((key, value) for key, value in wanted.items() if config.get(key) != value)
+
+def _plan(url, username, wanted, selection):
+    """ Read one bridge's configuration and work out its changes """
+    result         = BridgeMaintenance(url, username)
+    config         = dr_hue.get_configuration(url, username)
+    result.changes = config_changes(config, wanted) if wanted else {}
+    result.remove  = stale_users(config, username, **selection)
+    return result
+
+def plan_maintenance(bridges, config=None, stale_after=None, names=(), keep=(), workers=FLEET_WORKERS):
+    """ Read every bridge's configuration at once and work out what to change
+
+    :param list bridges: (url, username) pairs
+    :param dict config: the configuration values every bridge should have, see modify_configuration
+    :param int stale_after: remove users not used for this many days, see stale_users
+    :param list names: remove users whose device name matches one of these patterns
+    :param list keep: user ids to never remove
+    :param int workers: bridges read at the same time
+
+    :rtype: OrderedDict
+    :returns: A BridgeMaintenance per bridge url, with error set for the bridges that could not be read
+    """
+    selection = {'stale_after': stale_after, 'names': names, 'keep': keep}
+    outcomes  = map_rate_limited(_plan, [(url, username, config, selection) for url, username in bridges],
+                                 workers=workers)
+    results   = OrderedDict()
+    for (url, username), (result, error) in zip(bridges, outcomes):
+        if result is None:
+            result       = BridgeMaintenance(url, username)
+            result.error = error
+        results[url] = result
+    return results
+
+def _apply(result):
+    """ Make the changes planned for one bridge, the whitelist deletes in parallel """
+    if result.changes:
+        try:
+            dr_hue.modify_configuration(result.url, result.username, result.changes)
+        except Exception as exc:
+            result.failed['config'] = exc
+
+    user_ids = sorted(result.remove)
+    if user_ids:
+        outcomes = map_outbound(result.url, dr_hue.delete_user_from_whitelist,
+                                [(result.url, result.username, user_id) for user_id in user_ids])
+        for user_id, (_, error) in zip(user_ids, outcomes):
+            if error is not None:
+                result.failed[user_id] = error
+    result.applied = True
+    return result
+
+def apply_maintenance(results, workers=FLEET_WORKERS):
+    """ Make the planned changes on every bridge at once, bridges that could not be read are left alone
+
+    :rtype: OrderedDict
+    :returns: results, with applied and failed filled in
+    """
+    pending  = [result for result in results.values()
+                if result.error is None and (result.changes or result.remove)]
+    outcomes = map_rate_limited(_apply, [(result,) for result in pending], workers=workers)
+    for result, (_, error) in zip(pending, outcomes):
+        if error is not None:
+            result.error = error
+    return results
+
+def maintain(bridges, config=None, stale_after=None, names=(), keep=(), dry_run=False,
+             workers=FLEET_WORKERS):
+    """ Plan and apply configuration and whitelist maintenance on many bridges, see plan_maintenance
+
+    :param bool dry_run: only plan, nothing is changed
+
+    :rtype: OrderedDict
+    :returns: A BridgeMaintenance per bridge url
+    :raises FleetException: if any bridge could not be read or changed, after all others were done
+    """
+    results = plan_maintenance(bridges, config=config, stale_after=stale_after, names=names, keep=keep,
+                               workers=workers)
+    if not dry_run:
+        apply_maintenance(results, workers=workers)
+
+    errors = dict((url, result.error or result.failed) for url, result in results.items()
+                  if result.error is not None or result.failed)
+    if errors:
+        raise FleetException("Maintenance failed on %s of %s bridges" % (len(errors), len(results)),
+                             errors=errors, results=results)
+    return results
+
+def format_report(results):
+    """ A readable summary of maintenance results, planned or applied """
+    lines = []
+    for url, result in results.items():
+        if result.error is not None:
+            lines.append("%s: failed, %s" % (url, result.error))
+            continue
+        if not result.changes and not result.remove:
+            lines.append("%s: up to date" % url)
+            continue
+        lines.append("%s: %s" % (url, "changed" if result.applied else "would change"))
+        for key, value in sorted(result.changes.items()):
+            lines.append("    config %s = %r%s" % (key, value, _failure(result, 'config')))
+        for user_id, name in sorted(result.remove.items()):
+            lines.append("    remove %s (%s)%s" % (user_id, name, _failure(result, user_id)))
+
+    changes = sum(len(result.changes) + len(result.remove) for result in results.values())
+    failed  = len([result for result in results.values() if result.error is not None])
+    lines.append("%s changes on %s bridges, %s could not be read" % (changes, len(results), failed))
+    return "\n".join(lines)
+
+def _failure(result, key):
+    return ", failed: %s" % result.failed[key] if key in result.failed else ""
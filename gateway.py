@@ -0,0 +1,320 @@
+""" Local gateway that puts many clients in front of a single bridge
+
+The gateway answers the same /api/<username>/... urls as the bridge. Reads are served from a
+StateMirror and never reach the bridge. Writes go through one CoalescingClient, which merges a PUT
+into the PUT to the same path queued right before it, and hands them in order to the bridge's rate
+limited outbound queue as interactive commands. Clients with a whitelisted username that connect to
+/api/<username>/ws with a WebSocket get every change pushed to them as json.
+
+Sample Usage:
+
+    python dr_hue.py --url http://192.168.1.37 --username 1234567890 gateway --port 8000
+
+    # then point every service at http://127.0.0.1:8000 instead of the bridge
+"""
+
+import base64
+import hashlib
+import json
+import socket
+import struct
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections    import deque
+from Queue          import Queue, Empty
+from SocketServer   import ThreadingMixIn
+
+from constants       import HTTP_DELETE, HTTP_GET, HTTP_POST, HTTP_PUT
+from constants       import sanitize_error_messages
+from mirror          import StateMirror, MirrorPathException, DEFAULT_POLL_INTERVAL
+from outbound        import INTERACTIVE, get_outbound_queue
+from request_wrapper import json_rpc_call, JsonRpcGetException
+
+WEBSOCKET_PATH = "ws"       # under /api/<username>/, so subscribers pass the whitelist like any client
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+PING_INTERVAL  = 30
+
+#########################################################################################################
+# Outbound                                                                                              #
+#########################################################################################################
+
+class _PendingWrite(object):
+    """ A write waiting to go out, shared by every caller it was coalesced with """
+    __slots__ = ('method', 'path', 'body', 'done', 'result', 'error')
+
+    def __init__(self, method, path, body):
+        self.method = method
+        self.path   = path
+        self.body   = body
+        self.done   = threading.Event()
+        self.result = None
+        self.error  = None
+
+    def wait(self):
+        """ Block until sent, returns the bridge response or raises its error """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class CoalescingClient(object):
+    """ Sends writes to one bridge from a single thread, as interactive commands on its outbound queue
+
+    While a PUT is the last write waiting, later PUTs to the same path are merged into its body, so a
+    slider dragged across its range ends up as a single command. A PUT is never merged past another
+    write, that would change the order the bridge sees them in.
+    """
+
+    def __init__(self, url, username, mirror=None):
+        self.url       = url
+        self.username  = username
+        self.mirror    = mirror
+        self.outbound  = get_outbound_queue(url, retain=True)
+        self.coalesced = 0
+        self._queue    = deque()
+        self._cond     = threading.Condition()
+        self._worker   = threading.Thread(target=self._run, name="dr_hue gateway %s" % url)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def submit(self, method, path, body):
+        """ Queue a write, returns a _PendingWrite to wait on """
+        with self._cond:
+            tail = self._queue[-1] if self._queue else None
+            if (method == HTTP_PUT and isinstance(body, dict) and tail is not None and
+                    tail.method == HTTP_PUT and tail.path == path and isinstance(tail.body, dict)):
+                tail.body.update(body)
+                self.coalesced += 1
+                return tail
+
+            pending = _PendingWrite(method, path, dict(body) if isinstance(body, dict) else body)
+            self._queue.append(pending)
+            self._cond.notify()
+            return pending
+
+    def call(self, method, path, body):
+        """ Queue a write and wait for the bridge response """
+        return self.submit(method, path, body).wait()
+
+    def _run(self):
+        """ Drain the queue forever """
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                pending = self._queue.popleft()
+
+            try:
+                args           = (self.url, pending.method, pending.path, pending.body,
+                                  {'username': self.username})
+                pending.result = self.outbound.call(json_rpc_call, args, priority=INTERACTIVE)
+            except Exception as exc:
+                pending.error = exc
+
+            # Update the mirror before waking the callers, so a read right after a write sees it
+            if self.mirror is not None and pending.error is None:
+                if pending.method == HTTP_POST:
+                    # A create only returns the new id, the whole resource needs a reload of the full
+                    # state, which must not hold up the writes queued behind it
+                    refresh = threading.Thread(target=self._refresh, args=(pending,),
+                                               name="dr_hue gateway refresh %s" % self.url)
+                    refresh.daemon = True
+                    refresh.start()
+                    continue
+                try:
+                    self.mirror.apply(pending.result)
+                except Exception:
+                    pass
+
+            pending.done.set()
+
+    def _refresh(self, pending):
+        """ Reload the mirror after a create, then wake its callers """
+        try:
+            self.mirror.refresh()
+        except Exception:
+            pass
+        pending.done.set()
+
+#########################################################################################################
+# WebSocket                                                                                             #
+#########################################################################################################
+
+def _websocket_frame(payload, opcode=0x1):
+    """ A single unmasked server to client frame """
+    header = chr(0x80 | opcode)
+    length = len(payload)
+    if length < 126:
+        header += chr(length)
+    elif length < 65536:
+        header += chr(126) + struct.pack("!H", length)
+    else:
+        header += chr(127) + struct.pack("!Q", length)
+    return header + payload
+
+def _websocket_accept(key):
+    """ The Sec-WebSocket-Accept value for a client key """
+    return base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest())
+
+#########################################################################################################
+# HTTP                                                                                                  #
+#########################################################################################################
+
+def _error(error_type, address, **keys):
+    """ A response body in the bridge's own error format """
+    description = sanitize_error_messages({'error': {'type': error_type}}, keys)
+    return [{'error': {'type': error_type, 'address': address, 'description': description}}]
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    """ Serves one client request against server.mirror and server.client """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        """ Stay quiet, the gateway sits in the hot path """
+        pass
+
+    def handle(self):
+        """ Serve the connection, a client that went away mid reply is not an error """
+        try:
+            BaseHTTPRequestHandler.handle(self)
+        except socket.error:
+            self.close_connection = 1
+
+    def finish(self):
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            self.rfile.close()
+
+    def _reply(self, body, status=200):
+        """ Send a json reply, body may be an already serialized string """
+        payload = body if isinstance(body, basestring) else json.dumps(body, separators=(',', ':'))
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _route(self):
+        """ Split /api/<username>/<path> and check the username against the bridge whitelist
+
+        :returns: (username, path) or None if a reply was already sent
+        """
+        parts = [part for part in self.path.split('?')[0].split('/') if part]
+        if len(parts) < 2 or parts[0] != 'api':
+            self._reply(_error(4, self.path, method_name=self.command, resource=self.path))
+            return None
+
+        username = parts[1]
+        try:
+            whitelist = self.server.mirror.get('config/whitelist')
+        except MirrorPathException:
+            whitelist = {}
+        if username not in whitelist and username != self.server.client.username:
+            self._reply(_error(1, "/"))
+            return None
+
+        return username, "/".join(parts[2:])
+
+    def _body(self):
+        """ The json request body, {} if there is none """
+        length = int(self.headers.getheader('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def do_GET(self):
+        route = self._route()
+        if route is None:
+            return
+        if route[1] == WEBSOCKET_PATH and (self.headers.getheader('Upgrade') or '').lower() == 'websocket':
+            return self._websocket()
+        try:
+            self._reply(self.server.mirror.get_json(route[1]))
+        except MirrorPathException as exc:
+            self._reply(_error(3, exc.path, resource=exc.path))
+
+    def _write(self, method):
+        route = self._route()
+        if route is None:
+            return
+        try:
+            body = self._body()
+        except ValueError:
+            return self._reply(_error(2, "/" + route[1]))
+
+        try:
+            self._reply(self.server.client.call(method, route[1], body))
+        except JsonRpcGetException as exc:
+            self._reply(exc.rsp.content if exc.rsp is not None else _error(901, "/" + route[1],
+                                                                          **{'error code': 'upstream'}))
+        except Exception as exc:
+            self._reply(_error(901, "/" + route[1], **{'error code': exc.__class__.__name__}))
+
+    def do_PUT(self):
+        self._write(HTTP_PUT)
+
+    def do_POST(self):
+        self._write(HTTP_POST)
+
+    def do_DELETE(self):
+        self._write(HTTP_DELETE)
+
+    def _websocket(self):
+        """ Upgrade the connection and push change events until the client goes away """
+        key = self.headers.getheader('Sec-WebSocket-Key')
+        if not key:
+            self.send_error(400)
+            return
+
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", _websocket_accept(key))
+        self.end_headers()
+        self.wfile.flush()
+
+        events    = Queue()
+        subscribe = events.put
+        self.server.mirror.subscribe(subscribe)
+        try:
+            while True:
+                try:
+                    frame = _websocket_frame(json.dumps(events.get(timeout=PING_INTERVAL)))
+                except Empty:
+                    frame = _websocket_frame("", opcode=0x9)
+                self.wfile.write(frame)
+                self.wfile.flush()
+        except (socket.error, IOError):
+            pass
+        finally:
+            self.server.mirror.unsubscribe(subscribe)
+            self.close_connection = 1
+
+class GatewayServer(ThreadingMixIn, HTTPServer):
+    """ Threaded HTTP server holding the mirror and the outbound client of one bridge """
+    daemon_threads      = True
+    allow_reuse_address = True
+
+    def __init__(self, address, mirror, client):
+        HTTPServer.__init__(self, address, GatewayHandler)
+        self.mirror = mirror
+        self.client = client
+
+def make_gateway(url, username, host="127.0.0.1", port=8000, poll_interval=DEFAULT_POLL_INTERVAL):
+    """ Build a gateway for a bridge, the mirror is loaded and polling but nothing is served yet
+
+    :rtype: GatewayServer
+    """
+    mirror = StateMirror(url, username, poll_interval=poll_interval)
+    mirror.start()
+    client = CoalescingClient(url, username, mirror=mirror)
+    return GatewayServer((host, port), mirror, client)
+
+def run_gateway(url, username, host="127.0.0.1", port=8000, poll_interval=DEFAULT_POLL_INTERVAL):
+    """ Serve a gateway for a bridge until interrupted """
+    server = make_gateway(url, username, host=host, port=port, poll_interval=poll_interval)
+    try:
+        server.serve_forever()
+    finally:
+        server.mirror.stop()
+        server.server_close()
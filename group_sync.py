@@ -0,0 +1,265 @@
+""" Bridge groups backing the local datastore groups
+
+Local groups only exist in the datastore, so commanding one used to take a set_light_state per light.
+sync_groups flattens every local group to its lights and keeps a matching group on the bridge, so the
+whole group can be set with a single set_group_state. Bridge groups made this way are named with
+MANAGED_PREFIX; groups created by anyone else are never touched.
+
+The bridge only holds MAX_GROUPS groups and each light only belongs to a limited number of them. When
+there is not enough room the largest local groups get a bridge group first, the rest are reported as
+skipped and keep working light by light.
+
+Local names too long for the bridge are cut short and end in a hash of the full name, so two long names
+starting alike still get a bridge group each. The ids of the bridge groups the last sync_groups left
+matching their local group are kept, set_local_group_state uses them without reading the groups again.
+A skipped group has none, its bridge group may hold other lights, and is set light by light.
+
+Sample Usage:
+
+    import group_sync
+
+    group_sync.sync_groups(url, username)
+    group_sync.set_local_group_state(url, username, "Kitchen", {"on": True})
+"""
+
+import threading
+import zlib
+
+import dr_hue
+from constants       import HUE_ERRORS
+from outbound        import map_outbound
+from ratelimit       import bridge_key
+from request_wrapper import JsonRpcGetException
+
+MAX_GROUPS      = 16
+MAX_NAME_LENGTH = 32
+MANAGED_PREFIX  = "drh "
+
+# Hue errors for a missing group, and for a full group table on the bridge and on a light
+NOT_AVAILABLE    = 3
+GROUP_TABLE_FULL = 301
+LIGHT_TABLE_FULL = 302
+
+NAME_CLASH = "Bridge group name %r is taken by local group %r"
+
+_group_ids      = {}    # bridge -> {local group name: group id}, from the last sync or read
+_group_ids_lock = threading.Lock()
+
+class GroupSyncException(Exception):
+    """ Exception raised when bridge groups could not be read or changed """
+    def __init__(self, msg, errors=None, **kwargs):
+        super(GroupSyncException, self).__init__(msg, **kwargs)
+        self.errors = errors or {}
+
+def bridge_group_name(group_name):
+    """ The name a local group gets on the bridge, "drh Kitchen", or "drh Upstairs front bedr~3f09c2"
+    when the name does not fit """
+    name = MANAGED_PREFIX + group_name
+    if len(name) <= MAX_NAME_LENGTH:
+        return name
+    encoded = group_name.encode('utf-8') if isinstance(group_name, unicode) else group_name
+    suffix  = "~%06x" % (zlib.crc32(encoded) & 0xffffff)
+    return name[:MAX_NAME_LENGTH - len(suffix)] + suffix
+
+def local_groups(min_lights=2, url=None):
+    """ Every local group flattened to the bridge ids of its lights
+
+    Groups with fewer than min_lights lights are left out, a group command saves nothing for them.
+
+    :param str url: only the lights on the bridge at url, every light if None
+
+    :rtype: dict
+    :returns: {"Kitchen": ["3", "4"], ...}
+    """
+    # The datastore pulls in elixir and sqlalchemy, only import it when groups are actually synced
+    import datastore
+
+    bridge    = bridge_key(url) if url is not None else None
+    flattened = {}
+    for group_name in datastore.get_groups():
+        if group_name == datastore.UNCATEGORIZED:
+            continue
+        lights    = datastore.get_lights_in_group(group_name, bridge)
+        light_ids = sorted(set(str(base_id) for base_id in lights.values() if base_id is not None))
+        if len(light_ids) >= min_lights:
+            flattened[group_name] = light_ids
+    return flattened
+
+def _bridge_groups(url, username):
+    """ The managed bridge groups with their lights, and the number of groups the bridge holds
+
+    :returns: ({"drh Kitchen": ("1", ["3", "4"])}, 5)
+    """
+    groups  = dr_hue.get_all_groups(url, username)
+    managed = sorted(group_id for group_id, attrs in groups.items()
+                     if attrs.get('name', '').startswith(MANAGED_PREFIX))
+
+    outcomes = map_outbound(url, dr_hue.get_group_attributes,
+                            [(url, group_id, username) for group_id in managed])
+    errors   = dict((group_id, error) for group_id, (_, error) in zip(managed, outcomes) if error is not None)
+    if errors:
+        raise GroupSyncException("Reading %s bridge groups failed" % len(errors), errors=errors)
+
+    attributes = dict((attrs['name'], (group_id, sorted(attrs.get('lights', []))))
+                      for group_id, (attrs, _) in zip(managed, outcomes))
+    return attributes, len(groups)
+
+def _created_id(response):
+    """ '1' from [{"success":{"id":"/groups/1"}}] """
+    return str(response[0]['success']['id']).split('/')[-1]
+
+def sync_groups(url, username, groups=None, dry_run=False):
+    """ Create, update and delete managed bridge groups until they match the local groups
+
+    Deletes go first to free up room. Creates go largest group first, and stop once the bridge reports
+    its group table is full (error 301). A group refused because one of its lights belongs to too many
+    groups already (error 302) is skipped.
+
+    :param str url: The url of the Hue system
+    :param str username: the username that has access to the hue system
+    :param dict groups: light ids keyed by local group name, local_groups(url=url) if None
+    :param bool dry_run: only work out what would change
+
+    :rtype: dict
+    :returns:
+        {
+            "created": {"Kitchen": "5"},
+            "updated": ["Upstairs"],
+            "deleted": ["Garage"],
+            "unchanged": ["Bedroom"],
+            "skipped": {"Garden": "Group could not be created. Group table is full."}
+        }
+
+    A local group whose bridge name is already taken by another one, which takes the two names hashing
+    alike, is skipped.
+    """
+    groups          = local_groups(url=url) if groups is None else groups
+    managed, in_use = _bridge_groups(url, username)
+    report          = {'created': {}, 'updated': [], 'deleted': [], 'unchanged': [], 'skipped': {}}
+
+    wanted = {}
+    for name, light_ids in sorted(groups.items()):
+        bridge_name = bridge_group_name(name)
+        if bridge_name in wanted:
+            report['skipped'][name] = NAME_CLASH % (bridge_name, wanted[bridge_name][0])
+        else:
+            wanted[bridge_name] = (name, light_ids)
+
+    for bridge_name, (group_id, _) in sorted(managed.items()):
+        if bridge_name not in wanted:
+            if not dry_run:
+                dr_hue.delete_group(url, username, group_id)
+            report['deleted'].append(bridge_name[len(MANAGED_PREFIX):])
+            in_use -= 1
+
+    to_create = []
+    for bridge_name, (name, light_ids) in sorted(wanted.items()):
+        if bridge_name not in managed:
+            to_create.append((name, light_ids))
+        elif managed[bridge_name][1] == light_ids:
+            report['unchanged'].append(name)
+        else:
+            try:
+                if not dry_run:
+                    dr_hue.set_group_attributes(url, managed[bridge_name][0], username, {'lights': light_ids})
+                report['updated'].append(name)
+            except JsonRpcGetException as exc:
+                if LIGHT_TABLE_FULL not in exc.error_types:
+                    raise
+                report['skipped'][name] = str(exc)
+
+    # The groups saving the most commands get the free slots
+    to_create.sort(key=lambda group: (-len(group[1]), group[0]))
+    for index, (name, light_ids) in enumerate(to_create):
+        if in_use >= MAX_GROUPS:
+            for skipped, _ in to_create[index:]:
+                report['skipped'][skipped] = HUE_ERRORS[GROUP_TABLE_FULL]
+            break
+
+        if dry_run:
+            report['created'][name] = None
+            in_use += 1
+            continue
+
+        try:
+            params   = {'name': bridge_group_name(name), 'lights': light_ids}
+            response = dr_hue.create_group(url, username, params)
+            report['created'][name] = _created_id(response)
+            in_use += 1
+        except JsonRpcGetException as exc:
+            if GROUP_TABLE_FULL in exc.error_types:
+                # The bridge counts differently than we do, nothing more will fit
+                for skipped, _ in to_create[index:]:
+                    report['skipped'][skipped] = HUE_ERRORS[GROUP_TABLE_FULL]
+                break
+            if LIGHT_TABLE_FULL not in exc.error_types:
+                raise
+            report['skipped'][name] = str(exc)
+
+    if not dry_run:
+        # Skipped groups keep whatever their bridge group held, or share it with another local group
+        group_ids = dict((name, managed[bridge_group_name(name)][0])
+                         for name in report['unchanged'] + report['updated'])
+        group_ids.update(report['created'])
+        with _group_ids_lock:
+            _group_ids[bridge_key(url)] = group_ids
+    return report
+
+def managed_group_ids(url, username, refresh=False):
+    """ The ids of the managed bridge groups holding exactly the lights of their local group, keyed by
+    local group name
+
+    Kept from the last sync_groups, or read from the bridge once if there was none or refresh is given.
+    """
+    key = bridge_key(url)
+    with _group_ids_lock:
+        group_ids = _group_ids.get(key)
+    if group_ids is None or refresh:
+        managed, _ = _bridge_groups(url, username)
+        group_ids  = {}
+        for name, light_ids in local_groups(url=url).items():
+            group_id, group_lights = managed.get(bridge_group_name(name), (None, None))
+            if group_lights == light_ids:
+                group_ids[name] = group_id
+        with _group_ids_lock:
+            _group_ids[key] = group_ids
+    return group_ids
+
+def forget_group_ids(url=None):
+    """ Drop the kept group ids of the bridge at url, of every bridge if None """
+    with _group_ids_lock:
+        if url is None:
+            _group_ids.clear()
+        else:
+            _group_ids.pop(bridge_key(url), None)
+
+def set_local_group_state(url, username, group_name, params):
+    """ Set the state of every light in a local group
+
+    A single set_group_state when the group has a managed bridge group holding its lights, otherwise the
+    lights on this bridge are set through dr_hue.set_lights_state. The bridge group is looked up in
+    managed_group_ids, a group that turns out to be gone makes them be read again next time.
+
+    :param str url: The url of the Hue system
+    :param str username: the username that has access to the hue system
+    :param str group_name: the name of the group in the datastore
+    :param dict params: the state change, see set_light_state
+
+    :rtype: dict
+    :returns: The group used (None if there was none) and the lights that were set one by one
+            {"group": "5", "fallback": []}
+    """
+    group_id = managed_group_ids(url, username).get(group_name)
+    if group_id is not None:
+        try:
+            dr_hue.set_group_state(url, group_id, username, params)
+            return {'group': group_id, 'fallback': []}
+        except JsonRpcGetException as exc:
+            if NOT_AVAILABLE not in exc.error_types:
+                raise
+            forget_group_ids(url)
+
+    import datastore
+    light_ids = [base_id for base_id in datastore.get_lights_in_group(group_name, bridge_key(url)).values()
+                 if base_id is not None]
+    return dr_hue.set_lights_state(url, username, params, light_ids=light_ids)
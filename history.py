@@ -0,0 +1,298 @@
+""" Light state history for usage analysis
+
+A HistoryRecorder samples the state of every light on a bridge, from a StateMirror or a get_full_state
+poll, into a SQLite file next to the datastore. Samples are buffered and written in batches. Raw
+samples are kept for RAW_RETENTION and then rolled up into one row per light and hour, which are kept
+for HOURLY_RETENTION. The query helpers read the hourly rows and the raw samples together, so months
+of data for hundreds of lights are answered from a few thousand rows per light.
+
+The store uses the sqlite3 module directly rather than the elixir datastore, a sample is three small
+integers and an ORM object per sample would cost far more than the sample itself.
+
+Sample Usage:
+
+    import history
+
+    recorder = history.HistoryRecorder()
+    recorder.start(url, username, mirror=mirror)     # or without a mirror to poll the bridge
+    ...
+    recorder.on_hours(start=time.time() - 30 * 86400)
+    recorder.brightness_profile(url, "3")
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from ratelimit import bridge_key
+
+HISTORY_LOCATION = "$HOME/.config/dr_hue_history.db"
+SAMPLE_INTERVAL  = 60
+BATCH_SIZE       = 500
+RAW_RETENTION    = 7 * 86400
+HOURLY_RETENTION = 400 * 86400
+HOUR             = 3600
+
+_log             = logging.getLogger("dr_hue.history")
+_log.addHandler(logging.NullHandler())
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    id     INTEGER PRIMARY KEY,
+    bridge TEXT NOT NULL,
+    light  TEXT NOT NULL,
+    UNIQUE (bridge, light)
+);
+CREATE TABLE IF NOT EXISTS samples (
+    series    INTEGER NOT NULL,
+    ts        INTEGER NOT NULL,
+    is_on     INTEGER NOT NULL,
+    bri       INTEGER,
+    reachable INTEGER NOT NULL,
+    PRIMARY KEY (series, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hourly (
+    series      INTEGER NOT NULL,
+    hour        INTEGER NOT NULL,
+    samples     INTEGER NOT NULL,
+    on_samples  INTEGER NOT NULL,
+    bri_sum     INTEGER NOT NULL,
+    bri_max     INTEGER NOT NULL,
+    unreachable INTEGER NOT NULL,
+    PRIMARY KEY (series, hour)
+) WITHOUT ROWID;
+"""
+
+# Raw samples in the same shape as the hourly rows, so both can be queried together
+_RAW_HOURS = """
+SELECT series, ts / 3600 AS hour, COUNT(*) AS samples, SUM(is_on) AS on_samples,
+       SUM(CASE WHEN is_on THEN COALESCE(bri, 0) ELSE 0 END) AS bri_sum,
+       MAX(CASE WHEN is_on THEN COALESCE(bri, 0) ELSE 0 END) AS bri_max,
+       SUM(1 - reachable) AS unreachable
+FROM samples WHERE ts >= ? AND ts < ? GROUP BY series, ts / 3600
+"""
+
+# Hourly rows and raw samples together, one row per series and hour. Samples that came in for an hour
+# after it was rolled up are merged into it the way downsample would, so no hour is counted twice
+_ALL_HOURS = """
+SELECT series, hour, SUM(samples) AS samples, SUM(on_samples) AS on_samples, SUM(bri_sum) AS bri_sum,
+       MAX(bri_max) AS bri_max, SUM(unreachable) AS unreachable
+FROM (SELECT series, hour, samples, on_samples, bri_sum, bri_max, unreachable
+      FROM hourly WHERE hour >= ? AND hour < ?
+      UNION ALL """ + _RAW_HOURS + """)
+GROUP BY series, hour
+"""
+
+class HistoryRecorder(object):
+    """ Buffered writer and query helpers over one history file """
+
+    def __init__(self, path=HISTORY_LOCATION, batch_size=BATCH_SIZE):
+        self.path        = os.path.expandvars(path)
+        self.batch_size  = batch_size
+        self._buffer     = []
+        self._series     = {}
+        self._lock       = threading.RLock()
+        self._stop       = threading.Event()
+        self._sampler    = None
+
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        """ Stop sampling, write what is buffered and close the file """
+        self.stop()
+        with self._lock:
+            self.flush()
+            self._connection.close()
+
+    #####################################################################################################
+    # Writing                                                                                           #
+    #####################################################################################################
+
+    def _series_id(self, bridge, light_id):
+        """ The id of a (bridge, light) series, created on first use, caller holds the lock """
+        key = (bridge, str(light_id))
+        if key not in self._series:
+            self._connection.execute("INSERT OR IGNORE INTO series (bridge, light) VALUES (?, ?)", key)
+            self._series[key] = self._connection.execute(
+                "SELECT id FROM series WHERE bridge = ? AND light = ?", key).fetchone()[0]
+        return self._series[key]
+
+    def record(self, url, lights, ts=None):
+        """ Buffer one sample per light, written once batch_size samples are waiting
+
+        :param str url: The url of the Hue system
+        :param dict lights: the 'lights' of a get_full_state response, or light states keyed by id
+        :param int ts: the time of the sample, now if None
+        """
+        ts     = int(ts if ts is not None else time.time())
+        bridge = bridge_key(url)
+        with self._lock:
+            for light_id, attrs in lights.items():
+                state = attrs.get('state', attrs)
+                self._buffer.append((self._series_id(bridge, light_id), ts, int(bool(state.get('on'))),
+                                     state.get('bri'), int(state.get('reachable', True))))
+            if len(self._buffer) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        """ Write every buffered sample in a single transaction """
+        with self._lock:
+            if not self._buffer:
+                return
+            with self._connection:
+                # A second sample for the same light and second replaces the first
+                self._connection.executemany("INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?)",
+                                             self._buffer)
+            del self._buffer[:]
+
+    def sample(self, url, username=None, mirror=None, ts=None):
+        """ Record the current state of every light, read from the mirror if given """
+        if mirror is not None:
+            lights = mirror.get('lights')
+        else:
+            import dr_hue
+            lights = dr_hue.get_full_state(url, username).get('lights', {})
+        self.record(url, lights, ts=ts)
+
+    def start(self, url, username=None, mirror=None, interval=SAMPLE_INTERVAL):
+        """ Sample every interval seconds in a background thread, rolling up old samples once an hour """
+        def run():
+            last_maintained = 0
+            while not self._stop.wait(interval):
+                try:
+                    self.sample(url, username, mirror)
+                    self.flush()
+                except Exception as exc:
+                    # A missed sample is not fatal, the next one retries
+                    _log.warning("Sampling the lights of %s failed: %s", url, exc)
+
+                if time.time() - last_maintained >= HOUR:
+                    try:
+                        self.maintain()
+                    except Exception as exc:
+                        _log.warning("Rolling up the history of %s failed: %s", url, exc)
+                    last_maintained = time.time()
+
+        self._stop.clear()
+        self._sampler        = threading.Thread(target=run, name="dr_hue history %s" % url)
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def stop(self):
+        """ Stop sampling """
+        self._stop.set()
+
+    #####################################################################################################
+    # Retention                                                                                         #
+    #####################################################################################################
+
+    def downsample(self, now=None, raw_retention=RAW_RETENTION):
+        """ Roll the raw samples of whole hours older than raw_retention up into hourly rows
+
+        :rtype: int
+        :returns: The number of raw samples rolled up
+        """
+        now    = int(now if now is not None else time.time())
+        cutoff = (now - raw_retention) // HOUR * HOUR
+        with self._lock:
+            self.flush()
+            with self._connection:
+                # Merge with rows already rolled up for the same hours, in case late samples came in
+                self._connection.execute("""
+                    INSERT OR REPLACE INTO hourly
+                    SELECT series, hour, SUM(samples), SUM(on_samples), SUM(bri_sum), MAX(bri_max),
+                           SUM(unreachable)
+                    FROM (SELECT * FROM hourly WHERE hour IN (SELECT DISTINCT ts / 3600 FROM samples
+                                                             WHERE ts < ?)
+                          UNION ALL """ + _RAW_HOURS + """)
+                    GROUP BY series, hour""", (cutoff, 0, cutoff))
+                return self._connection.execute("DELETE FROM samples WHERE ts < ?", (cutoff,)).rowcount
+
+    def prune(self, now=None, hourly_retention=HOURLY_RETENTION):
+        """ Drop hourly rows older than hourly_retention, returns how many were dropped """
+        now = int(now if now is not None else time.time())
+        with self._lock:
+            with self._connection:
+                return self._connection.execute("DELETE FROM hourly WHERE hour < ?",
+                                                ((now - hourly_retention) // HOUR,)).rowcount
+
+    def maintain(self, now=None):
+        """ Downsample and prune """
+        self.downsample(now)
+        self.prune(now)
+
+    #####################################################################################################
+    # Queries                                                                                           #
+    #####################################################################################################
+
+    def _hours(self, start, end, url=None, light_id=None):
+        """ Hourly aggregates of the hourly rows and raw samples between start and end, with the bridge
+        and light of their series """
+        start = int(start if start is not None else 0)
+        end   = int(end if end is not None else time.time() + 1)
+        query = """
+            SELECT s.bridge, s.light, h.hour, h.samples, h.on_samples, h.bri_sum, h.bri_max, h.unreachable
+            FROM (%s) AS h JOIN series AS s ON s.id = h.series""" % _ALL_HOURS
+        args  = [start // HOUR, (end + HOUR - 1) // HOUR, start, end]
+        conditions = []
+        if url is not None:
+            conditions.append("s.bridge = ?")
+            args.append(bridge_key(url))
+        if light_id is not None:
+            conditions.append("s.light = ?")
+            args.append(str(light_id))
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        with self._lock:
+            self.flush()
+            return self._connection.execute(query, args).fetchall()
+
+    def on_hours(self, url=None, light_id=None, start=None, end=None):
+        """ Hours each light was on between start and end, estimated from the share of samples it was on
+
+        :rtype: dict
+        :returns: {("192.168.1.37", "3"): 41.5, ...}
+        """
+        totals = {}
+        for bridge, light, _, samples, on_samples, _, _, _ in self._hours(start, end, url, light_id):
+            key         = (bridge, light)
+            totals[key] = totals.get(key, 0.0) + float(on_samples) / samples
+        return totals
+
+    def brightness_profile(self, url, light_id, start=None, end=None, utc_offset=0):
+        """ Mean brightness while on, and the share of time on, per hour of the day
+
+        :param int utc_offset: seconds to add to UTC for the local hour of the day
+        :rtype: list
+        :returns: 24 (mean bri, on ratio) pairs, hour 0 first
+        """
+        totals = [[0, 0, 0] for _ in range(24)]
+        for _, _, hour, samples, on_samples, bri_sum, _, _ in self._hours(start, end, url, light_id):
+            entry     = totals[(hour * HOUR + utc_offset) // HOUR % 24]
+            entry[0] += samples
+            entry[1] += on_samples
+            entry[2] += bri_sum
+        return [(float(bri_sum) / on_samples if on_samples else 0.0,
+                 float(on_samples) / samples if samples else 0.0) for samples, on_samples, bri_sum in totals]
+
+    def samples(self, url, light_id, start=None, end=None):
+        """ The raw samples of a light that have not been rolled up yet
+
+        :rtype: list
+        :returns: (ts, on, bri, reachable) tuples, oldest first
+        """
+        with self._lock:
+            self.flush()
+            return [(ts, bool(is_on), bri, bool(reachable)) for ts, is_on, bri, reachable in
+                    self._connection.execute("""
+                        SELECT ts, is_on, bri, reachable FROM samples
+                        WHERE series = (SELECT id FROM series WHERE bridge = ? AND light = ?)
+                          AND ts >= ? AND ts < ? ORDER BY ts""",
+                        (bridge_key(url), str(light_id), int(start or 0),
+                         int(end if end is not None else time.time() + 1)))]
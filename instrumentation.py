@@ -0,0 +1,257 @@
+""" Instrumentation hooks and latency counters for the request layer
+
+Nothing in here is active by default. Register a hook or call enable_stats() and every json_rpc_call
+is timed; with neither, the request path only pays for a single module attribute lookup.
+
+Sample Usage:
+
+    import instrumentation
+
+    instrumentation.enable_stats()
+    ... make some calls ...
+    print instrumentation.prometheus_text()
+"""
+
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Checked by the request layer before doing any instrumentation work
+ENABLED = False
+
+_pre_call_hooks  = []
+_post_call_hooks = []
+_stats_enabled   = False
+_stats           = {}
+_stats_lock      = threading.Lock()
+
+class CallInfo(object):
+    """ Details of a single json_rpc_call, handed to every hook
+
+    method         str    HTTP method of the call
+    endpoint       str    Endpoint template, e.g. 'lights/<id>/state'
+    bridge         str    Network location of the bridge the call went to
+    status         int    HTTP status code, None if no response came back
+    bytes_sent     int    Size of the serialized request body
+    bytes_received int    Size of the response body
+    duration       float  Seconds spent in the call, None until the call finishes
+    error          obj    The exception raised by the call, if any
+    """
+    __slots__ = ('method', 'endpoint', 'bridge', 'status', 'bytes_sent', 'bytes_received', 'duration',
+                 'error', 'start')
+
+    def __init__(self, method, endpoint, bridge, bytes_sent):
+        self.method         = method
+        self.endpoint       = endpoint
+        self.bridge         = bridge
+        self.status         = None
+        self.bytes_sent     = bytes_sent
+        self.bytes_received = 0
+        self.duration       = None
+        self.error          = None
+        self.start          = time.time()
+
+class Histogram(object):
+    """ Fixed bucket histogram, the last bucket catches everything above the highest bound """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts  = [0] * (len(self.buckets) + 1)
+        self.count   = 0
+        self.total   = 0.0
+        self.maximum = 0.0
+
+    def observe(self, value):
+        """ Record a single value """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+
+    def cumulative(self):
+        """ List of (upper bound, cumulative count) pairs, ending with '+Inf' """
+        pairs   = []
+        running = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            running += count
+            pairs.append((bound, running))
+        return pairs
+
+class _EndpointStats(object):
+    """ Counters kept per bridge, method and endpoint """
+    __slots__ = ('latency', 'errors', 'bytes_sent', 'bytes_received', 'statuses')
+
+    def __init__(self):
+        self.latency        = Histogram()
+        self.errors         = 0
+        self.bytes_sent     = 0
+        self.bytes_received = 0
+        self.statuses       = {}
+
+def _refresh_enabled():
+    """ Recompute the fast path flag checked by the request layer """
+    global ENABLED
+    ENABLED = bool(_stats_enabled or _pre_call_hooks or _post_call_hooks)
+
+def add_pre_call_hook(hook):
+    """ Register a callable taking a CallInfo, run right before the request goes out """
+    _pre_call_hooks.append(hook)
+    _refresh_enabled()
+
+def add_post_call_hook(hook):
+    """ Register a callable taking a CallInfo, run once the call has finished or failed """
+    _post_call_hooks.append(hook)
+    _refresh_enabled()
+
+def remove_hook(hook):
+    """ Unregister a pre or post call hook """
+    for hooks in (_pre_call_hooks, _post_call_hooks):
+        while hook in hooks:
+            hooks.remove(hook)
+    _refresh_enabled()
+
+def enable_stats():
+    """ Start collecting the built in latency and byte counters """
+    global _stats_enabled
+    _stats_enabled = True
+    _refresh_enabled()
+
+def disable_stats():
+    """ Stop collecting counters, what has been collected so far is kept """
+    global _stats_enabled
+    _stats_enabled = False
+    _refresh_enabled()
+
+def reset_stats():
+    """ Drop every counter collected so far """
+    with _stats_lock:
+        _stats.clear()
+
+def reset_after_fork():
+    """ Start a forked child without the parent's hooks and counters, the stats lock may have been held """
+    global _stats_enabled, _stats_lock
+    del _pre_call_hooks[:]
+    del _post_call_hooks[:]
+    _stats.clear()
+    _stats_lock    = threading.Lock()
+    _stats_enabled = False
+    _refresh_enabled()
+
+def start_call(method, endpoint, bridge, bytes_sent):
+    """ Called by the request layer before sending, returns the CallInfo to finish later """
+    info = CallInfo(method, endpoint, bridge, bytes_sent)
+    for hook in _pre_call_hooks:
+        hook(info)
+    return info
+
+def finish_call(info, response=None, error=None):
+    """ Called by the request layer once a call completes, successfully or not """
+    info.duration = time.time() - info.start
+    info.error    = error
+    if response is not None:
+        info.status         = response.status_code
+        info.bytes_received = len(response.content or '')
+
+    if _stats_enabled:
+        _record(info)
+
+    for hook in _post_call_hooks:
+        hook(info)
+
+def _record(info):
+    """ Fold a finished call into the counters """
+    key = (info.bridge, info.method, info.endpoint)
+    with _stats_lock:
+        stats = _stats.get(key)
+        if stats is None:
+            stats = _stats[key] = _EndpointStats()
+
+        stats.latency.observe(info.duration)
+        stats.bytes_sent     += info.bytes_sent
+        stats.bytes_received += info.bytes_received
+        stats.statuses[info.status] = stats.statuses.get(info.status, 0) + 1
+        if info.error is not None:
+            stats.errors += 1
+
+def get_stats():
+    """ Snapshot of the counters
+
+    :rtype: dict
+    :returns: Keyed by bridge, then by "<method> <endpoint>"
+
+        {
+            "192.168.1.37": {
+                "PUT lights/<id>/state": {
+                    "count": 12,
+                    "errors": 0,
+                    "total_time": 0.61,
+                    "mean_time": 0.05,
+                    "max_time": 0.12,
+                    "bytes_sent": 144,
+                    "bytes_received": 540,
+                    "statuses": {200: 12},
+                    "buckets": [(0.005, 0), ..., ('+Inf', 12)]
+                }
+            }
+        }
+    """
+    snapshot = {}
+    with _stats_lock:
+        for (bridge, method, endpoint), stats in _stats.items():
+            latency = stats.latency
+            snapshot.setdefault(bridge, {})["%s %s" % (method, endpoint)] = {
+                'count'         : latency.count,
+                'errors'        : stats.errors,
+                'total_time'    : latency.total,
+                'mean_time'     : latency.total / latency.count if latency.count else 0.0,
+                'max_time'      : latency.maximum,
+                'bytes_sent'    : stats.bytes_sent,
+                'bytes_received': stats.bytes_received,
+                'statuses'      : dict(stats.statuses),
+                'buckets'       : latency.cumulative()
+            }
+    return snapshot
+
+def _labels(bridge, method, endpoint, **extra):
+    """ Render a prometheus label set """
+    labels = [('bridge', bridge), ('method', method), ('endpoint', endpoint)] + sorted(extra.items())
+    return ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in labels)
+
+def prometheus_text():
+    """ Render the counters in the prometheus text exposition format
+
+    :rtype: str
+    """
+    lines = [
+        "# HELP dr_hue_request_duration_seconds Time spent in json_rpc_call",
+        "# TYPE dr_hue_request_duration_seconds histogram"
+    ]
+    counters = []
+
+    with _stats_lock:
+        for (bridge, method, endpoint), stats in sorted(_stats.items()):
+            latency = stats.latency
+            for bound, count in latency.cumulative():
+                labels = _labels(bridge, method, endpoint, le=bound)
+                lines.append("dr_hue_request_duration_seconds_bucket{%s} %d" % (labels, count))
+
+            labels = _labels(bridge, method, endpoint)
+            lines.append("dr_hue_request_duration_seconds_sum{%s} %f" % (labels, latency.total))
+            lines.append("dr_hue_request_duration_seconds_count{%s} %d" % (labels, latency.count))
+            counters.append((labels, stats))
+
+    for name, attr, text in (('dr_hue_request_errors_total', 'errors', 'Failed json_rpc_calls'),
+                             ('dr_hue_request_bytes_sent_total', 'bytes_sent', 'Request body bytes'),
+                             ('dr_hue_request_bytes_received_total', 'bytes_received',
+                              'Response body bytes')):
+        lines.append("# HELP %s %s" % (name, text))
+        lines.append("# TYPE %s counter" % name)
+        for labels, stats in counters:
+            lines.append("%s{%s} %d" % (name, labels, getattr(stats, attr)))
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,188 @@
+""" Local mirror of a bridge's full state
+
+The mirror is loaded with get_full_state, polled now and then to pick up changes made by anyone else,
+and updated right away from the success responses of the writes that go through it. Reads are served
+from memory. Subscribers are told about every value that changes.
+
+Change events are dictionaries:
+
+    {"path": "/lights/1/state/bri", "value": 200}
+    {"path": "/schedules/3", "deleted": true}
+"""
+
+import copy
+import json
+import re
+import threading
+
+import dr_hue
+
+DEFAULT_POLL_INTERVAL = 10
+
+_GROUP_ACTION = re.compile(r'^/groups/([^/]+)/action/([^/]+)$')
+
+class MirrorPathException(Exception):
+    """ Exception raised when a path does not exist in the mirror """
+    def __init__(self, msg, path=None, **kwargs):
+        super(MirrorPathException, self).__init__(msg, **kwargs)
+        self.path = path
+
+def _split(path):
+    """ '/lights/1/state' -> ['lights', '1', 'state'] """
+    return [part for part in path.split('/') if part]
+
+def _diff(old, new, prefix, events):
+    """ Collect change events for every leaf that differs between two states """
+    for key in set(old) | set(new):
+        path = "%s/%s" % (prefix, key)
+        if key not in new:
+            events.append({'path': path, 'deleted': True})
+        elif key not in old or type(old[key]) != type(new[key]):
+            events.append({'path': path, 'value': new[key]})
+        elif isinstance(new[key], dict):
+            _diff(old[key], new[key], path, events)
+        elif old[key] != new[key]:
+            events.append({'path': path, 'value': new[key]})
+
+class StateMirror(object):
+    """ In memory copy of a bridge's full state """
+
+    def __init__(self, url, username, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.url           = url
+        self.username      = username
+        self.poll_interval = poll_interval
+        self._state        = None
+        self._lock         = threading.RLock()
+        self._subscribers  = []
+        self._stop         = threading.Event()
+        self._poller       = None
+
+    def subscribe(self, callback):
+        """ Call callback(events) with a list of change events whenever the state changes """
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """ Stop sending change events to callback """
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def _publish(self, events):
+        """ Hand change events to every subscriber, a failing subscriber is dropped """
+        if not events:
+            return
+        for callback in list(self._subscribers):
+            try:
+                callback(events)
+            except Exception:
+                self.unsubscribe(callback)
+
+    def refresh(self):
+        """ Reload the full state from the bridge, returns the change events it caused """
+        state  = dr_hue.get_full_state(self.url, self.username)
+        events = []
+        with self._lock:
+            if self._state is not None:
+                _diff(self._state, state, "", events)
+            self._state = state
+        self._publish(events)
+        return events
+
+    def start(self):
+        """ Load the state and keep polling it in a background thread """
+        if self._state is None:
+            self.refresh()
+
+        def poll():
+            while not self._stop.wait(self.poll_interval):
+                try:
+                    self.refresh()
+                except Exception:
+                    # The bridge being unreachable for a poll is not fatal, the next poll retries
+                    pass
+
+        self._stop.clear()
+        self._poller        = threading.Thread(target=poll, name="dr_hue mirror %s" % self.url)
+        self._poller.daemon = True
+        self._poller.start()
+
+    def stop(self):
+        """ Stop polling """
+        self._stop.set()
+
+    def _node(self, parts):
+        """ Walk to a node of the state, caller holds the lock """
+        if self._state is None:
+            self.refresh()
+        node = self._state
+        for index, part in enumerate(parts):
+            if not isinstance(node, dict) or part not in node:
+                path = "/" + "/".join(parts[:index + 1])
+                raise MirrorPathException("%s not available" % path, path=path)
+            node = node[part]
+        return node
+
+    def get(self, path=""):
+        """ A copy of the state at path, e.g. 'lights/1/state', '' for everything """
+        with self._lock:
+            return copy.deepcopy(self._node(_split(path)))
+
+    def get_json(self, path=""):
+        """ The state at path, serialized to json """
+        with self._lock:
+            return json.dumps(self._node(_split(path)), separators=(',', ':'))
+
+    def _set(self, path, value, events):
+        """ Set a single value, caller holds the lock """
+        parts  = _split(path)
+        parent = self._state
+        for part in parts[:-1]:
+            parent = parent.setdefault(part, {})
+        if parts and parent.get(parts[-1]) != value:
+            parent[parts[-1]] = value
+            events.append({'path': "/" + "/".join(parts), 'value': value})
+
+    def apply(self, response):
+        """ Fold the success entries of a write response into the mirror
+
+        :param list response: the bridge response, e.g. [{"success":{"/lights/1/state/on":true}}]
+        :rtype: list
+        :returns: The change events it caused
+        """
+        events = []
+        with self._lock:
+            if self._state is None:
+                return events
+
+            for item in response or []:
+                success = item.get('success') if isinstance(item, dict) else None
+                if isinstance(success, dict):
+                    for path, value in success.items():
+                        if not path.startswith('/'):
+                            continue
+                        self._set(path, value, events)
+
+                        # A group action changes the state of every light in the group
+                        match = _GROUP_ACTION.match(path)
+                        if match:
+                            group_id, field = match.groups()
+                            lights = self._state.get('lights', {})
+                            if group_id == "0":
+                                members = lights.keys()
+                            else:
+                                members = self._state.get('groups', {}).get(group_id, {}).get('lights', [])
+                            for light_id in members:
+                                if light_id in lights:
+                                    self._set("/lights/%s/state/%s" % (light_id, field), value, events)
+
+                elif isinstance(success, basestring) and success.endswith(' deleted.'):
+                    parts  = _split(success[:-len(' deleted.')])
+                    parent = self._state
+                    for part in parts[:-1]:
+                        parent = parent.get(part, {})
+                    if parts and parent.pop(parts[-1], None) is not None:
+                        events.append({'path': "/" + "/".join(parts), 'deleted': True})
+
+        self._publish(events)
+        return events
@@ -0,0 +1,198 @@
+""" Resolve lights by name, across bridges, without asking the bridge
+
+Commanding a light by name used to mean a get_all_lights, or a datastore.get_lights, to find its id
+first. A NameIndex keeps both directions in memory: names to (bridge, light id) and back. Lookups are
+case and whitespace insensitive and take a dictionary lookup; prefix lookups bisect a sorted list of the
+names and fuzzy lookups fall back to difflib for typos.
+
+The index is filled from get_all_lights responses or the datastore and then kept up to date
+incrementally: from the responses of the renames made through it, which carry the name the bridge
+actually gave ("Lobby 3 1" when "Lobby 3" was taken), and from the change events of a StateMirror it
+follows.
+
+Sample Usage:
+
+    from name_index import NameIndex
+
+    index = NameIndex()
+    index.load_bridge(url, dr_hue.get_all_lights(url, username))
+    bridge, light_id = index.resolve("lobby 3")
+    index.rename(url, username, light_id, "Lobby 4")
+    print index.prefix("lob"), index.fuzzy("Loby 4")
+"""
+
+import difflib
+import threading
+from bisect import bisect_left, insort
+
+import dr_hue
+from ratelimit import bridge_key
+
+FUZZY_CUTOFF = 0.6
+MATCH_LIMIT  = 10
+
+class NameIndexException(Exception):
+    """ Exception raised for a name that matches no light, or more than one """
+    def __init__(self, msg, name=None, matches=None, **kwargs):
+        super(NameIndexException, self).__init__(msg, **kwargs)
+        self.name    = name
+        self.matches = matches or []
+
+def normalize(name):
+    """ The form names are compared in, "  Lobby   3" and "lobby 3" are the same light """
+    return u" ".join(unicode(name).lower().split())
+
+class NameIndex(object):
+    """ Bidirectional index of light names, ids and bridges """
+
+    def __init__(self):
+        self._names  = {}     # (bridge, light id) -> name as the bridge has it
+        self._lights = {}     # normalized name -> set of (bridge, light id)
+        self._sorted = []     # normalized names, for prefix lookups
+        self._lock   = threading.RLock()
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return normalize(name) in self._lights
+
+    def _forget(self, key):
+        """ Caller holds the lock """
+        name = self._names.pop(key, None)
+        if name is None:
+            return
+        normalized = normalize(name)
+        lights     = self._lights[normalized]
+        lights.discard(key)
+        if not lights:
+            del self._lights[normalized]
+            del self._sorted[bisect_left(self._sorted, normalized)]
+
+    def add(self, url, light_id, name):
+        """ Index a light, or its new name """
+        key = (bridge_key(url), str(light_id))
+        with self._lock:
+            self._forget(key)
+            normalized = normalize(name)
+            if normalized not in self._lights:
+                self._lights[normalized] = set()
+                insort(self._sorted, normalized)
+            self._lights[normalized].add(key)
+            self._names[key] = name
+
+    def remove(self, url, light_id):
+        """ Drop a light from the index """
+        with self._lock:
+            self._forget((bridge_key(url), str(light_id)))
+
+    def load_bridge(self, url, lights):
+        """ Replace every light of a bridge
+
+        :param str url: the bridge
+        :param dict lights: a get_all_lights response, {"1": {"name": "Bedroom"}, ...}
+        """
+        bridge = bridge_key(url)
+        with self._lock:
+            for key in [key for key in self._names if key[0] == bridge]:
+                self._forget(key)
+            for light_id, attrs in lights.items():
+                self.add(url, light_id, attrs['name'])
+
+    def load_datastore(self, url):
+        """ Replace every light of a bridge with the lights registered in the datastore for that bridge """
+        # The datastore pulls in elixir and sqlalchemy, only import it when it is used
+        import datastore
+        lights = datastore.get_lights(bridge_key(url))
+        self.load_bridge(url, dict((str(base_id), {'name': name}) for name, base_id in lights.items()
+                                   if base_id is not None))
+
+    def apply_rename(self, url, light_id, response):
+        """ Take the new name from a rename_light response, [{"success":{"/lights/1/name":"Lobby 4"}}] """
+        for item in response or []:
+            success = item.get('success') if isinstance(item, dict) else None
+            if isinstance(success, dict):
+                for path, name in success.items():
+                    if path.rstrip('/').split('/')[-1] == 'name':
+                        self.add(url, light_id, name)
+
+    def rename(self, url, username, light_id, name):
+        """ Rename a light on the bridge and in the index, returns the rename_light response """
+        response = dr_hue.rename_light(url, light_id, name, username)
+        self.apply_rename(url, light_id, response)
+        return response
+
+    def follow(self, mirror):
+        """ Keep the lights of a StateMirror's bridge up to date from its change events """
+        def on_events(events):
+            for event in events:
+                parts = [part for part in event['path'].split('/') if part]
+                if len(parts) < 2 or parts[0] != 'lights':
+                    continue
+                if len(parts) == 2 and event.get('deleted'):
+                    self.remove(mirror.url, parts[1])
+                elif len(parts) == 2 and isinstance(event.get('value'), dict) and 'name' in event['value']:
+                    self.add(mirror.url, parts[1], event['value']['name'])
+                elif len(parts) == 3 and parts[2] == 'name' and not event.get('deleted'):
+                    self.add(mirror.url, parts[1], event['value'])
+
+        mirror.subscribe(on_events)
+        return on_events
+
+    def name_of(self, url, light_id):
+        """ The name of a light, None if it is not indexed """
+        return self._names.get((bridge_key(url), str(light_id)))
+
+    def lookup(self, name, url=None):
+        """ Every (bridge, light id) with that name, on the bridge at url if given """
+        with self._lock:
+            lights = sorted(self._lights.get(normalize(name), ()))
+        if url is not None:
+            bridge = bridge_key(url)
+            lights = [key for key in lights if key[0] == bridge]
+        return lights
+
+    def resolve(self, name, url=None):
+        """ The (bridge, light id) of the one light with that name
+
+        :raises NameIndexException: when no light or more than one light has the name, with the close
+                                    matches or the candidates in matches
+        """
+        # One answer from one state of the index, the lock is reentrant
+        with self._lock:
+            lights = self.lookup(name, url)
+            if len(lights) == 1:
+                return lights[0]
+            if lights:
+                raise NameIndexException("%s lights are named '%s'" % (len(lights), name), name=name,
+                                         matches=lights)
+            raise NameIndexException("No light is named '%s'" % name, name=name, matches=self.fuzzy(name))
+
+    def prefix(self, text, limit=MATCH_LIMIT):
+        """ The names starting with text, in order
+
+        :rtype: list
+        :returns: [(name, [(bridge, light id), ...]), ...]
+        """
+        text    = normalize(text)
+        matches = []
+        with self._lock:
+            position = bisect_left(self._sorted, text)
+            while position < len(self._sorted) and len(matches) < limit:
+                normalized = self._sorted[position]
+                if not normalized.startswith(text):
+                    break
+                matches.append((normalized, sorted(self._lights[normalized])))
+                position += 1
+        return matches
+
+    def fuzzy(self, text, limit=MATCH_LIMIT, cutoff=FUZZY_CUTOFF):
+        """ The names closest to text, best first, same form as prefix """
+        with self._lock:
+            names = difflib.get_close_matches(normalize(text), self._sorted, limit, cutoff)
+            return [(normalized, sorted(self._lights[normalized])) for normalized in names]
+
+def set_light_state_by_name(index, url, username, name, params):
+    """ set_light_state for the light with that name on the bridge at url, resolved through index """
+    _, light_id = index.resolve(name, url)
+    return dr_hue.set_light_state(url, light_id, username, params)
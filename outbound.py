@@ -0,0 +1,477 @@
+""" Prioritized outbound command queue per bridge
+
+Bulk helpers push their commands through an OutboundQueue instead of calling the bridge directly.
+Each queue has a few worker threads that take the most urgent command first and share the bridge's
+RateLimiter, so an interactive command skips ahead of hundreds of queued background PUTs while the
+bridge still sees the same command rate.
+
+Once a bridge has a queue, json_rpc_call routes every write to that bridge through it, at the priority
+of the calling thread:
+
+    import outbound
+
+    with outbound.priority(outbound.INTERACTIVE):
+        dr_hue.turn_light_on(url, 5, username)    # jumps ahead of a running turn_all_lights_off
+
+Queueing delay, from submit until the command goes out, is tracked per priority class.
+
+Each worker sends over its own persistent connection, so several commands can be in flight at once and
+the round trip to a remote bridge is not spent idle. How many are allowed at once is tuned per bridge
+by a ConcurrencyTuner: it adds a connection while that raises the throughput of a busy queue, steps
+back when it does not, and halves the concurrency when transport errors or internal bridge errors
+(901) show up.
+
+Queues do not outlive their use: one left idle, with no command waiting or in flight, for IDLE_TIMEOUT
+seconds is shut down, its workers stop and its bridge's writes go straight out again. A long lived
+user such as the gateway retains its queue to keep it. shutdown_outbound_queues() stops them all, and is
+run at interpreter exit: workers still waiting on their queue when the interpreter tears itself down die
+with tracebacks, so they are let go first, for up to EXIT_TIMEOUT seconds.
+"""
+
+import atexit
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from instrumentation import Histogram
+from ratelimit       import DEFAULT_WORKERS, bridge_key, get_rate_limiter
+
+INTERACTIVE = 0
+NORMAL      = 1
+BACKGROUND  = 2
+
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', NORMAL: 'normal', BACKGROUND: 'background'}
+
+DEFAULT_CONCURRENCY = 2
+TUNE_WINDOW         = 20      # commands per measurement
+TUNE_GAIN           = 0.1     # throughput gain needed to keep an extra connection
+TUNE_HOLD           = 10      # windows to stay put after settling, before probing again
+ERROR_THRESHOLD     = 0.05
+INTERNAL_ERROR      = 901
+IDLE_TIMEOUT        = 60.0    # seconds a queue may sit idle before it is shut down
+EXIT_TIMEOUT        = 2.0     # seconds given at exit to the commands still queued
+
+# Checked by the request layer, True while any bridge has a queue
+ROUTED = False
+
+_queues      = {}
+_queues_lock = threading.Lock()
+_local       = threading.local()
+_reaper      = None
+
+class CommandFuture(object):
+    """ The eventual outcome of a queued command """
+    __slots__ = ('_done', 'result', 'error')
+
+    def __init__(self):
+        self._done  = threading.Event()
+        self.result = None
+        self.error  = None
+
+    def done(self):
+        """ Whether the command has finished """
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ Block until the command finished, returns its result or raises its error """
+        if not self._done.wait(timeout):
+            raise RuntimeError("Command still queued after %s seconds" % timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def _finish(self, result=None, error=None):
+        self.result = result
+        self.error  = error
+        self._done.set()
+
+@contextmanager
+def priority(level):
+    """ Run the block with `level` as the priority of every command this thread queues """
+    previous       = getattr(_local, 'priority', NORMAL)
+    _local.priority = level
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+def current_priority():
+    """ The priority commands queued by this thread get by default """
+    return getattr(_local, 'priority', NORMAL)
+
+def in_worker():
+    """ Whether this thread is an outbound worker, its calls go straight to the bridge """
+    return getattr(_local, 'worker', False)
+
+def _transport_failure(error):
+    """ Whether an error points at an overloaded bridge or link, rather than at a bad command """
+    if error is None:
+        return False
+    error_types = getattr(error, 'error_types', None)
+    return error_types is None or INTERNAL_ERROR in error_types
+
+class ConcurrencyTuner(object):
+    """ Hill climbing on the throughput of a busy queue, one step of concurrency at a time
+
+    Every TUNE_WINDOW commands sent while more were waiting the throughput is compared with the window
+    before. A step that raised it by TUNE_GAIN or more is followed by another in the same direction,
+    otherwise the previous concurrency is restored and kept for TUNE_HOLD windows. An error rate above
+    ERROR_THRESHOLD halves the concurrency right away.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, minimum=1, maximum=DEFAULT_WORKERS,
+                 window=TUNE_WINDOW):
+        self.concurrency = max(minimum, min(concurrency, maximum))
+        self.minimum     = minimum
+        self.maximum     = maximum
+        self.window      = window
+        self.throughput  = 0.0
+        self.latency     = 0.0
+        self.error_rate  = 0.0
+        self._previous   = None
+        self._hold       = 0
+        self._reset()
+
+    def _reset(self):
+        self._start   = None
+        self._count   = 0
+        self._errors  = 0
+        self._elapsed = 0.0
+
+    def idle(self):
+        """ The queue ran dry, its throughput says nothing about the bridge until it is busy again """
+        self._reset()
+
+    def observe(self, latency, failed=False, now=None):
+        """ Count a command sent while others were waiting, returns the concurrency to use """
+        now = time.time() if now is None else now
+        if self._start is None:
+            self._start = now - latency
+        self._count   += 1
+        self._errors  += bool(failed)
+        self._elapsed += latency
+        if self._count < self.window:
+            return self.concurrency
+
+        self.throughput = self._count / max(now - self._start, 1e-6)
+        self.latency    = self._elapsed / self._count
+        self.error_rate = float(self._errors) / self._count
+        self._reset()
+
+        concurrency = self.concurrency
+        if self.error_rate > ERROR_THRESHOLD:
+            self.concurrency = max(self.minimum, concurrency // 2)
+            self._previous   = None
+            self._hold       = 0
+        elif self._hold:
+            self._hold -= 1
+            if not self._hold:
+                self._previous = None
+        elif self._previous is None:
+            # Probe upwards first, a remote bridge is usually waiting on the round trip
+            self._previous   = (concurrency, self.throughput)
+            self.concurrency = min(self.maximum, concurrency + 1)
+        else:
+            previous, throughput = self._previous
+            if self.throughput >= throughput * (1 + TUNE_GAIN) and previous != concurrency:
+                step             = 1 if concurrency > previous else -1
+                self._previous   = (concurrency, self.throughput)
+                self.concurrency = max(self.minimum, min(self.maximum, concurrency + step))
+            else:
+                self.concurrency = previous
+                self._hold       = TUNE_HOLD
+        return self.concurrency
+
+class OutboundQueue(object):
+    """ Commands for one bridge, run most urgent first by `workers` threads under a RateLimiter
+
+    At most `concurrency` of the workers send at the same time. With autotune the concurrency is
+    adjusted between 1 and `workers` by a ConcurrencyTuner.
+    """
+
+    def __init__(self, url, limiter=None, workers=DEFAULT_WORKERS, concurrency=DEFAULT_CONCURRENCY,
+                 autotune=True):
+        self.url       = url
+        self.limiter   = limiter or get_rate_limiter(url)
+        self.tuner     = ConcurrencyTuner(concurrency, maximum=workers) if autotune else None
+        self.closed    = False
+        self.last_used = time.time()
+        self._limit    = max(1, min(concurrency, workers))
+        self._active   = 0
+        self._holds    = 0
+        self._heap     = []
+        self._counter  = itertools.count()
+        self._cond     = threading.Condition()
+        self._delays   = dict((level, Histogram()) for level in PRIORITY_NAMES)
+        self._workers  = []
+        for index in range(workers):
+            self._start_worker(index)
+
+    @property
+    def concurrency(self):
+        """ How many commands may be in flight at once """
+        return self._limit
+
+    def set_concurrency(self, concurrency, autotune=False):
+        """ Fix the concurrency, between 1 and the number of workers, and turn tuning on or off """
+        with self._cond:
+            self._limit = max(1, min(concurrency, len(self._workers)))
+            self.tuner  = ConcurrencyTuner(self._limit, maximum=len(self._workers)) if autotune else None
+            self._cond.notify_all()
+
+    def _start_worker(self, index):
+        worker = threading.Thread(target=self._run, name="dr_hue outbound %s #%s" % (self.url, index))
+        worker.daemon = True
+        worker.start()
+        self._workers.append(worker)
+
+    def __len__(self):
+        """ Number of commands waiting """
+        return len(self._heap)
+
+    def submit(self, func, args=(), kwargs=None, priority=None):
+        """ Queue func(*args, **kwargs)
+
+        A queue that was shut down runs the command right away on the calling thread, still under the
+        rate limiter.
+
+        :param int priority: INTERACTIVE, NORMAL or BACKGROUND, the calling thread's priority if None
+        :rtype: CommandFuture
+        """
+        level  = current_priority() if priority is None else priority
+        future = CommandFuture()
+        with self._cond:
+            if not self.closed:
+                heapq.heappush(self._heap, (level, next(self._counter), time.time(), func, args,
+                                            kwargs or {}, future))
+                self.last_used = time.time()
+                self._cond.notify()
+                return future
+
+        self.limiter.acquire()
+        try:
+            future._finish(result=func(*args, **(kwargs or {})))
+        except Exception as exc:
+            future._finish(error=exc)
+        return future
+
+    def call(self, func, args=(), kwargs=None, priority=None):
+        """ Queue a command and wait for its result """
+        return self.submit(func, args, kwargs, priority).wait()
+
+    def retain(self):
+        """ Keep the queue from being shut down while idle, until release. Returns the queue """
+        with self._cond:
+            self._holds += 1
+        return self
+
+    def release(self):
+        with self._cond:
+            self._holds     = max(0, self._holds - 1)
+            self.last_used = time.time()
+
+    def idle(self, now=None, timeout=IDLE_TIMEOUT):
+        """ Whether the queue has had nothing to do, and nobody retaining it, for timeout seconds """
+        now = time.time() if now is None else now
+        with self._cond:
+            return (not self._heap and not self._active and not self._holds and
+                    now - self.last_used >= timeout)
+
+    def shutdown(self, wait=True, timeout=None):
+        """ Stop taking commands, the workers finish what is queued and exit
+
+        :param bool wait: wait for the workers to exit
+        :param float timeout: seconds to wait at most, for all of them together
+        """
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        if wait:
+            deadline = time.time() + timeout if timeout is not None else None
+            for worker in self._workers:
+                if worker is not threading.current_thread():
+                    worker.join(max(0, deadline - time.time()) if deadline is not None else None)
+
+    def _run(self):
+        """ Worker loop """
+        _local.worker = True
+        while True:
+            with self._cond:
+                while not self._heap or self._active >= self._limit:
+                    if self.closed and not self._heap:
+                        return
+                    self._cond.wait()
+                level, _, queued, func, args, kwargs, future = heapq.heappop(self._heap)
+                self._active += 1
+                busy          = bool(self._heap)
+
+            self.limiter.acquire()
+            started = time.time()
+            with self._cond:
+                self._delays[level].observe(started - queued)
+
+            result = error = None
+            try:
+                result = func(*args, **kwargs)
+            except Exception as exc:
+                error  = exc
+
+            with self._cond:
+                self._active  -= 1
+                self.last_used = time.time()
+                tuner          = self.tuner
+                if tuner is not None:
+                    if busy:
+                        self._limit = tuner.observe(time.time() - started, _transport_failure(error))
+                    else:
+                        tuner.idle()
+                self._cond.notify_all()
+
+            future._finish(result=result, error=error)
+
+    def stats(self):
+        """ Queueing delay per priority class
+
+        :rtype: dict
+        :returns: {'interactive': {'count': 3, 'mean': 0.01, 'max': 0.02, 'buckets': [...]}, ...,
+                   'queued': 120, 'concurrency': 3, 'active': 3, 'throughput': 9.8, 'latency': 0.28,
+                   'error_rate': 0.0}
+        """
+        stats = {'queued': len(self._heap), 'concurrency': self._limit, 'active': self._active}
+        with self._cond:
+            if self.tuner is not None:
+                stats['throughput'] = self.tuner.throughput
+                stats['latency']    = self.tuner.latency
+                stats['error_rate'] = self.tuner.error_rate
+            for level, histogram in self._delays.items():
+                stats[PRIORITY_NAMES[level]] = {
+                    'count'  : histogram.count,
+                    'mean'   : histogram.total / histogram.count if histogram.count else 0.0,
+                    'max'    : histogram.maximum,
+                    'buckets': histogram.cumulative()
+                }
+        return stats
+
+def get_outbound_queue(url, workers=DEFAULT_WORKERS, retain=False):
+    """ Get the queue for the bridge at url, creating it if needed. From then on writes to that bridge
+    are routed through it, until it is shut down after IDLE_TIMEOUT idle seconds
+
+    :param bool retain: keep the queue until its release() is called, see OutboundQueue.retain
+    """
+    global ROUTED, _reaper
+    key = bridge_key(url)
+    with _queues_lock:
+        queue = _queues.get(key)
+        if queue is None:
+            # Every worker gets a persistent connection of its own
+            from request_wrapper import set_max_connections
+            set_max_connections(url, workers)
+
+            queue  = _queues[key] = OutboundQueue(url, workers=workers)
+            ROUTED = True
+        if retain:
+            queue.retain()
+
+        if _reaper is None or not _reaper.is_alive():
+            _reaper        = threading.Thread(target=_reap, name="dr_hue outbound reaper")
+            _reaper.daemon = True
+            _reaper.start()
+    return queue
+
+def _remove_queue(key, queue):
+    """ Forget a bridge's queue and its connection pool, caller holds _queues_lock """
+    global ROUTED
+    if _queues.get(key) is queue:
+        del _queues[key]
+        from request_wrapper import clear_max_connections
+        clear_max_connections(queue.url)
+    ROUTED = bool(_queues)
+
+def reap_idle_queues(now=None, timeout=IDLE_TIMEOUT):
+    """ Shut down the queues that have been idle for timeout seconds, returns how many """
+    with _queues_lock:
+        idle = [(key, queue) for key, queue in _queues.items() if queue.idle(now, timeout)]
+        for key, queue in idle:
+            _remove_queue(key, queue)
+    for _, queue in idle:
+        queue.shutdown(wait=False)
+    return len(idle)
+
+def _reap():
+    """ Reaper thread, runs while there are queues """
+    global _reaper
+    while True:
+        time.sleep(IDLE_TIMEOUT / 2)
+        reap_idle_queues()
+        with _queues_lock:
+            if not _queues:
+                _reaper = None
+                return
+
+def shutdown_outbound_queues(wait=True, timeout=None):
+    """ Shut down every queue, the commands already queued are still sent
+
+    :param bool wait: wait for the workers to exit
+    :param float timeout: seconds to wait at most, for all the queues together
+    """
+    with _queues_lock:
+        queues = _queues.items()
+        for key, queue in queues:
+            _remove_queue(key, queue)
+    for _, queue in queues:
+        queue.shutdown(wait=False)
+    if wait:
+        deadline = time.time() + timeout if timeout is not None else None
+        for _, queue in queues:
+            queue.shutdown(timeout=max(0, deadline - time.time()) if deadline is not None else None)
+
+atexit.register(shutdown_outbound_queues, timeout=EXIT_TIMEOUT)
+
+def reset_after_fork():
+    """ Start a forked child without the parent's queues, their workers and the reaper did not survive
+    the fork and their locks may have been held """
+    global ROUTED, _queues_lock, _reaper
+    _queues.clear()
+    _queues_lock = threading.Lock()
+    _reaper      = None
+    ROUTED       = False
+
+def queue_for(key):
+    """ The queue of a bridge by its bridge_key, None if it has none """
+    return _queues.get(key)
+
+def get_stats():
+    """ Queueing delay per bridge and priority class """
+    return dict((key, queue.stats()) for key, queue in _queues.items())
+
+def map_outbound(url, func, arg_lists, priority=BACKGROUND):
+    """ Queue func(*args) for every entry of arg_lists and wait for all of them
+
+    :rtype: list
+    :returns: A (result, exception) pair per call, in the order of arg_lists. Exactly one of the two
+              is None
+    """
+    if in_worker():
+        # Waiting on the queue from one of its own workers could starve it, run inline instead
+        limiter  = get_rate_limiter(url)
+        outcomes = []
+        for args in arg_lists:
+            limiter.acquire()
+            try:
+                outcomes.append((func(*args), None))
+            except Exception as exc:
+                outcomes.append((None, exc))
+        return outcomes
+
+    queue   = get_outbound_queue(url)
+    futures = [queue.submit(func, args, priority=priority) for args in arg_lists]
+
+    outcomes = []
+    for future in futures:
+        try:
+            outcomes.append((future.wait(), None))
+        except Exception as exc:
+            outcomes.append((None, exc))
+    return outcomes
@@ -0,0 +1,340 @@
+""" Opt-in profiling of the request path and the bulk helpers
+
+While a profile runs, every json_rpc_call is split into phases and the time of each is added up:
+
+    url        building and checking the url
+    serialize  json encoding the body
+    queue      waiting in the outbound queue, rate limiting included
+    connect    opening a connection to the bridge
+    send       writing the request
+    wait       waiting for the bridge to answer, up to the response headers
+    http       the rest of the time spent in requests, reading the body included
+    parse      decoding the response and checking it for errors
+    sleep      deliberate pauses of the bulk helpers
+
+The bulk helpers are timed as a whole as well. A run can also sample the stacks of every thread, written
+out in the collapsed format flamegraph.pl and speedscope read, and run cProfile on the calling thread.
+
+Nothing is measured unless a run is active; the request path then only checks ACTIVE. Setting
+DR_HUE_PROFILE to 1 (or phases), sample, cprofile or all profiles the whole process and writes the
+report to stderr at exit, or to DR_HUE_PROFILE_OUTPUT.txt/.collapsed/.pstats if that is set too.
+
+Sample Usage:
+
+    import profiling
+
+    with profiling.profile(sample=True) as run:
+        dr_hue.turn_all_lights_on(url, username, sleep_interval=0.1)
+    print run.format()
+    run.write_collapsed("/tmp/turn_all.collapsed")
+"""
+
+import atexit
+import functools
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+PHASES          = ('url', 'serialize', 'queue', 'connect', 'send', 'wait', 'http', 'parse', 'sleep')
+SAMPLE_INTERVAL = 0.005
+ENV_MODE        = 'DR_HUE_PROFILE'
+ENV_OUTPUT      = 'DR_HUE_PROFILE_OUTPUT'
+
+# Checked by the request layer before doing any profiling work
+ACTIVE = False
+
+_runs    = []
+_lock    = threading.Lock()
+_local   = threading.local()
+_patched = False
+
+class ProfileRun(object):
+    """ The timings collected between start() and stop()
+
+    phases   dict   {phase: [count, seconds, longest]}
+    helpers  dict   {bulk helper name: [count, seconds]}
+    stacks   dict   {collapsed stack: samples}, when sampling
+    wall     float  seconds between start and stop, so far if still running
+    """
+
+    def __init__(self, sample=False, cprofile=False, interval=SAMPLE_INTERVAL):
+        self.phases    = dict((phase, [0, 0.0, 0.0]) for phase in PHASES)
+        self.helpers   = {}
+        self.stacks    = {}
+        self.interval  = interval
+        self.started   = None
+        self.stopped   = None
+        self.profiler  = None
+        self._sample   = sample
+        self._cprofile = cprofile
+        self._sampler  = None
+        self._halt     = threading.Event()
+
+    @property
+    def wall(self):
+        if self.started is None:
+            return 0.0
+        return (self.stopped or time.time()) - self.started
+
+    @property
+    def calls(self):
+        """ The number of json_rpc_calls made during the run """
+        return self.phases['url'][0]
+
+    def _add(self, phase, seconds):
+        """ Caller holds the module lock """
+        totals     = self.phases[phase]
+        totals[0] += 1
+        totals[1] += seconds
+        if seconds > totals[2]:
+            totals[2] = seconds
+
+    def _add_helper(self, name, seconds):
+        """ Caller holds the module lock """
+        totals     = self.helpers.setdefault(name, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+
+    def _take_samples(self):
+        """ Sampler thread, folds the stack of every other thread into self.stacks """
+        own = threading.current_thread().ident
+        while not self._halt.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def start(self):
+        """ Start collecting, returns self """
+        self.started = time.time()
+        if self._cprofile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if self._sample:
+            self._sampler        = threading.Thread(target=self._take_samples, name="dr_hue profile sampler")
+            self._sampler.daemon = True
+            self._sampler.start()
+        _register(self)
+        return self
+
+    def stop(self):
+        """ Stop collecting, returns self """
+        _unregister(self)
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self._sampler is not None:
+            self._halt.set()
+            self._sampler.join()
+        self.stopped = time.time()
+        return self
+
+    def as_dict(self):
+        with _lock:
+            return {
+                'wall'   : self.wall,
+                'calls'  : self.calls,
+                'phases' : dict((phase, {'count': count, 'seconds': seconds, 'max': longest})
+                                for phase, (count, seconds, longest) in self.phases.items()),
+                'helpers': dict((name, {'count': count, 'seconds': seconds})
+                                for name, (count, seconds) in self.helpers.items())
+            }
+
+    def format(self):
+        """ The phase and helper timings as a small table """
+        wall  = self.wall or 1.0
+        lines = ["%-10s %8s %10s %10s %10s %7s" % ("phase", "count", "total s", "mean ms", "max ms", "wall")]
+        with _lock:
+            for phase in PHASES:
+                count, seconds, longest = self.phases[phase]
+                if not count:
+                    continue
+                lines.append("%-10s %8d %10.3f %10.2f %10.2f %6.1f%%" % (phase, count, seconds,
+                                                                        seconds / count * 1000,
+                                                                        longest * 1000, seconds / wall * 100))
+            if self.helpers:
+                lines.append("%-30s %8s %10s" % ("helper", "count", "total s"))
+            for name, (count, seconds) in sorted(self.helpers.items()):
+                lines.append("%-30s %8d %10.3f" % (name, count, seconds))
+        lines.append("%d calls in %.3f s" % (self.calls, self.wall))
+        return "\n".join(lines)
+
+    def collapsed(self):
+        """ The sampled stacks, one "frame;frame;frame count" line each, for flamegraph.pl """
+        return "".join("%s %d\n" % (stack, count) for stack, count in sorted(self.stacks.items()))
+
+    def write_collapsed(self, path):
+        with open(path, 'w') as output:
+            output.write(self.collapsed())
+
+    def write_pstats(self, path):
+        """ Dump the cProfile statistics, for pstats, snakeviz or gprof2dot """
+        if self.profiler is None:
+            raise ValueError("The run was not started with cprofile=True")
+        self.profiler.dump_stats(path)
+
+def _refresh_active():
+    """ Recompute the fast path flag checked by the request layer """
+    global ACTIVE
+    ACTIVE = bool(_runs)
+
+def _register(run):
+    _patch_http()
+    with _lock:
+        _runs.append(run)
+        _refresh_active()
+
+def _unregister(run):
+    with _lock:
+        if run in _runs:
+            _runs.remove(run)
+        _refresh_active()
+
+def start(sample=False, cprofile=False, interval=SAMPLE_INTERVAL):
+    """ Start a ProfileRun, runs may overlap and each sees every call made while it is active
+
+    :param bool sample: sample the stacks of every thread every `interval` seconds
+    :param bool cprofile: run cProfile on the calling thread
+
+    :rtype: ProfileRun
+    """
+    return ProfileRun(sample, cprofile, interval).start()
+
+@contextmanager
+def profile(sample=False, cprofile=False, interval=SAMPLE_INTERVAL):
+    """ Profile the block, yields the ProfileRun """
+    run = start(sample, cprofile, interval)
+    try:
+        yield run
+    finally:
+        run.stop()
+
+def add(phase, seconds):
+    """ Add time spent in a phase to every active run """
+    with _lock:
+        for run in _runs:
+            run._add(phase, seconds)
+
+def lap(phase, mark):
+    """ Add the time since mark to a phase, returns the new mark """
+    now = time.time()
+    add(phase, now - mark)
+    return now
+
+def start_request():
+    """ Mark taken right before handing a call to the transport """
+    return (time.time(), getattr(_local, 'socket_time', 0.0))
+
+def finish_request(mark):
+    """ Add the time the transport took beyond connect, send and wait to the http phase, returns the new
+    mark """
+    now     = time.time()
+    started, socket_time = mark
+    add('http', max(0.0, now - started - (getattr(_local, 'socket_time', 0.0) - socket_time)))
+    return now
+
+def queued(func):
+    """ Wrap a command about to be queued so the time until it starts counts as the queue phase """
+    submitted = time.time()
+
+    def command(*args, **kwargs):
+        add('queue', time.time() - submitted)
+        return func(*args, **kwargs)
+    return command
+
+def sleep(seconds):
+    """ time.sleep that counts as the sleep phase """
+    if ACTIVE:
+        started = time.time()
+        time.sleep(seconds)
+        add('sleep', time.time() - started)
+    else:
+        time.sleep(seconds)
+
+def profiled(name):
+    """ Decorator timing a bulk helper as a whole under name while a run is active """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ACTIVE:
+                return func(*args, **kwargs)
+            started = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.time() - started
+                with _lock:
+                    for run in _runs:
+                        run._add_helper(name, elapsed)
+        return wrapper
+    return decorate
+
+def _socket_phase(phase, method):
+    """ Wrap a urllib3 connection method so it counts as phase. Time spent in a nested one, connecting
+    inside the first request on a connection, is taken out of the outer one. """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not ACTIVE or (phase == 'connect' and getattr(_local, 'connecting', False)):
+            # https connections may connect through their parent class, count that once
+            return method(self, *args, **kwargs)
+        before  = getattr(_local, 'socket_time', 0.0)
+        started = time.time()
+        if phase == 'connect':
+            _local.connecting = True
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            if phase == 'connect':
+                _local.connecting = False
+            elapsed = time.time() - started
+            add(phase, elapsed - (getattr(_local, 'socket_time', 0.0) - before))
+            _local.socket_time = before + elapsed
+    return wrapper
+
+def _patch_http():
+    """ Time connect, send and wait inside urllib3, once and only when a run starts """
+    global _patched
+    with _lock:
+        if _patched:
+            return
+        _patched = True
+    try:
+        from urllib3 import connection
+    except ImportError:
+        from requests.packages.urllib3 import connection
+    for cls, name, phase in ((connection.HTTPConnection, 'connect', 'connect'),
+                             (connection.HTTPSConnection, 'connect', 'connect'),
+                             (connection.HTTPConnection, 'request', 'send'),
+                             (connection.HTTPConnection, 'getresponse', 'wait')):
+        setattr(cls, name, _socket_phase(phase, getattr(cls, name)))
+
+def _report_at_exit(run, output):
+    """ Stop the process wide run and write out what it collected """
+    run.stop()
+    if not output:
+        sys.stderr.write(run.format() + "\n")
+        return
+    with open(output + ".txt", 'w') as report:
+        report.write(run.format() + "\n")
+    if run.stacks:
+        run.write_collapsed(output + ".collapsed")
+    if run.profiler is not None:
+        run.write_pstats(output + ".pstats")
+
+def _from_environment():
+    """ Profile the whole process when DR_HUE_PROFILE is set """
+    mode = os.environ.get(ENV_MODE, '').lower()
+    if mode in ('', '0', 'off'):
+        return
+    run = start(sample=mode in ('sample', 'all'), cprofile=mode in ('cprofile', 'all'))
+    atexit.register(_report_at_exit, run, os.environ.get(ENV_OUTPUT))
+
+_from_environment()
@@ -0,0 +1,109 @@
+""" Rate limiting of the calls made against a bridge
+
+The bridge only handles a limited number of commands per second, around 10 light commands, before it
+starts queueing or dropping them. Every helper that makes many calls shares one RateLimiter per bridge.
+"""
+
+import threading
+import time
+from urlparse import urlparse
+
+DEFAULT_RATE    = 10.0
+DEFAULT_WORKERS = 4
+
+_limiters      = {}
+_limiters_lock = threading.Lock()
+
+class RateLimiter(object):
+    """ Token bucket, allows bursts of up to `burst` calls then `rate` calls per second """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=None):
+        self.rate    = float(rate)
+        self.burst   = float(burst or max(1.0, rate))
+        self._tokens = self.burst
+        self._stamp  = time.time()
+        self._lock   = threading.Lock()
+
+    def _refill(self, now):
+        """ Add the tokens accumulated since the last call, caller holds the lock """
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp  = now
+
+    def acquire(self, tokens=1):
+        """ Block until `tokens` calls may be made
+
+        :rtype: float
+        :returns: The number of seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill(time.time())
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def set_rate(self, rate, burst=None):
+        """ Change the rate, tokens already in the bucket are kept """
+        with self._lock:
+            self._refill(time.time())
+            self.rate    = float(rate)
+            self.burst   = float(burst or max(1.0, rate))
+            self._tokens = min(self._tokens, self.burst)
+
+def bridge_key(url):
+    """ The key bridges are tracked by, the network location of the url """
+    return urlparse(url).netloc or url
+
+def get_rate_limiter(url, rate=DEFAULT_RATE):
+    """ Get the shared RateLimiter for the bridge at url, creating it with `rate` if needed """
+    key = bridge_key(url)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = RateLimiter(rate)
+    return limiter
+
+def reset_after_fork():
+    """ Start a forked child without the parent's limiters, their locks may have been held """
+    global _limiters_lock
+    _limiters.clear()
+    _limiters_lock = threading.Lock()
+
+def map_rate_limited(func, arg_lists, limiter=None, workers=DEFAULT_WORKERS):
+    """ Call func(*args) for every entry of arg_lists on a small thread pool
+
+    :param func func: the call to make
+    :param list arg_lists: a tuple of arguments per call
+    :param RateLimiter limiter: acquired before every call, None to not limit
+    :param int workers: the number of calls that may be out at the same time
+
+    :rtype: list
+    :returns: A (result, exception) pair per call, in the order of arg_lists. Exactly one of the two
+              is None
+    """
+    def call(args):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return (func(*args), None)
+        except Exception as exc:
+            return (None, exc)
+
+    if not arg_lists:
+        return []
+    if workers <= 1 or len(arg_lists) == 1:
+        return [call(args) for args in arg_lists]
+
+    # multiprocessing is slow to import, only pay for it when there is something to run
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(min(workers, len(arg_lists)))
+    try:
+        return pool.map(call, arg_lists)
+    finally:
+        pool.close()
+        pool.join()
@@ -1,8 +1,11 @@
 """ Simple module for wrapping the requests """
 
-import re
-import requests
 import json
+import threading
+import time
+import instrumentation
+import outbound
+import profiling
 from urlparse  import urlparse
 from constants import sanitize_error_messages
 from constants import HTTP_DELETE, HTTP_GET, HTTP_HEAD, HTTP_OPTIONS, HTTP_POST, HTTP_PUT
@@ -10,9 +13,19 @@ from constants import HTTP_DELETE, HTTP_GET, HTTP_HEAD, HTTP_OPTIONS, HTTP_POST,
 HTTP_BASIC_AUTH  = "HTTPBasicAuth"
 HTTP_DIGEST_AUTH = "HTTPDigestAuth"
 VALID_SCHEMES    = ['http', 'https']
+HTTP_METHODS     = frozenset([HTTP_DELETE, HTTP_GET, HTTP_HEAD, HTTP_OPTIONS, HTTP_POST, HTTP_PUT])
 
 BASEURL = "api/<username>"
 
+_requests     = None
+_session      = None
+_session_lock = threading.Lock()
+
+# Replace how calls are sent and watch what goes over the wire, see set_transport and set_recorder
+_transport    = None
+_recorder     = None
+_cache        = None
+
 class GenericCallMethodException(Exception):
     """ Exception class called when there is a generic failure that didn't involve a response from
     the server """
@@ -21,16 +34,95 @@ class GenericCallMethodException(Exception):
 
 class JsonRpcGetException(Exception):
     """ Exception class called when an API fails """
-    def __init__(self, msg, rsp=None, keys=None, **kwargs):
+    def __init__(self, msg, rsp=None, keys=None, errors=None, **kwargs):
         super(JsonRpcGetException, self).__init__(msg, **kwargs)
-        self.rsp  = rsp
-        self.keys = keys or {}
+        self.rsp    = rsp
+        self.keys   = keys or {}
+        self.errors = errors or []
+
+    @property
+    def error_types(self):
+        """ The hue error numbers of the failure, e.g. [301] """
+        return [int(error.get('type', 0)) for error in self.errors]
 
     
+def _get_requests():
+    """ Import requests on first use, it is by far the slowest part of importing dr_hue """
+    global _requests
+    if _requests is None:
+        import requests
+        _requests = requests
+    return _requests
+
+def _get_session():
+    """ Shared requests session, keeps connections to the bridges open between calls """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _get_requests().Session()
+    return _session
+
+def set_max_connections(url, connections):
+    """ Keep up to `connections` persistent connections open to the bridge at url
+
+    Calls beyond that wait for a connection to come free instead of opening a throwaway one, so the
+    bridge never sees more concurrent requests than it was tuned for.
+    """
+    parsed  = urlparse(url)
+    adapter = _get_requests().adapters.HTTPAdapter(pool_connections=1, pool_maxsize=connections,
+                                                   pool_block=True)
+    session = _get_session()
+    with _session_lock:
+        # The trailing slash keeps http://10.0.0.2 from also matching http://10.0.0.20
+        session.mount("%s://%s/" % (parsed.scheme or 'http', parsed.netloc), adapter)
+
+def clear_max_connections(url):
+    """ Go back to the session's default connection pool for the bridge at url """
+    parsed  = urlparse(url)
+    session = _get_session()
+    with _session_lock:
+        adapter = session.adapters.pop("%s://%s/" % (parsed.scheme or 'http', parsed.netloc), None)
+    if adapter is not None:
+        adapter.close()
+
+def set_transport(transport):
+    """ Send every call through transport instead of the shared requests session, None to go back
+
+    A transport has the request(method, url, data=None) method of a requests.Session and returns an
+    object with the status_code, content, raise_for_status() and json() of a requests.Response.
+    """
+    global _transport
+    _transport = transport
+
+def set_recorder(recorder):
+    """ Hand every call to recorder.record(method_type, method_name, url, data, response, started,
+    duration, error) once it is done, None to stop. See traffic.TrafficRecorder """
+    global _recorder
+    _recorder = recorder
+
+def set_cache(cache):
+    """ Answer repeated GETs from cache, a cache.ResponseCache, and invalidate it on writes. None to stop
+    caching """
+    global _cache
+    _cache = cache
+
+def reset_after_fork():
+    """ Start a forked child without the parent's session, cache and recorder
+
+    The session's sockets are shared with the parent, the locks of all three may have been held by a
+    thread that did not survive the fork. The transport is kept.
+    """
+    global _session, _session_lock, _cache, _recorder
+    _session      = None
+    _session_lock = threading.Lock()
+    _cache        = None
+    _recorder     = None
+
 def _sanitize_url(url, variables):
     """ Quickly sanitize url """
     for key in variables:
-        url = re.sub('<'+key+'>', variables[key], url)
+        url = url.replace('<'+key+'>', str(variables[key]))
     return url
 
 def request_get(url):
@@ -41,7 +133,7 @@ def request_get(url):
         raise GenericCallMethodException(msg)
 
     # save the response and throw an error if the get didn't work
-    response = requests.get(url)
+    response = _get_session().get(url)
     response.raise_for_status()
     return response
 
@@ -62,6 +154,8 @@ def json_rpc_call(url, method_type, method_name, params, keys, base_url_overide=
     #if params.get('method', None) is None and not base_url_overide:
      #   raise GenericCallMethodException("No method parameter found!")
 
+    mark = time.time() if profiling.ACTIVE else None
+
     # Cleanup the url
     base_url      = base_url_overide or "%s/%s/%s" % (url, BASEURL, method_name)
     qualified_url = _sanitize_url(base_url, keys)
@@ -72,20 +166,81 @@ def json_rpc_call(url, method_type, method_name, params, keys, base_url_overide=
         msg = "No valid scheme found, please include one of '%s' in your url" % VALID_SCHEMES
         raise GenericCallMethodException(msg)
 
-    data = json.dumps(params)
-    response = {
-        HTTP_DELETE:  lambda x: requests.delete(qualified_url,  data=data),
-        HTTP_GET:     lambda x: requests.get(qualified_url,     data=data),
-        HTTP_HEAD:    lambda x: requests.head(qualified_url,    data=data),
-        HTTP_OPTIONS: lambda x: requests.options(qualified_url, data=data),
-        HTTP_POST:    lambda x: requests.post(qualified_url,    data=data),
-        HTTP_PUT:     lambda x: requests.put(qualified_url,     data=data)
-    }[method_type](None)
+    if mark is not None:
+        mark = profiling.lap('url', mark)
 
-    response.raise_for_status()
-    for rsp in response:
-        if 'error' in rsp:
-            msg = "api_failure: %s " % rsp["error"]["description"]
-            raise JsonRpcGetException(msg, rsp=response, keys=keys)
+    cache = _cache
+    if cache is not None and method_type == HTTP_GET and cache.cacheable(method_name):
+        result = cache.get(method_name, qualified_url)
+        if result is not None:
+            return result
 
-    return response.json()
\ No newline at end of file
+    data = json.dumps(params)
+    if mark is not None:
+        profiling.lap('serialize', mark)
+
+    # Writes to a bridge that has an outbound queue wait their turn in it, see outbound.py
+    if outbound.ROUTED and method_type != HTTP_GET and not outbound.in_worker():
+        queue = outbound.queue_for(parsed_url.netloc)
+        if queue is not None:
+            perform = profiling.queued(_perform) if mark is not None else _perform
+            return queue.call(perform, (method_type, method_name, qualified_url, data, keys))
+
+    return _perform(method_type, method_name, qualified_url, data, keys)
+
+def _perform(method_type, method_name, qualified_url, data, keys):
+    """ Send a prepared call and check the response for errors """
+    info = None
+    if instrumentation.ENABLED:
+        info = instrumentation.start_call(method_type, method_name, urlparse(qualified_url).netloc, len(data))
+
+    recorder = _recorder
+    started  = time.time() if recorder is not None else None
+
+    # A write makes cached reads stale whether or not it works, a read is only kept if no write to the
+    # bridge went out meanwhile
+    cache      = _cache
+    generation = None
+    if cache is not None:
+        if method_type == HTTP_GET:
+            generation = cache.generation(qualified_url)
+        else:
+            cache.invalidate(qualified_url)
+
+    response = None
+    try:
+        if method_type not in HTTP_METHODS:
+            raise GenericCallMethodException("Unknown HTTP method '%s'" % method_type)
+        mark     = profiling.start_request() if profiling.ACTIVE else None
+        response = (_transport or _get_session()).request(method_type, qualified_url, data=data)
+        if mark is not None:
+            mark = profiling.finish_request(mark)
+
+        response.raise_for_status()
+        result = response.json()
+
+        # Failures come back as a 200 with a list of {"error": {...}} entries
+        if isinstance(result, list):
+            errors = [rsp['error'] for rsp in result if isinstance(rsp, dict) and 'error' in rsp]
+            if errors:
+                msg = "api_failure: %s " % errors[0]["description"]
+                raise JsonRpcGetException(msg, rsp=response, keys=keys, errors=errors)
+        if mark is not None:
+            profiling.lap('parse', mark)
+    except Exception as exc:
+        if info is not None:
+            instrumentation.finish_call(info, response, exc)
+        if recorder is not None:
+            recorder.record(method_type, method_name, qualified_url, data, response, started,
+                            time.time() - started, exc)
+        raise
+
+    if generation is not None:
+        cache.store(method_name, qualified_url, response.content, generation)
+    if info is not None:
+        instrumentation.finish_call(info, response)
+    if recorder is not None:
+        recorder.record(method_type, method_name, qualified_url, data, response, started,
+                        time.time() - started, None)
+
+    return result
\ No newline at end of file
@@ -0,0 +1,161 @@
+""" Scene snapshots of many lights, captured and restored in bulk
+
+A scene is captured from a single get_full_state read and kept in the local datastore. Restoring it
+reads the full state once more, skips the lights that already match, and sends lights sharing the same
+target state as one group command wherever a bridge group (or group 0, all lights) covers them.
+
+Sample Usage:
+
+    import scenes
+
+    scenes.capture_scene(url, username, "movie night", light_ids=[1, 2, 3])
+    ...
+    scenes.restore_scene(url, username, "movie night")
+"""
+
+import json
+
+import dr_hue
+from outbound import map_outbound
+from profiling import profiled
+
+# The fields holding the color for each colormode, only the active ones are restored
+COLOR_FIELDS = {
+    'hs': ('hue', 'sat'),
+    'xy': ('xy',),
+    'ct': ('ct',)
+}
+
+ALL_LIGHTS_GROUP = dr_hue.ALL_LIGHTS_GROUP
+
+class SceneRestoreException(Exception):
+    """ Exception raised when some of the commands restoring a scene failed """
+    def __init__(self, msg, errors=None, **kwargs):
+        super(SceneRestoreException, self).__init__(msg, **kwargs)
+        self.errors = errors or {}
+
+def restorable_state(state):
+    """ Reduce a light state to the fields needed to bring it back
+
+    A light that is off only needs to be turned off, the bridge refuses other changes to it (error 201).
+
+    :param dict state: the 'state' object of a light
+    :rtype: dict
+    """
+    if not state.get('on'):
+        return {'on': False}
+
+    restorable = {'on': True}
+    for field in ('bri', 'effect') + COLOR_FIELDS.get(state.get('colormode'), ()):
+        if field in state:
+            restorable[field] = state[field]
+    return restorable
+
+def capture_scene(url, username, scene_name, light_ids=None, full_state=None):
+    """ Snapshot the state of many lights into the datastore with a single read
+
+    :param str url: The url of the Hue system
+    :param str username: the username that has access to the hue system
+    :param str scene_name: the name to store the scene under, an existing scene is replaced
+    :param list light_ids: the lights to capture, every light on the bridge if None
+    :param dict full_state: an already fetched get_full_state response to capture from
+
+    :rtype: dict
+    :returns: The captured states keyed by light id
+    """
+    lights = (full_state or dr_hue.get_full_state(url, username)).get('lights', {})
+    if light_ids is not None:
+        wanted = set(str(light_id) for light_id in light_ids)
+        lights = dict((light_id, attrs) for light_id, attrs in lights.items() if light_id in wanted)
+
+    # The datastore pulls in elixir and sqlalchemy, only import it when a scene is actually stored
+    import datastore
+
+    states = dict((light_id, restorable_state(attrs.get('state', {}))) for light_id, attrs in lights.items())
+    datastore.save_scene(scene_name, states)
+    return states
+
+def _matches(current, target):
+    """ Whether a light already shows the target state """
+    if not target.get('on'):
+        return not current.get('on')
+    return all(current.get(field) == value for field, value in target.items())
+
+def plan_restore(states, full_state):
+    """ Work out the fewest commands that bring the lights to the given states
+
+    :param dict states: target states keyed by light id
+    :param dict full_state: a get_full_state response describing the bridge right now
+
+    :rtype: list
+    :returns: ('groups'|'lights', id, body) tuples
+    """
+    lights = full_state.get('lights', {})
+    groups = dict((group_id, set(attrs.get('lights', [])))
+                  for group_id, attrs in full_state.get('groups', {}).items())
+    groups[ALL_LIGHTS_GROUP] = set(lights)
+
+    # Bucket the lights by target body, split into the ones needing a change and the ones already there
+    buckets = {}
+    for light_id, target in states.items():
+        if light_id not in lights:
+            continue
+        key   = json.dumps(target, sort_keys=True)
+        entry = buckets.setdefault(key, (target, set(), set()))
+        if _matches(lights[light_id].get('state', {}), target):
+            entry[2].add(light_id)
+        else:
+            entry[1].add(light_id)
+
+    commands = []
+    for key in sorted(buckets):
+        target, todo, done = buckets[key]
+        allowed = todo | done
+
+        # Greedily use the group covering the most lights still to do, as long as it covers two or more
+        # and does not touch any light that should end up in a different state
+        while len(todo) > 1:
+            candidates = [(len(members & todo), group_id) for group_id, members in groups.items()
+                          if members and members <= allowed]
+            if not candidates:
+                break
+            covered, group_id = max(candidates)
+            if covered < 2:
+                break
+            commands.append(('groups', group_id, target))
+            todo = todo - groups[group_id]
+
+        commands.extend(('lights', light_id, target) for light_id in sorted(todo))
+
+    return commands
+
+def _send(url, username, kind, target_id, body):
+    """ Send a single restore command """
+    if kind == 'groups':
+        return dr_hue.set_group_state(url, target_id, username, body)
+    return dr_hue.set_light_state(url, target_id, username, body)
+
+@profiled("scenes.restore_scene")
+def restore_scene(url, username, scene_name):
+    """ Bring the lights of a stored scene back to their captured state
+
+    :param str url: The url of the Hue system
+    :param str username: the username that has access to the hue system
+    :param str scene_name: the name the scene was captured under
+
+    :rtype: list
+    :returns: The ('groups'|'lights', id, body) commands that were sent
+    """
+    import datastore
+
+    states   = datastore.get_scene(scene_name)
+    commands = plan_restore(states, dr_hue.get_full_state(url, username))
+    outcomes = map_outbound(url, _send, [(url, username) + command for command in commands])
+
+    errors = dict(((kind, target_id), error) for (kind, target_id, _), (_, error) in zip(commands, outcomes)
+                  if error is not None)
+    if errors:
+        msg = "Restoring scene '%s' failed for %s of %s commands" % (scene_name, len(errors), len(commands))
+        raise SceneRestoreException(msg, errors=errors)
+
+    return commands
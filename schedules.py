@@ -0,0 +1,358 @@
+""" Compiles timed light and group changes into bridge schedules
+
+Instead of sleeping in python between set_light_state calls, a timeline of changes is turned into
+schedules that the bridge runs on its own. Schedules created here are named with MANAGED_PREFIX and
+carry a digest of their content in the description, so recompiling a timeline only touches the
+schedules that actually changed.
+
+The bulk read, delete and upsert calls at the bottom run concurrently under the bridge's rate limit and
+keep a ScheduleCache of attributes keyed by schedule id, so syncing a site is a single pass.
+
+Sample Usage:
+
+    from datetime  import datetime, timedelta
+    from schedules import light_event, group_event, sync_timeline
+
+    start    = datetime.utcnow() + timedelta(minutes=10)
+    timeline = [
+        light_event("wake 1", start, 1, on=True, bri=1),
+        light_event("wake 2", start + timedelta(minutes=5), 1, bri=128),
+        group_event("shift b", start + timedelta(hours=8), 2, on=False)
+    ]
+
+    sync_timeline(url, username, timeline)
+"""
+
+import hashlib
+import json
+import threading
+from datetime import datetime
+
+import dr_hue
+from outbound import map_outbound
+from profiling import profiled
+
+MAX_SCHEDULES       = 100
+MAX_COMMAND_LENGTH  = 90
+MAX_NAME_LENGTH     = 32
+MANAGED_PREFIX      = "drh "
+DIGEST_PREFIX       = "dr_hue "
+TIME_FORMAT         = "%Y-%m-%dT%H:%M:%S"
+
+LIGHTS = 'lights'
+GROUPS = 'groups'
+
+class ScheduleCompileException(Exception):
+    """ Exception raised when a timeline cannot be turned into bridge schedules """
+    def __init__(self, msg, **kwargs):
+        super(ScheduleCompileException, self).__init__(msg, **kwargs)
+
+class BulkScheduleException(Exception):
+    """ Exception raised once a bulk operation finished with some of its calls failing """
+    def __init__(self, msg, results=None, errors=None, **kwargs):
+        super(BulkScheduleException, self).__init__(msg, **kwargs)
+        self.results = results or {}
+        self.errors  = errors or {}
+
+class TimelineEvent(object):
+    """ A single state change of a light or group at a given UTC time """
+    __slots__ = ('label', 'time', 'kind', 'target_id', 'body')
+
+    def __init__(self, label, time, kind, target_id, body):
+        self.label     = label
+        self.time      = time
+        self.kind      = kind
+        self.target_id = str(target_id)
+        self.body      = body
+
+def light_event(label, time, light_id, **state):
+    """ Build an event that sets the state of a light at time (a UTC datetime or ISO string) """
+    return TimelineEvent(label, time, LIGHTS, light_id, state)
+
+def group_event(label, time, group_id, **action):
+    """ Build an event that sets the state of a group at time (a UTC datetime or ISO string) """
+    return TimelineEvent(label, time, GROUPS, group_id, action)
+
+class SchedulePlan(object):
+    """ The bridge changes needed to bring its schedules in line with a timeline
+
+    create    list  Schedule parameter dictionaries to POST
+    update    list  (schedule id, parameter dictionary) pairs to PUT
+    delete    list  Ids of managed schedules no longer in the timeline
+    unchanged list  Ids of managed schedules that already match
+    """
+
+    def __init__(self):
+        self.create    = []
+        self.update    = []
+        self.delete    = []
+        self.unchanged = []
+
+    def __len__(self):
+        """ Number of calls applying the plan takes """
+        return len(self.create) + len(self.update) + len(self.delete)
+
+def _compact(obj):
+    """ JSON without any whitespace, that is what counts against the command limit """
+    return json.dumps(obj, separators=(',', ':'), sort_keys=True)
+
+def _format_time(time):
+    """ Normalize a datetime or string to the format the bridge accepts """
+    if isinstance(time, datetime):
+        return time.strftime(TIME_FORMAT)
+    return datetime.strptime(time, TIME_FORMAT).strftime(TIME_FORMAT)
+
+def compile_event(event, username):
+    """ Turn a TimelineEvent into the parameters for create_scehdule
+
+    :param TimelineEvent event: the change to schedule
+    :param str username: the username the bridge should run the command as
+
+    :rtype: dict
+    """
+    name = MANAGED_PREFIX + event.label
+    if len(name) > MAX_NAME_LENGTH:
+        msg = "Label '%s' is too long, at most %s characters are allowed" % \
+              (event.label, MAX_NAME_LENGTH - len(MANAGED_PREFIX))
+        raise ScheduleCompileException(msg)
+
+    suffix  = 'state' if event.kind == LIGHTS else 'action'
+    command = {
+        'address': "/api/%s/%s/%s/%s" % (username, event.kind, event.target_id, suffix),
+        'method' : 'PUT',
+        'body'   : event.body
+    }
+
+    if len(_compact(command)) > MAX_COMMAND_LENGTH:
+        msg = "Command for '%s' is %s characters, the bridge allows %s: %s" % \
+              (event.label, len(_compact(command)), MAX_COMMAND_LENGTH, _compact(command))
+        raise ScheduleCompileException(msg)
+
+    time   = _format_time(event.time)
+    digest = hashlib.sha1(_compact(command) + time).hexdigest()[:16]
+
+    return {
+        'name'       : name,
+        'description': DIGEST_PREFIX + digest,
+        'command'    : command,
+        'time'       : time
+    }
+
+def compile_timeline(url, username, events, now=None, cache=None):
+    """ Diff a timeline against the schedules on the bridge
+
+    Events that are already in the past are left out, the bridge would refuse them.
+
+    :param str url: The url of the Hue system
+    :param str username: the username that has access to the hue system
+    :param list events: TimelineEvent objects, labels must be unique
+    :param datetime now: the current UTC time, defaults to datetime.utcnow()
+    :param ScheduleCache cache: where schedule attributes are read from, a fresh one by default
+
+    :rtype: SchedulePlan
+    """
+    now   = (now or datetime.utcnow()).strftime(TIME_FORMAT)
+    cache = cache or ScheduleCache(url, username)
+
+    desired = {}
+    for event in events:
+        params = compile_event(event, username)
+        if params['name'] in desired:
+            raise ScheduleCompileException("Label '%s' is used more than once" % event.label)
+        if params['time'] > now:
+            desired[params['name']] = params
+
+    existing = dr_hue.get_all_schedules(url, username)
+    managed  = dict((attrs['name'], schedule_id) for schedule_id, attrs in existing.items()
+                    if attrs.get('name', '').startswith(MANAGED_PREFIX))
+
+    # Only the schedules we may keep need their description compared
+    attributes = get_schedules_bulk(url, username, [managed[name] for name in desired if name in managed],
+                                    cache=cache)
+
+    plan = SchedulePlan()
+    for name, params in sorted(desired.items()):
+        schedule_id = managed.pop(name, None)
+        if schedule_id is None:
+            plan.create.append(params)
+        elif attributes[schedule_id].get('description') == params['description']:
+            plan.unchanged.append(schedule_id)
+        else:
+            changes = dict((key, params[key]) for key in ('description', 'command', 'time'))
+            plan.update.append((schedule_id, changes))
+
+    plan.delete = sorted(managed.values())
+
+    total = len(existing) - len(plan.delete) + len(plan.create)
+    if total > MAX_SCHEDULES:
+        msg = "Timeline needs %s schedules, the bridge can store %s" % (total, MAX_SCHEDULES)
+        raise ScheduleCompileException(msg)
+
+    return plan
+
+@profiled("schedules.apply_plan")
+def apply_plan(url, username, plan, cache=None):
+    """ Run a SchedulePlan against the bridge. Deletes go first to free up schedule slots
+
+    :rtype: dict
+    :returns: The bridge responses, keyed by schedule id for deletes and updates and by schedule
+              name for creates
+    """
+    responses = delete_schedules_bulk(url, username, plan.delete, cache=cache)
+    upserts   = [dict(params, id=schedule_id) for schedule_id, params in plan.update] + plan.create
+    responses.update(upsert_schedules_bulk(url, username, upserts, cache=cache))
+    return responses
+
+def sync_timeline(url, username, events, now=None, cache=None):
+    """ Compile a timeline and apply it, returns the SchedulePlan that was applied """
+    cache = cache or ScheduleCache(url, username)
+    plan  = compile_timeline(url, username, events, now=now, cache=cache)
+    apply_plan(url, username, plan, cache=cache)
+    return plan
+
+#########################################################################################################
+# Bulk schedule management                                                                              #
+#########################################################################################################
+
+class ScheduleCache(object):
+    """ Attributes of the schedules on one bridge, keyed by schedule id
+
+    Entries are filled in by get_schedules_bulk and kept in line by the bulk delete and upsert calls.
+    Changes made to the bridge by other clients are not seen until invalidate() or clear().
+    """
+
+    def __init__(self, url, username):
+        self.url         = url
+        self.username    = username
+        self._attributes = {}
+        self._lock       = threading.Lock()
+
+    def __contains__(self, schedule_id):
+        return str(schedule_id) in self._attributes
+
+    def get(self, schedule_id):
+        """ Cached attributes of a schedule, None on a miss """
+        attrs = self._attributes.get(str(schedule_id))
+        return dict(attrs) if attrs is not None else None
+
+    def store(self, schedule_id, attrs):
+        """ Replace the cached attributes of a schedule """
+        with self._lock:
+            self._attributes[str(schedule_id)] = dict(attrs)
+
+    def merge(self, schedule_id, changes):
+        """ Apply a successful update to a cached schedule, a miss stays a miss """
+        with self._lock:
+            attrs = self._attributes.get(str(schedule_id))
+            if attrs is not None:
+                attrs.update(changes)
+
+    def invalidate(self, schedule_id):
+        """ Forget a single schedule """
+        with self._lock:
+            self._attributes.pop(str(schedule_id), None)
+
+    def clear(self):
+        """ Forget every schedule """
+        with self._lock:
+            self._attributes.clear()
+
+def _collect(keys, outcomes, operation):
+    """ Split (result, exception) pairs into results, raising if anything failed """
+    results = {}
+    errors  = {}
+    for key, (result, error) in zip(keys, outcomes):
+        if error is None:
+            results[key] = result
+        else:
+            errors[key] = error
+
+    if errors:
+        msg = "%s failed for %s of %s schedules: %s" % \
+              (operation, len(errors), len(keys), ", ".join(sorted(str(key) for key in errors)))
+        raise BulkScheduleException(msg, results=results, errors=errors)
+
+    return results
+
+@profiled("schedules.get_schedules_bulk")
+def get_schedules_bulk(url, username, schedule_ids=None, cache=None):
+    """ Read the attributes of many schedules, only fetching what is not cached yet
+
+    :param str url: The url of the Hue system
+    :param str username: the username that has access to the hue system
+    :param list schedule_ids: the ids to read, all schedules on the bridge if None
+    :param ScheduleCache cache: filled in with what gets fetched
+
+    :rtype: dict
+    :returns: Schedule attributes keyed by schedule id
+    """
+    cache = cache or ScheduleCache(url, username)
+    if schedule_ids is None:
+        schedule_ids = dr_hue.get_all_schedules(url, username).keys()
+    schedule_ids = [str(schedule_id) for schedule_id in schedule_ids]
+
+    missing  = [schedule_id for schedule_id in schedule_ids if schedule_id not in cache]
+    outcomes = map_outbound(url, dr_hue.get_schedule_attributes,
+                            [(url, schedule_id, username) for schedule_id in missing])
+
+    for schedule_id, (attrs, error) in zip(missing, outcomes):
+        if error is None:
+            cache.store(schedule_id, attrs)
+    _collect(missing, outcomes, "Reading")
+
+    return dict((schedule_id, cache.get(schedule_id)) for schedule_id in schedule_ids)
+
+@profiled("schedules.delete_schedules_bulk")
+def delete_schedules_bulk(url, username, schedule_ids, cache=None):
+    """ Delete many schedules
+
+    :rtype: dict
+    :returns: The bridge responses keyed by schedule id
+    """
+    schedule_ids = [str(schedule_id) for schedule_id in schedule_ids]
+    outcomes     = map_outbound(url, dr_hue.delete_schedule,
+                                    [(url, schedule_id, username) for schedule_id in schedule_ids])
+
+    if cache is not None:
+        for schedule_id, (_, error) in zip(schedule_ids, outcomes):
+            if error is None:
+                cache.invalidate(schedule_id)
+
+    return _collect(schedule_ids, outcomes, "Deleting")
+
+def _upsert(url, username, params):
+    """ Update the schedule if params has an 'id', create it otherwise """
+    params      = dict(params)
+    schedule_id = params.pop('id', None)
+    if schedule_id is None:
+        return dr_hue.create_scehdule(url, username, params)
+    return dr_hue.set_scehdule_attributes(url, schedule_id, username, params)
+
+@profiled("schedules.upsert_schedules_bulk")
+def upsert_schedules_bulk(url, username, schedules, cache=None):
+    """ Create or update many schedules
+
+    :param list schedules: create_scehdule parameter dictionaries, those with an 'id' key update that
+                           schedule instead
+
+    :rtype: dict
+    :returns: The bridge responses keyed by schedule id for updates and by name for creates
+    """
+    keys     = [str(params['id']) if 'id' in params else params.get('name') for params in schedules]
+    outcomes = map_outbound(url, _upsert, [(url, username, params) for params in schedules])
+
+    if cache is not None:
+        for params, (response, error) in zip(schedules, outcomes):
+            if error is not None:
+                continue
+            changes = dict((key, value) for key, value in params.items() if key != 'id')
+            if 'id' in params:
+                cache.merge(params['id'], changes)
+            else:
+                # [{"success":{"id": "2"}}]
+                for item in response or []:
+                    created = item.get('success', {}).get('id')
+                    if created is not None:
+                        cache.store(created, changes)
+
+    return _collect(keys, outcomes, "Writing")
@@ -0,0 +1,301 @@
+""" Spread a large fleet of bridges over several processes
+
+With hundreds of bridges a single process spends its time encoding and decoding json and in requests,
+and the GIL keeps that on one core. A ShardedFleet splits the bridges over worker processes, each
+owning its bridges outright: their connection pools, outbound queues, rate limiters and whatever else
+the module level state of dr_hue holds only ever live in that one process. The coordinator routes
+every call to the process owning its bridge and hands the results back in the order the calls were
+given. Within a worker a small thread pool keeps calls to different bridges going at the same time.
+
+Functions are sent by reference, so they have to be module level functions such as the ones in dr_hue.
+They are called with the bridge url as the first argument. Failures come back as ShardCallException,
+with the name and hue error types of the original exception. So do results that cannot be pickled, calls
+whose worker process died and calls still out when a map times out.
+
+Sample Usage:
+
+    from sharding import ShardedFleet
+
+    with ShardedFleet(bridges, processes=4) as fleet:
+        outcomes = fleet.map(dr_hue.set_light_state, [(url, (light_id, username, {'on': True}))
+                                                      for url, username, light_id in targets])
+        configs  = fleet.broadcast(dr_hue.get_configuration)
+"""
+
+import cPickle
+import itertools
+import multiprocessing
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from Queue       import Empty
+
+from ratelimit import bridge_key
+
+WORKER_THREADS    = 8
+LIVENESS_INTERVAL = 1.0    # seconds between two checks for dead workers
+
+# Modules whose state a worker forgets first thing, see their reset_after_fork
+_FORK_STATE = ('request_wrapper', 'outbound', 'ratelimit', 'instrumentation', 'adaptive')
+
+class ShardCallException(Exception):
+    """ Exception standing in for one raised by a call in a worker process """
+    def __init__(self, msg, error_type=None, error_types=None, **kwargs):
+        super(ShardCallException, self).__init__(msg, **kwargs)
+        self.error_type  = error_type
+        self.error_types = error_types
+
+def shard_index(url, shards):
+    """ The shard a bridge belongs to, the same in every process and every run """
+    return zlib.crc32(bridge_key(url)) % shards
+
+def _fresh_process_state():
+    """ Forget the connections, queues, limiters, caches and hooks inherited from the coordinator
+
+    Their sockets are shared with the coordinator, their worker threads did not survive the fork and
+    their locks may have been held by one of those threads. Modules not imported yet have nothing to
+    forget.
+    """
+    for name in _FORK_STATE:
+        module = sys.modules.get(name)
+        if module is not None:
+            module.reset_after_fork()
+
+def _shard_error(exc):
+    name = exc.__class__.__name__
+    return ShardCallException("%s: %s" % (name, exc), error_type=name,
+                              error_types=getattr(exc, 'error_types', None))
+
+def _execute(job_id, index, func, url, args, kwargs):
+    """ Run one call in a worker, returns the message for the coordinator
+
+    The outcome is pickled here: the queue's feeder thread would drop a message it cannot pickle and
+    leave the coordinator waiting for it.
+    """
+    try:
+        outcome = (func(url, *args, **kwargs), None)
+    except Exception as exc:
+        outcome = (None, _shard_error(exc))
+    try:
+        payload = cPickle.dumps(outcome, cPickle.HIGHEST_PROTOCOL)
+    except Exception as exc:
+        payload = cPickle.dumps((None, _shard_error(exc)), cPickle.HIGHEST_PROTOCOL)
+    return (job_id, index, payload)
+
+def _serve(shard, inbox, outbox, bridges, threads, initializer):
+    """ Worker process main loop, runs calls until it gets None """
+    from multiprocessing.pool import ThreadPool
+
+    _fresh_process_state()
+    if initializer is not None:
+        initializer(bridges)
+
+    pool = ThreadPool(threads)
+    try:
+        for command in iter(inbox.get, None):
+            pool.apply_async(_execute, command, callback=outbox.put)
+    finally:
+        pool.close()
+        pool.join()
+        outbox.put((None, shard, None))
+
+class _Job(object):
+    """ The calls of one map, filled in by the collector thread """
+
+    def __init__(self, shards):
+        self.shards   = shards
+        self.outcomes = [None] * len(shards)
+        self.pending  = len(shards)
+        self.done     = threading.Event()
+        if not shards:
+            self.done.set()
+
+    def fill(self, index, outcome):
+        """ Set an outcome unless it is in already, caller holds the fleet's lock. Returns whether the
+        job is done """
+        if self.outcomes[index] is None:
+            self.outcomes[index] = outcome
+            self.pending        -= 1
+        return not self.pending
+
+class ShardedFleet(object):
+    """ Worker processes each owning a share of the bridges
+
+    bridges      list  (url, username) pairs
+    processes    int   worker processes, the number of cores if None
+    threads      int   calls a worker runs at the same time
+    initializer  func  called as initializer(bridges) in every worker with its share of the bridges,
+                       e.g. to enable adaptive rates or a response cache there
+    """
+
+    def __init__(self, bridges, processes=None, threads=WORKER_THREADS, initializer=None):
+        self.bridges     = OrderedDict(bridges)
+        self.processes   = max(1, min(processes or multiprocessing.cpu_count(), len(self.bridges) or 1))
+        self.threads     = threads
+        self.initializer = initializer
+        self.calls       = [0] * self.processes
+        self._inboxes    = []
+        self._outbox     = None
+        self._workers    = []
+        self._collector  = None
+        self._dead       = set()
+        self._jobs       = {}
+        self._job_ids    = itertools.count()
+        self._lock       = threading.Lock()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def shard_of(self, url):
+        return shard_index(url, self.processes)
+
+    def start(self):
+        """ Start the worker processes, returns self """
+        self._outbox = multiprocessing.Queue()
+        self._dead   = set()
+        for shard in range(self.processes):
+            owned  = [(url, username) for url, username in self.bridges.items()
+                      if self.shard_of(url) == shard]
+            inbox  = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=_serve, name="dr_hue shard %s" % shard,
+                                             args=(shard, inbox, self._outbox, owned, self.threads,
+                                                   self.initializer))
+            worker.daemon = True
+            worker.start()
+            self._inboxes.append(inbox)
+            self._workers.append(worker)
+
+        self._collector        = threading.Thread(target=self._collect, name="dr_hue shard collector")
+        self._collector.daemon = True
+        self._collector.start()
+        return self
+
+    def stop(self):
+        """ Let the workers finish what they were given and stop them """
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for worker in self._workers:
+            worker.join()
+        if self._collector is not None:
+            self._collector.join()
+        self._inboxes, self._workers, self._collector = [], [], None
+
+    def _deliver(self, message, stopped):
+        """ Hand one message from a worker to its job, or note the worker stopped """
+        job_id, index, payload = message
+        if job_id is None:
+            stopped.add(index)
+            return
+        try:
+            outcome = cPickle.loads(payload)
+        except Exception as exc:
+            # A result that cannot be rebuilt here fails its own call, not the collector
+            outcome = (None, _shard_error(exc))
+        with self._lock:
+            # Calls failed for a timeout or a dead worker are not filled in again
+            job = self._jobs.get(job_id)
+            if job is not None and job.fill(index, outcome):
+                del self._jobs[job_id]
+                job.done.set()
+
+    def _fail(self, shards, msg, job_ids=None):
+        """ Fail the calls still out on shards, of every job or of the given ones """
+        with self._lock:
+            for job_id, job in self._jobs.items():
+                if job_ids is not None and job_id not in job_ids:
+                    continue
+                for index, shard in enumerate(job.shards):
+                    if shard in shards and job.outcomes[index] is None:
+                        job.fill(index, (None, ShardCallException(msg % shard)))
+                if not job.pending:
+                    del self._jobs[job_id]
+                    job.done.set()
+
+    def _collect(self):
+        """ Hand the results coming back from the workers to their jobs, and fail the calls of workers
+        that die """
+        workers, stopped = list(self._workers), set()
+        checked          = time.time()
+        while len(stopped | self._dead) < len(workers):
+            try:
+                self._deliver(self._outbox.get(timeout=LIVENESS_INTERVAL), stopped)
+            except Empty:
+                pass
+            if time.time() - checked < LIVENESS_INTERVAL:
+                continue
+
+            checked = time.time()
+            dead    = set(shard for shard, worker in enumerate(workers)
+                          if shard not in stopped | self._dead and not worker.is_alive())
+            if not dead:
+                continue
+            # What a worker sent before it died is still in the pipe
+            while True:
+                try:
+                    self._deliver(self._outbox.get_nowait(), stopped)
+                except Empty:
+                    break
+            with self._lock:
+                self._dead |= dead - stopped
+            self._fail(dead - stopped, "Shard %s died")
+
+    def map(self, func, calls, timeout=None):
+        """ Run func(url, *args, **kwargs) for every call on the worker owning its bridge, and wait
+
+        :param func func: a module level function
+        :param list calls: (url, args) or (url, args, kwargs) tuples
+        :param float timeout: seconds to wait, the calls still out then fail. None to wait for all
+
+        :rtype: list
+        :returns: A (result, exception) pair per call, in the order of calls. Exactly one of the two
+                  is None
+        """
+        job_id = next(self._job_ids)
+        shards = [self.shard_of(call[0]) for call in calls]
+        job    = _Job(shards)
+        with self._lock:
+            if calls:
+                self._jobs[job_id] = job
+            for shard in shards:
+                self.calls[shard] += 1
+            dead = set(self._dead)
+
+        for index, (shard, call) in enumerate(zip(shards, calls)):
+            if shard in dead:
+                continue
+            kwargs = call[2] if len(call) > 2 else {}
+            self._inboxes[shard].put((job_id, index, func, call[0], tuple(call[1]), kwargs))
+        if dead:
+            self._fail(dead, "Shard %s died", job_ids=[job_id])
+
+        if not job.done.wait(timeout):
+            self._fail(set(shards), "Timed out waiting for shard %%s after %s seconds" % timeout,
+                       job_ids=[job_id])
+        return job.outcomes
+
+    def broadcast(self, func, *args, **kwargs):
+        """ Run func(url, username, *args, **kwargs) once for every bridge
+
+        :rtype: OrderedDict
+        :returns: A (result, exception) pair per bridge url
+        """
+        calls = [(url, (username,) + args, kwargs) for url, username in self.bridges.items()]
+        return OrderedDict(zip(self.bridges, self.map(func, calls)))
+
+    def stats(self):
+        """ Bridges and calls per shard
+
+        :rtype: list
+        :returns: [{'bridges': 25, 'calls': 1200, 'alive': True}, ...]
+        """
+        owned = [0] * self.processes
+        for url in self.bridges:
+            owned[self.shard_of(url)] += 1
+        return [{'bridges': owned[shard], 'calls': self.calls[shard],
+                 'alive': shard < len(self._workers) and self._workers[shard].is_alive()}
+                for shard in range(self.processes)]
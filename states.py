@@ -0,0 +1,215 @@
+""" Compact, validated state records for bridge responses
+
+The read calls in dr_hue return the bridge's json as nested dictionaries. Keeping thousands of those
+around costs a dictionary per light and another per state object, and every reader has to check the
+fields it uses. The records here are parsed and validated once, keep their fields in __slots__ and
+share repeated values such as model ids and color modes between lights.
+
+Only the modelled fields are kept, as_dict gives back the bridge layout for those.
+
+Sample Usage:
+
+    import dr_hue
+    import states
+
+    lights = states.parse_lights(dr_hue.get_full_state(url, username)['lights'])
+    print lights['1'].name, lights['1'].bri
+
+Run benchmarks/state_memory.py to compare the footprint with the plain dictionaries.
+"""
+
+class StateValidationException(Exception):
+    """ Exception raised when a bridge response does not have the expected fields """
+    def __init__(self, msg, field=None, value=None, **kwargs):
+        super(StateValidationException, self).__init__(msg, **kwargs)
+        self.field = field
+        self.value = value
+
+# Values that repeat across many lights are stored once
+_shared = {}
+
+def _bool(value):
+    if isinstance(value, bool):
+        return value
+    raise ValueError("expected a bool")
+
+def _int(value):
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return value
+    raise ValueError("expected an integer")
+
+def _str(value):
+    if isinstance(value, basestring):
+        return value
+    raise ValueError("expected a string")
+
+def _enum(value):
+    return _shared.setdefault(_str(value), value)
+
+def _ids(value):
+    if isinstance(value, list):
+        return tuple(_enum(item) for item in value)
+    raise ValueError("expected a list of ids")
+
+def _xy(value):
+    if isinstance(value, list) and len(value) == 2:
+        return (float(value[0]), float(value[1]))
+    raise ValueError("expected an [x, y] pair")
+
+def _obj(value):
+    if isinstance(value, dict):
+        return value
+    raise ValueError("expected an object")
+
+# (section, ((attribute, key, converter), ...)), a section of None is the top level of the object
+_COLOR_FIELDS = (('on', 'on', _bool), ('bri', 'bri', _int), ('hue', 'hue', _int), ('sat', 'sat', _int),
+                 ('ct', 'ct', _int), ('xy', 'xy', _xy), ('effect', 'effect', _enum),
+                 ('alert', 'alert', _enum), ('colormode', 'colormode', _enum))
+
+LIGHT_LAYOUT = (
+    (None, (('name', 'name', _str), ('type', 'type', _enum), ('modelid', 'modelid', _enum),
+            ('swversion', 'swversion', _enum))),
+    ('state', _COLOR_FIELDS + (('reachable', 'reachable', _bool),))
+)
+
+GROUP_LAYOUT = (
+    (None, (('name', 'name', _str), ('lights', 'lights', _ids))),
+    ('action', _COLOR_FIELDS)
+)
+
+SCHEDULE_LAYOUT = (
+    (None, (('name', 'name', _str), ('description', 'description', _str), ('time', 'time', _str))),
+    ('command', (('address', 'address', _str), ('method', 'method', _enum), ('body', 'body', _obj)))
+)
+
+CONFIG_LAYOUT = (
+    (None, (('name', 'name', _str), ('mac', 'mac', _str), ('ipaddress', 'ipaddress', _str),
+            ('netmask', 'netmask', _str), ('gateway', 'gateway', _str), ('dhcp', 'dhcp', _bool),
+            ('proxyaddress', 'proxyaddress', _str), ('proxyport', 'proxyport', _int),
+            ('utc', 'utc', _str), ('swversion', 'swversion', _str), ('linkbutton', 'linkbutton', _bool),
+            ('portalservices', 'portalservices', _bool), ('whitelist', 'whitelist', _obj))),
+)
+
+def _slots(layout):
+    """ The attribute names of a layout """
+    return tuple(attribute for _, fields in layout for attribute, _, _ in fields)
+
+class _Record(object):
+    """ A bridge object parsed against a layout """
+    __slots__ = ('id',)
+    _layout   = ()
+
+    @classmethod
+    def from_json(cls, record_id, data):
+        """ Parse and validate one object of a bridge response
+
+        :param str record_id: the id of the object, e.g. the light id
+        :param dict data: the object as returned by the bridge
+        """
+        record    = cls.__new__(cls)
+        record.id = str(record_id) if record_id is not None else None
+
+        for section, fields in cls._layout:
+            source = data if section is None else data.get(section, {})
+            if not isinstance(source, dict):
+                raise StateValidationException("%s %s: '%s' is not an object" % (cls.__name__, record_id,
+                                                                                section), field=section)
+            for attribute, key, convert in fields:
+                value = source.get(key)
+                if value is not None:
+                    try:
+                        value = convert(value)
+                    except (ValueError, TypeError) as exc:
+                        raise StateValidationException("%s %s: %s %s, got %r" % (cls.__name__, record_id,
+                                                                                 key, exc, value),
+                                                       field=key, value=value)
+                setattr(record, attribute, value)
+        return record
+
+    def as_dict(self):
+        """ The record in the bridge's layout, fields that were missing are left out """
+        result = {}
+        for section, fields in self._layout:
+            target = result if section is None else result.setdefault(section, {})
+            for attribute, key, _ in fields:
+                value = getattr(self, attribute)
+                if value is not None:
+                    target[key] = list(value) if isinstance(value, tuple) else value
+        return result
+
+    def __eq__(self, other):
+        return type(self) is type(other) and \
+               all(getattr(self, name) == getattr(other, name) for name in ('id',) + _slots(self._layout))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<%s %s %r>" % (self.__class__.__name__, self.id, getattr(self, 'name', None))
+
+class LightState(_Record):
+    """ A light, with its state fields on the record itself: light.bri rather than light['state']['bri'] """
+    _layout   = LIGHT_LAYOUT
+    __slots__ = _slots(LIGHT_LAYOUT)
+
+class GroupState(_Record):
+    """ A group, with its last action fields on the record itself """
+    _layout   = GROUP_LAYOUT
+    __slots__ = _slots(GROUP_LAYOUT)
+
+class ScheduleState(_Record):
+    """ A schedule, with its command's address, method and body on the record itself """
+    _layout   = SCHEDULE_LAYOUT
+    __slots__ = _slots(SCHEDULE_LAYOUT)
+
+class ConfigState(_Record):
+    """ The bridge configuration """
+    _layout   = CONFIG_LAYOUT
+    __slots__ = _slots(CONFIG_LAYOUT)
+
+class FullState(object):
+    """ Every record of a get_full_state response """
+    __slots__ = ('lights', 'groups', 'schedules', 'config')
+
+    def __init__(self, lights, groups, schedules, config):
+        self.lights    = lights
+        self.groups    = groups
+        self.schedules = schedules
+        self.config    = config
+
+def _parse_all(record_class, response):
+    """ Parse a response keyed by id into records """
+    if not isinstance(response, dict):
+        raise StateValidationException("Expected an object keyed by id, got %r" % type(response).__name__)
+    return dict((key, record_class.from_json(key, value)) for key, value in response.iteritems())
+
+def parse_light(light_id, response):
+    """ A LightState from a get_light_attr response """
+    return LightState.from_json(light_id, response)
+
+def parse_lights(response):
+    """ LightStates keyed by id, from the 'lights' of a get_full_state response
+
+    A get_all_lights response only has the names, those records have no state fields.
+    """
+    return _parse_all(LightState, response)
+
+def parse_groups(response):
+    """ GroupStates keyed by id """
+    return _parse_all(GroupState, response)
+
+def parse_schedules(response):
+    """ ScheduleStates keyed by id """
+    return _parse_all(ScheduleState, response)
+
+def parse_config(response):
+    """ A ConfigState from a get_configuration response """
+    return ConfigState.from_json(None, response)
+
+def parse_full_state(response):
+    """ A FullState from a get_full_state response
+
+    :rtype: FullState
+    """
+    return FullState(parse_lights(response.get('lights', {})), parse_groups(response.get('groups', {})),
+                     parse_schedules(response.get('schedules', {})), parse_config(response.get('config', {})))
@@ -0,0 +1,207 @@
+""" Record the calls made to bridges and replay them later
+
+A TrafficRecorder installed with request_wrapper.set_recorder writes every json_rpc_call to a log, one
+compact json array per line: the offset from the start of the recording, the duration, the method,
+the url template, the path, the body, the status and the response. Logs ending in .gz are compressed.
+
+replay re-issues a log against another bridge, normally a fakebridge.FakeBridge, through the current
+client code, at the original pace, a multiple of it, or as fast as it will go. The ReplayReport
+compares throughput and latency with the recording.
+
+Sample Usage:
+
+    import request_wrapper, traffic
+
+    recorder = traffic.TrafficRecorder("/var/log/dr_hue/traffic.log.gz")
+    request_wrapper.set_recorder(recorder)
+    ...
+    request_wrapper.set_recorder(None)
+    recorder.close()
+
+    print traffic.replay("/var/log/dr_hue/traffic.log.gz", fake.url, speed=60).format()
+"""
+
+import gzip
+import json
+import threading
+import time
+from collections import namedtuple
+from urlparse    import urlparse
+
+from request_wrapper import json_rpc_call
+
+FORMAT_VERSION = 1
+FLUSH_EVERY    = 100
+REPLAY_WORKERS = 8
+
+Call = namedtuple('Call', 'offset duration method template path body status response error')
+
+class TrafficException(Exception):
+    """ Exception raised for a log that cannot be read """
+    def __init__(self, msg, **kwargs):
+        super(TrafficException, self).__init__(msg, **kwargs)
+
+def _open(path, mode):
+    """ Open a log, compressed if its name ends in .gz """
+    return gzip.open(path, mode) if path.endswith('.gz') else open(path, mode)
+
+class TrafficRecorder(object):
+    """ Writes every call handed to it by request_wrapper to a log """
+
+    def __init__(self, path, responses=True):
+        self.path      = path
+        self.responses = responses
+        self.started   = time.time()
+        self.count     = 0
+        self._lock     = threading.Lock()
+        self._file     = _open(path, 'wb')
+        self._file.write(json.dumps({'version': FORMAT_VERSION, 'started': self.started}) + "\n")
+
+    def record(self, method_type, method_name, url, data, response, started, duration, error):
+        """ Append one call, the signature request_wrapper.set_recorder expects """
+        parsed = urlparse(url)
+        path   = parsed.path + ("?" + parsed.query if parsed.query else "")
+        line   = json.dumps([round((started - self.started) * 1000, 1), round(duration * 1000, 1),
+                             method_type, method_name, path, data,
+                             getattr(response, 'status_code', None),
+                             getattr(response, 'content', None) if self.responses else None,
+                             error.__class__.__name__ if error is not None else None],
+                            separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + "\n")
+            self.count += 1
+            if self.count % FLUSH_EVERY == 0:
+                self._file.flush()
+
+    def close(self):
+        """ Write what is buffered and close the log """
+        with self._lock:
+            self._file.close()
+
+def load(path):
+    """ Read a log
+
+    :rtype: tuple
+    :returns: (header dict, list of Call ordered by offset, in seconds)
+    """
+    with _open(path, 'rb') as log:
+        lines = iter(log)
+        try:
+            header = json.loads(next(lines))
+        except (StopIteration, ValueError):
+            raise TrafficException("%s is not a traffic log" % path)
+        if header.get('version') != FORMAT_VERSION:
+            raise TrafficException("%s has version %s, expected %s" % (path, header.get('version'),
+                                                                       FORMAT_VERSION))
+        calls = []
+        for line in lines:
+            offset, duration, method, template, call_path, body, status, response, error = json.loads(line)
+            calls.append(Call(offset / 1000.0, duration / 1000.0, method, template, call_path, body, status,
+                              response, error))
+    calls.sort(key=lambda call: call.offset)
+    return header, calls
+
+def _percentile(values, fraction):
+    """ The value below which `fraction` of the sorted values fall """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def _summary(durations, span, errors):
+    """ Throughput and latency of a set of calls """
+    durations = sorted(durations)
+    return {
+        'calls'     : len(durations),
+        'errors'    : errors,
+        'seconds'   : span,
+        'throughput': len(durations) / span if span > 0 else 0.0,
+        'mean'      : sum(durations) / len(durations) if durations else 0.0,
+        'p50'       : _percentile(durations, 0.5),
+        'p95'       : _percentile(durations, 0.95),
+        'max'       : durations[-1] if durations else 0.0
+    }
+
+class ReplayReport(object):
+    """ How a replay compares with its recording """
+
+    def __init__(self, calls, outcomes, elapsed, speed):
+        self.speed    = speed
+        self.outcomes = outcomes
+        span          = max(call.offset + call.duration for call in calls) - calls[0].offset if calls else 0.0
+        self.recorded = _summary([call.duration for call in calls], span,
+                                 len([call for call in calls if call.error]))
+        self.replayed = _summary([duration for duration, _ in outcomes], elapsed,
+                                 len([error for _, error in outcomes if error is not None]))
+
+    def deltas(self):
+        """ Relative change of the replay against the recording, throughput scaled by the speed
+
+        :rtype: dict
+        :returns: {'throughput': 0.12, 'mean': -0.3, 'p50': ..., 'p95': ..., 'max': ...}, 0.12 is 12% more
+        """
+        expected = dict(self.recorded)
+        if self.speed:
+            expected['throughput'] *= self.speed
+        return dict((field, (self.replayed[field] - expected[field]) / expected[field] if expected[field]
+                     else 0.0) for field in ('throughput', 'mean', 'p50', 'p95', 'max'))
+
+    def as_dict(self):
+        return {'speed': self.speed, 'recorded': self.recorded, 'replayed': self.replayed,
+                'deltas': self.deltas()}
+
+    def format(self):
+        """ The report as a small table """
+        deltas = self.deltas()
+        lines  = ["%-12s %12s %12s %8s" % ("", "recorded", "replayed", "delta")]
+        lines.append("%-12s %12d %12d" % ("calls", self.recorded['calls'], self.replayed['calls']))
+        lines.append("%-12s %12d %12d" % ("errors", self.recorded['errors'], self.replayed['errors']))
+        lines.append("%-12s %12.1f %12.1f %+7.0f%%" % ("calls/s", self.recorded['throughput'],
+                                                      self.replayed['throughput'],
+                                                      deltas['throughput'] * 100))
+        for field in ('mean', 'p50', 'p95', 'max'):
+            lines.append("%-12s %12.1f %12.1f %+7.0f%%" % ("%s ms" % field, self.recorded[field] * 1000,
+                                                          self.replayed[field] * 1000, deltas[field] * 100))
+        return "\n".join(lines)
+
+def _replay_call(url, call):
+    """ Send one recorded call to the bridge at url, returns (duration, error) """
+    started = time.time()
+    try:
+        json_rpc_call(url, call.method, call.template, json.loads(call.body or "{}"), {},
+                      base_url_overide=url + call.path)
+        error = None
+    except Exception as exc:
+        error = exc
+    return time.time() - started, error
+
+def replay(path, url, speed=1.0, workers=REPLAY_WORKERS):
+    """ Re-issue the calls of a log against the bridge at url
+
+    :param str path: the log written by a TrafficRecorder
+    :param str url: the bridge to replay against, e.g. FakeBridge.url
+    :param float speed: 1 for the recorded pace, 60 for an hour a minute, None for as fast as possible
+    :param int workers: calls that may be in flight at once
+
+    :rtype: ReplayReport
+    """
+    from multiprocessing.pool import ThreadPool
+
+    _, calls = load(path)
+    url      = url.rstrip('/')
+    pool     = ThreadPool(workers)
+    pending  = []
+    begin    = time.time()
+    first    = calls[0].offset if calls else 0.0
+    try:
+        for call in calls:
+            if speed:
+                delay = begin + (call.offset - first) / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            pending.append(pool.apply_async(_replay_call, (url, call)))
+        outcomes = [result.get() for result in pending]
+    finally:
+        pool.close()
+        pool.join()
+
+    return ReplayReport(calls, outcomes, time.time() - begin, speed)
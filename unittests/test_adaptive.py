@@ -0,0 +1,126 @@
+""" Test the adaptive command rate """
+
+import time
+import unittest
+
+import adaptive
+import datastore
+import dr_hue
+import instrumentation
+import outbound
+from fakebridge import FakeBridge
+from ratelimit import RateLimiter, bridge_key, get_rate_limiter
+from request_wrapper import JsonRpcGetException
+
+class AdaptiveRateTests(unittest.TestCase):
+
+    def setUp(self):
+        datastore.setup_database()
+
+    def tearDown(self):
+        adaptive.disable("http://10.0.0.45")
+        datastore.purge()
+
+    def test_aimd(self):
+        """ Test good calls raise the rate step by step and overload halves it, once per cooldown """
+        limiter    = RateLimiter(10)
+        controller = adaptive.AdaptiveRateController(limiter, window=5, increase=1.0, cooldown=2.0)
+
+        for _ in range(10):
+            controller.observe(duration=0.1, now=0.0)
+        self.assertEquals((controller.rate, limiter.rate), (12.0, 12.0))
+
+        internal = JsonRpcGetException("api_failure", errors=[{'type': 901}])
+        self.assertEquals(controller.observe(internal, 0.1, now=10.0), 6.0)
+        self.assertEquals(controller.observe(internal, 0.1, now=11.0), 6.0)
+        self.assertEquals(controller.observe(IOError("timed out"), None, now=12.5), 3.0)
+        self.assertEquals(controller.observe(duration=5.0, now=15.0), 1.5)
+        self.assertEquals(controller.observe(duration=5.0, now=20.0), 1.0)
+
+        # Mistakes in a command say nothing about load
+        invalid = JsonRpcGetException("api_failure", errors=[{'type': 7}])
+        for _ in range(5):
+            controller.observe(invalid, 0.1, now=30.0)
+        self.assertEquals((controller.rate, controller.cuts), (1.0, 4))
+
+    def test_hook_and_persistence(self):
+        """ Test calls reach the bridge's controller and the rate it learned survives a restart """
+        controller = adaptive.enable("http://10.0.0.45", rate=4.0, window=2)
+        self.assertTrue(instrumentation.ENABLED)
+
+        for _ in range(4):
+            info = instrumentation.start_call("PUT", "lights/<id>/state", "10.0.0.45", 12)
+            instrumentation.finish_call(info)
+        self.assertEquals(controller.rate, 5.0)
+        self.assertEquals(get_rate_limiter("http://10.0.0.45").rate, 5.0)
+        self.assertEquals(adaptive.get_rates(), {'10.0.0.45': 5.0})
+
+        adaptive.disable("http://10.0.0.45")
+        self.assertFalse(instrumentation.ENABLED)
+        self.assertEquals(datastore.get_bridge_setting("10.0.0.45", adaptive.SETTING_NAME), 5.0)
+
+        self.assertEquals(adaptive.enable("http://10.0.0.45").rate, 5.0)
+
+    def test_direct_calls_are_throttled(self):
+        """ Test a plain set_light_state waits for the rate the bridge was cut to """
+        bridge = FakeBridge(lights=1).start()
+        try:
+            busy   = [True]
+            handle = bridge.handle
+
+            def overloaded(method, parts, body):
+                if method == "PUT" and busy[0]:
+                    busy[0] = False
+                    return [{'error': {'type': 901, 'address': "/lights/1/state", 'description': "busy"}}]
+                return handle(method, parts, body)
+            bridge.handle = overloaded
+
+            controller = adaptive.enable(bridge.url, rate=20.0, persist=False, decrease=0.1)
+            self.assertTrue(outbound.queue_for(bridge_key(bridge.url)) is not None)
+            self.assertRaises(JsonRpcGetException, dr_hue.set_light_state, bridge.url, 1, "user",
+                              {'on': True})
+            self.assertEquals(controller.rate, 2.0)
+
+            start = time.time()
+            for _ in range(5):
+                dr_hue.set_light_state(bridge.url, 1, "user", {'on': True})
+            self.assertTrue(time.time() - start >= 1.2, time.time() - start)
+
+            # Once disabled the queue is let go like any other idle one
+            queue = outbound.queue_for(bridge_key(bridge.url))
+            self.assertFalse(queue.idle(timeout=0))
+            adaptive.disable(bridge.url)
+            self.assertTrue(queue.idle(timeout=0))
+        finally:
+            adaptive.disable(bridge.url)
+            bridge.stop()
+
+    def test_failed_save(self):
+        """ Test saving happens off the calls and a rate that could not be saved is reported """
+        saved     = []
+        persister = adaptive._Persister("10.0.0.45", interval=0.05)
+        setting   = datastore.set_bridge_setting
+
+        def broken(bridge, name, value):
+            saved.append(value)
+            raise IOError("disk full")
+        datastore.set_bridge_setting = broken
+        try:
+            persister(3.0)
+            self.assertEquals(persister.pending, 3.0)
+            time.sleep(0.3)
+            self.assertTrue(len(saved) > 1)
+            self.assertEquals(persister.pending, 3.0)
+            self.assertRaises(IOError, persister.stop)
+        finally:
+            datastore.set_bridge_setting = setting
+
+        persister.flush()
+        self.assertEquals(datastore.get_bridge_setting("10.0.0.45", adaptive.SETTING_NAME), 3.0)
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+""" Test whole bridge and whole group commands go out as group actions """
+
+import unittest
+import dr_hue
+from request_wrapper import JsonRpcGetException
+
+class AllLightsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.calls    = []
+        self.original = {}
+        self.lights   = {"1": {"state": {"on": True, "bri": 10}},
+                         "2": {"state": {"on": True, "bri": 10}},
+                         "3": {"state": {"on": True, "bri": 10}}}
+        self.groups   = {"1": {"name": "Upstairs", "lights": ["1", "2"]}}
+        self.missed   = set()
+        self.refuse   = None
+        self.unread   = False
+
+        def get_full_state(url, username):
+            self.calls.append(('get_full_state',))
+            if self.unread:
+                raise JsonRpcGetException("internal error", errors=[{'type': 901}])
+            return {'lights': self.lights, 'groups': self.groups}
+
+        def get_all_groups(url, username):
+            self.calls.append(('get_all_groups',))
+            return self.groups
+
+        def get_all_lights(url, username):
+            self.calls.append(('get_all_lights',))
+            return dict((light_id, {'name': light_id}) for light_id in self.lights)
+
+        def set_group_state(url, group_id, username, params):
+            self.calls.append(('set_group_state', group_id, params))
+            if self.refuse is not None:
+                raise JsonRpcGetException("refused", errors=self.refuse)
+            members = self.lights.keys() if group_id == "0" else self.groups[group_id]['lights']
+            for light_id in members:
+                if light_id not in self.missed:
+                    self.lights[light_id]['state'].update(params)
+            return [{"success": {"/groups/%s/action/on" % group_id: params.get('on')}}]
+
+        def set_light_state(url, light_id, username, params):
+            self.calls.append(('set_light_state', light_id, params))
+            self.lights[light_id]['state'].update(params)
+            return [{"success": {"/lights/%s/state/on" % light_id: params.get('on')}}]
+
+        for func in (get_full_state, get_all_groups, get_all_lights, set_group_state, set_light_state):
+            self.original[func.__name__] = getattr(dr_hue, func.__name__)
+            setattr(dr_hue, func.__name__, func)
+
+    def tearDown(self):
+        for name, func in self.original.items():
+            setattr(dr_hue, name, func)
+
+    def test_all_lights_off_is_one_command(self):
+        """ Test turning everything off is a single group 0 command """
+        sent = dr_hue.turn_all_lights_off("http://10.0.0.2", "user")
+        self.assertEquals(self.calls, [('set_group_state', '0', {'on': False})])
+        self.assertEquals(sent, {'group': '0', 'fallback': []})
+
+    def test_verify_falls_back_for_missed_lights(self):
+        """ Test only the lights a verification read shows unchanged are set one by one """
+        self.missed.add("3")
+        sent = dr_hue.turn_all_lights_off("http://10.0.0.2", "user", verify=True)
+        self.assertEquals(sent, {'group': '0', 'fallback': ['3'], 'verified': True})
+        self.assertEquals(self.calls[-1], ('set_light_state', '3', {'on': False}))
+        self.assertFalse(any(light['state']['on'] for light in self.lights.values()))
+
+    def test_failed_verify_read(self):
+        """ Test a verification read that fails is reported and resends nothing """
+        self.unread = True
+        sent = dr_hue.turn_all_lights_off("http://10.0.0.2", "user", verify=True)
+        self.assertEquals(sent, {'group': '0', 'fallback': [], 'verified': False})
+        self.assertEquals(self.calls, [('set_group_state', '0', {'on': False}), ('get_full_state',)])
+
+    def test_group_matching_lights(self):
+        """ Test a set of lights that is exactly a group uses it, any other set goes light by light """
+        sent = dr_hue.set_lights_state("http://10.0.0.2", "user", {'bri': 200}, light_ids=[2, 1])
+        self.assertEquals(sent, {'group': '1', 'fallback': []})
+        self.assertEquals(self.calls[-1], ('set_group_state', '1', {'bri': 200}))
+
+        del self.calls[:]
+        sent = dr_hue.set_lights_state("http://10.0.0.2", "user", {'bri': 50}, light_ids=[1, 3])
+        self.assertEquals(sent, {'group': None, 'fallback': ['1', '3']})
+        self.assertEquals([call[0] for call in self.calls],
+                          ['get_all_groups', 'get_all_lights', 'set_light_state', 'set_light_state'])
+
+        del self.calls[:]
+        sent = dr_hue.set_lights_state("http://10.0.0.2", "user", {'on': False}, light_ids=[3, 2, 1])
+        self.assertEquals(sent, {'group': '0', 'fallback': []})
+        self.assertFalse('get_full_state' in [call[0] for call in self.calls])
+
+    def test_failed_group_command(self):
+        """ Test every light is set one by one when the group command is refused """
+        self.refuse = []
+        sent = dr_hue.turn_all_lights_on("http://10.0.0.2", "user")
+        self.assertEquals(sent['fallback'], ['1', '2', '3'])
+        self.assertEquals(len([call for call in self.calls if call[0] == 'set_light_state']), 3)
+
+    def test_partial_group_errors(self):
+        """ Test only the lights a group error names are resent, and an attribute error resends nothing """
+        self.refuse = [{'type': 201, 'address': "/lights/2/state/bri", 'description': "device is off"}]
+        sent = dr_hue.set_lights_state("http://10.0.0.2", "user", {'on': True, 'bri': 200}, light_ids=[1, 2])
+        self.assertEquals(sent, {'group': '1', 'fallback': ['2']})
+        self.assertEquals(self.calls[-1], ('set_light_state', '2', {'on': True, 'bri': 200}))
+
+        del self.calls[:]
+        self.refuse = [{'type': 7, 'address': "/groups/0/action/bri", 'description': "invalid value"}]
+        sent = dr_hue.set_lights_state("http://10.0.0.2", "user", {'on': True, 'bri': 900})
+        self.assertEquals(sent, {'group': '0', 'fallback': []})
+        self.assertFalse('set_light_state' in [call[0] for call in self.calls])
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+""" Test batching of light and group changes """
+
+import unittest
+import dr_hue
+from batch import BatchFlushException, light_batch
+
+class BatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.calls    = []
+        self.original = (dr_hue.set_light_state, dr_hue.set_group_state)
+
+        dr_hue.set_light_state = lambda url, light_id, username, params: \
+            self.calls.append(('lights', light_id, params))
+        dr_hue.set_group_state = lambda url, group_id, username, params: \
+            self.calls.append(('groups', group_id, params))
+
+    def tearDown(self):
+        dr_hue.set_light_state, dr_hue.set_group_state = self.original
+
+    def test_merged_bodies(self):
+        """ Test changes are merged into one call per target, groups first """
+        with light_batch("http://10.0.0.2", "user") as b:
+            b.turn_light_on(1)
+            b.set_light_brightness(1, 200)
+            b.set_light_hue(1, 50000)
+            b.set_light_brightness(2, 100)
+            b.turn_group_off(3)
+            b.set_light(2, bri=120)
+            self.assertEquals(len(b), 3)
+            self.assertEquals(self.calls, [])
+
+        self.assertEquals(self.calls, [('groups', '3', {'on': False}),
+                                       ('lights', '1', {'on': True, 'bri': 200, 'hue': 50000}),
+                                       ('lights', '2', {'bri': 120})])
+
+    def test_nothing_sent_on_error(self):
+        """ Test an exception inside the block discards the batch """
+        with self.assertRaises(ValueError):
+            with light_batch("http://10.0.0.2", "user") as b:
+                b.turn_light_on(1)
+                raise ValueError("abort")
+
+        self.assertEquals(self.calls, [])
+
+    def test_failed_flush(self):
+        """ Test a failed call reports what was sent and keeps the rest for another flush """
+        failing = set(['2'])
+
+        def set_light_state(url, light_id, username, params):
+            if light_id in failing:
+                raise IOError("timed out")
+            self.calls.append(('lights', light_id, params))
+        dr_hue.set_light_state = set_light_state
+
+        with self.assertRaises(BatchFlushException) as raised:
+            with light_batch("http://10.0.0.2", "user") as b:
+                b.turn_group_off(3)
+                b.turn_light_on(1)
+                b.set_light_brightness(2, 100)
+                b.turn_light_on(4)
+
+        error = raised.exception
+        self.assertEquals(error.sent.keys(), [('groups', '3'), ('lights', '1')])
+        self.assertEquals(error.failed, ('lights', '2'))
+        self.assertEquals(error.pending.keys(), [('lights', '2'), ('lights', '4')])
+        self.assertTrue(isinstance(error.error, IOError))
+        self.assertEquals(len(b), 2)
+
+        failing.clear()
+        self.assertEquals(b.flush().keys(), [('lights', '2'), ('lights', '4')])
+        self.assertEquals(self.calls[-2:], [('lights', '2', {'bri': 100}), ('lights', '4', {'on': True})])
+        self.assertEquals(len(b), 0)
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+""" Test the Bridge/Light/Group object model """
+
+import unittest
+import dr_hue
+from bridge import Bridge, Light, _BridgeResource
+
+LIGHTS = {
+    "1": {"name": "Bedroom", "state": {"on": False, "bri": 10, "hue": 100, "sat": 254}},
+    "2": {"name": "Kitchen", "state": {"on": True, "bri": 254, "hue": 200, "sat": 254}}
+}
+
+class BridgeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.calls    = []
+        self.original = {}
+
+        def get_all_lights(url, username):
+            self.calls.append(('get_all_lights',))
+            return dict((key, {'name': value['name']}) for key, value in LIGHTS.items())
+
+        def get_light_attr(url, light_id, username):
+            self.calls.append(('get_light_attr', light_id))
+            return {'name': LIGHTS[light_id]['name'], 'state': dict(LIGHTS[light_id]['state'])}
+
+        def set_light_state(url, light_id, username, params):
+            self.calls.append(('set_light_state', light_id, params))
+            return [{"success": {"/lights/%s/state/%s" % (light_id, key): value}}
+                    for key, value in params.items()]
+
+        for func in (get_all_lights, get_light_attr, set_light_state):
+            self.original[func.__name__] = getattr(dr_hue, func.__name__)
+            setattr(dr_hue, func.__name__, func)
+
+        self.bridge = Bridge("http://10.0.0.2", "user")
+
+    def tearDown(self):
+        for name, func in self.original.items():
+            setattr(dr_hue, name, func)
+
+    def test_lazy_loading(self):
+        """ Test attributes are only fetched once, on first access """
+        light = self.bridge.light(1)
+        self.assertEquals(self.calls, [])
+
+        self.assertEquals(light.bri, 10)
+        self.assertEquals(light.hue, 100)
+        self.assertEquals(light.name, "Bedroom")
+        self.assertEquals(self.calls, [('get_light_attr', '1')])
+
+    def test_listing_seeds_names(self):
+        """ Test the light listing fills in names without per light calls """
+        lights = self.bridge.lights
+        self.assertEquals(sorted(lights.keys()), ["1", "2"])
+        self.assertEquals(lights["2"].name, "Kitchen")
+        self.assertEquals(self.calls, [('get_all_lights',)])
+
+        self.assertTrue(lights["2"].on)
+        self.assertEquals(self.calls[-1], ('get_light_attr', '2'))
+
+    def test_flush_batches_changes(self):
+        """ Test several setters end up in a single set_light_state call """
+        light     = self.bridge.light(1)
+        light.on  = True
+        light.bri = 200
+        light.set(hue=50000)
+
+        self.assertTrue(light.dirty)
+        self.assertEquals(light.bri, 200)
+        self.assertEquals(self.calls, [])
+
+        self.bridge.flush()
+        self.assertEquals(self.calls, [('set_light_state', '1', {'on': True, 'bri': 200, 'hue': 50000})])
+        self.assertFalse(light.dirty)
+        self.assertEquals(self.bridge.flush(), {})
+
+        # The light was never loaded, what was sent is not passed off as its full state
+        self.assertEquals(light.state, {'on': False, 'bri': 10, 'hue': 100, 'sat': 254})
+        self.assertEquals(self.calls[-1], ('get_light_attr', '1'))
+
+        # Once loaded, what was sent is cached and does not need a fetch
+        light.bri = 30
+        light.flush()
+        self.assertEquals(light.bri, 30)
+        self.assertEquals(light.sat, 254)
+        self.assertEquals(len(self.calls), 3)
+
+    def test_overrides(self):
+        """ Test resources have to say how they are fetched and sent """
+        self.assertRaises(TypeError, _BridgeResource, self.bridge, 1)
+
+        class Unsendable(_BridgeResource):
+            __slots__ = ()
+            _section  = 'state'
+
+            def _fetch(self):
+                return {'state': {}}
+
+        self.assertRaises(TypeError, Unsendable, self.bridge, 1)
+        self.assertTrue(isinstance(Light(self.bridge, 1), _BridgeResource))
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+""" Test the GET response cache """
+
+import unittest
+
+import dr_hue
+import request_wrapper
+from cache      import DEFAULT_TTLS, ResponseCache
+from fakebridge import FakeBridge
+
+class ResponseCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.bridge = FakeBridge(lights=3).start()
+        ttls        = dict(DEFAULT_TTLS)
+        del ttls['config']
+        self.cache  = ResponseCache(ttls=ttls)
+        request_wrapper.set_cache(self.cache)
+
+    def tearDown(self):
+        request_wrapper.set_cache(None)
+        self.bridge.stop()
+
+    def test_hits_and_invalidation(self):
+        """ Test repeated reads are served from memory until a write to the same resource """
+        url = self.bridge.url
+        first = dr_hue.get_light_attr(url, 1, "user")
+        first['name'] = "changed by the caller"
+        self.assertEquals(dr_hue.get_light_attr(url, 1, "user")['name'], "Hue Lamp 1")
+        dr_hue.get_light_attr(url, 2, "user")
+        dr_hue.get_all_lights(url, "user")
+        dr_hue.get_configuration(url, "user")
+        dr_hue.get_configuration(url, "user")
+        self.assertEquals(self.bridge.requests['GET'], 5)
+
+        dr_hue.set_light_state(url, 1, "user", {'on': True})
+        self.assertTrue(dr_hue.get_light_attr(url, 1, "user")['state']['on'])
+        dr_hue.get_light_attr(url, 2, "user")
+        dr_hue.get_all_lights(url, "user")
+        self.assertEquals(self.bridge.requests['GET'], 7)
+
+        # A group action changes lights the light urls do not mention
+        dr_hue.set_group_state(url, 0, "user", {'bri': 10})
+        self.assertEquals(dr_hue.get_light_attr(url, 2, "user")['state']['bri'], 10)
+
+        # And a light write changes the groups it is in
+        self.bridge.state['groups']['1'] = {'name': "Desk", 'lights': ["1"], 'action': {'on': False}}
+        dr_hue.get_group_attributes(url, 1, "user")
+        dr_hue.get_group_attributes(url, 1, "user")
+        self.assertEquals(self.bridge.requests['GET'], 9)
+        dr_hue.set_light_state(url, 1, "user", {'on': True})
+        self.bridge.state['groups']['1']['action']['on'] = True
+        self.assertTrue(dr_hue.get_group_attributes(url, 1, "user")['action']['on'])
+        self.assertEquals(self.bridge.requests['GET'], 10)
+
+        stats = self.cache.stats()
+        self.assertEquals((stats['hits'], stats['misses']), (3, 8))
+        self.assertEquals(stats['endpoints']['lights/<id>'], {'hits': 2, 'misses': 4})
+        self.assertFalse('config' in stats['endpoints'])
+
+    def test_eviction_and_expiry(self):
+        """ Test the least recently used responses go first and stale ones are not served """
+        cache = ResponseCache(max_bytes=3 * 300, ttls={'lights/<id>': 10})
+        for light_id in range(1, 4):
+            url = "http://10.0.0.3/api/user/lights/%s" % light_id
+            cache.store('lights/<id>', url, '{"id":%s}' % light_id, cache.generation(url), now=0)
+        cache.get('lights/<id>', "http://10.0.0.3/api/user/lights/1", now=1)
+        cache.store('lights/<id>', "http://10.0.0.3/api/user/lights/4", '{"id":4}', 0, now=2)
+
+        self.assertEquals(cache.get('lights/<id>', "http://10.0.0.3/api/user/lights/2", now=3), None)
+        self.assertEquals(cache.get('lights/<id>', "http://10.0.0.3/api/user/lights/1", now=3), {'id': 1})
+        self.assertEquals(cache.get('lights/<id>', "http://10.0.0.3/api/user/lights/4", now=20), None)
+        self.assertEquals((cache.evictions, cache.expirations, len(cache)), (1, 1, 2))
+        self.assertTrue(cache.size <= cache.max_bytes)
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+""" Test the solar calculations and the circadian engine """
+
+import time
+import unittest
+from datetime import date, datetime, timedelta
+
+import circadian
+from fakebridge import FakeBridge
+
+LONDON    = circadian.Site(51.5074, -0.1278, utc_offset=0)
+TROMSO    = circadian.Site(69.65, 18.96, utc_offset=120)
+MIDSUMMER = date(2014, 6, 21)
+
+class SolarTests(unittest.TestCase):
+
+    def assertAround(self, moment, hour, minute, tolerance=3):
+        expected = datetime(moment.year, moment.month, moment.day, hour, minute)
+        self.assertTrue(abs(moment - expected) <= timedelta(minutes=tolerance),
+                        "%s != %s" % (moment, expected))
+
+    def test_sun_times(self):
+        """ Test sunrise, noon and sunset against published times, and the midnight sun """
+        times = circadian.sun_times(LONDON, MIDSUMMER)
+        self.assertAround(times['sunrise'], 3, 43)
+        self.assertAround(times['noon'], 12, 2)
+        self.assertAround(times['sunset'], 20, 21)
+
+        times = circadian.sun_times(LONDON, date(2014, 12, 21))
+        self.assertAround(times['sunrise'], 8, 4)
+        self.assertAround(times['sunset'], 15, 54)
+
+        times = circadian.sun_times(TROMSO, MIDSUMMER)
+        self.assertEquals((times['sunrise'], times['sunset']), (None, None))
+
+        noon = circadian.solar_elevation(LONDON, datetime(2014, 6, 21, 12, 2))
+        self.assertAlmostEqual(noon, 90 - 51.5074 + 23.44, delta=0.1)
+
+    def test_table(self):
+        """ Test the daily table follows the sun, matches solar_elevation and is built once """
+        table = circadian.daily_table(LONDON, MIDSUMMER)
+        self.assertTrue(circadian.daily_table(LONDON, MIDSUMMER) is table)
+        self.assertEquals(len(table.ct), circadian.MINUTES_PER_DAY)
+
+        profile = circadian.DEFAULT_PROFILE
+        self.assertEquals(table.at(0), (profile.ct_night, profile.bri_night))
+        self.assertEquals(table.at(12 * 60 + 2), (profile.ct_day, profile.bri_day))
+        morning = [table.ct[minute] for minute in range(3 * 60, 12 * 60)]
+        self.assertEquals(morning, sorted(morning, reverse=True))
+        self.assertAlmostEqual(table.elevation[17 * 60], circadian.solar_elevation(LONDON,
+                                                                                  datetime(2014, 6, 21, 17)),
+                               delta=0.01)
+
+class EngineTests(unittest.TestCase):
+
+    def test_thresholds(self):
+        """ Test zones are only sent when their target moved far enough, as few commands as possible """
+        bridge = FakeBridge(lights=4).start()
+        try:
+            bridge.state['groups']['1'] = {'name': "Desk", 'lights': ["1", "2"], 'action': {}}
+            zones  = [circadian.Zone("all"), circadian.Zone("desk", light_ids=[2, 1]),
+                      circadian.Zone("reading", light_ids=[3])]
+            engine = circadian.CircadianEngine(bridge.url, "user", LONDON, zones)
+
+            sent = engine.step(datetime(2014, 6, 21, 12))
+            self.assertEquals(sorted(sent), ["all", "desk", "reading"])
+            self.assertEquals([zone.group_id for zone in zones], ["0", "1", None])
+            self.assertEquals(engine.commands, 3)
+            self.assertEquals(bridge.state['lights']['3']['state']['ct'], sent['reading'][0])
+
+            self.assertEquals(engine.step(datetime(2014, 6, 21, 12, 30)), {})
+            self.assertEquals(engine.commands, 3)
+
+            # Through the evening every zone moves, but far from every minute
+            commands = engine.commands
+            moment   = datetime(2014, 6, 21, 18)
+            while moment < datetime(2014, 6, 21, 22):
+                engine.step(moment)
+                moment += timedelta(minutes=1)
+            steps = (engine.commands - commands) / 3
+            self.assertTrue(5 < steps < 60, steps)
+            self.assertEquals(bridge.state['lights']['4']['state']['ct'], circadian.DEFAULT_PROFILE.ct_night)
+        finally:
+            bridge.stop()
+
+    def test_failing_zone(self):
+        """ Test a zone the bridge rejects is reported and retried, the others and lights that are off
+        are not held up by it """
+        bridge = FakeBridge(lights=4).start()
+        try:
+            busy   = [True]
+            handle = bridge.handle
+
+            def rejecting(method, parts, body):
+                if method == "PUT" and parts[:2] == ['lights', '3']:
+                    return [{'error': {'type': 201, 'address': "/lights/3/state/ct", 'description': "off"}}]
+                if method == "PUT" and parts[:2] == ['lights', '4'] and busy[0]:
+                    return [{'error': {'type': 901, 'address': "/lights/4/state", 'description': "busy"}}]
+                return handle(method, parts, body)
+            bridge.handle = rejecting
+
+            zones  = [circadian.Zone("off", light_ids=[3]), circadian.Zone("broken", light_ids=[4]),
+                      circadian.Zone("fine", light_ids=[1])]
+            engine = circadian.CircadianEngine(bridge.url, "user", LONDON, zones)
+
+            sent = engine.step(datetime(2014, 6, 21, 12))
+            self.assertEquals(sorted(sent), ["fine", "off"])
+            self.assertEquals(engine.errors['broken'].error_types, [901])
+            self.assertEquals(zones[1].sent, None)
+
+            busy[0] = False
+            self.assertEquals(sorted(engine.step(datetime(2014, 6, 21, 12, 1))), ["broken"])
+            self.assertEquals(engine.errors, {})
+            self.assertEquals(bridge.state['lights']['4']['state']['ct'], sent['fine'][0])
+        finally:
+            bridge.stop()
+
+    def test_start(self):
+        """ Test only the first step of a started engine sends every zone, even when it fails """
+        engine = circadian.CircadianEngine("http://10.0.0.1", "user", LONDON, [circadian.Zone("all")])
+        forced = []
+
+        def step(now=None, force=False):
+            forced.append(force)
+            raise IOError("bridge away")
+        engine.step = step
+        engine.start(interval=0.01)
+        try:
+            deadline = time.time() + 5
+            while len(forced) < 3 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            engine.stop()
+        self.assertEquals(forced[:3], [True, False, False])
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
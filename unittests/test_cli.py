@@ -0,0 +1,101 @@
+""" Test the command line interface and its daemon """
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+
+import cli
+from fakebridge import FakeBridge
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class CliTests(unittest.TestCase):
+
+    def setUp(self):
+        self.bridge    = FakeBridge(lights=3).start()
+        self.directory = tempfile.mkdtemp()
+        self.socket    = os.path.join(self.directory, "dr_hue.sock")
+
+    def tearDown(self):
+        self.bridge.stop()
+        shutil.rmtree(self.directory)
+
+    def main(self, *argv):
+        """ Run cli.main, returns the exit code and what it printed """
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            code = cli.main(['--url', self.bridge.url, '--username', "user", '--socket', self.socket] +
+                            list(argv))
+            return code, sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+    def test_parsing(self):
+        """ Test the arguments of a command and its key=value changes """
+        argv = ['--url', "http://10.0.0.2", 'lights', 'set', '1', '2', 'bri=200']
+        args = cli.build_parser().parse_args(argv)
+        self.assertEquals((args.url, args.area, args.action, args.ids), ("http://10.0.0.2", 'lights', 'set',
+                                                                         ['1', '2', 'bri=200']))
+        self.assertEquals(cli._changes(['bri=200', 'on=true', 'name=Desk lamp', 'xy=[0.3,0.4]']),
+                          {'bri': 200, 'on': True, 'name': "Desk lamp", 'xy': [0.3, 0.4]})
+
+        self.assertRaises(cli.CliException, cli._changes, ['bri'])
+        self.assertRaises(cli.CliException, cli.build_parser().parse_args, ['lights', 'dim'])
+        self.assertRaises(cli.CliException, cli.execute, ['daemon'])
+        self.assertEquals(self.main('lights', 'set', '1')[0], 2)
+
+    def test_all_lights(self):
+        """ Test `lights on` without ids is one group 0 command """
+        code, printed, _ = self.main('--no-daemon', 'lights', 'on')
+        self.assertEquals(code, 0)
+        self.assertTrue("through group 0" in printed, printed)
+        self.assertEquals(self.bridge.requests['PUT'], 1)
+        self.assertTrue(all(light['state']['on'] for light in self.bridge.state['lights'].values()))
+
+    def test_daemon(self):
+        """ Test commands are forwarded to a running daemon, which cleans up its socket when stopped """
+        env    = dict(os.environ, DR_HUE_URL=self.bridge.url, DR_HUE_USERNAME="user")
+        daemon = subprocess.Popen([sys.executable, "cli.py", '--socket', self.socket, 'daemon'], cwd=ROOT,
+                                  env=env)
+        try:
+            deadline = time.time() + 10
+            while not os.path.exists(self.socket) and time.time() < deadline:
+                time.sleep(0.05)
+
+            reply = cli.forward(self.socket, ['lights', 'on', '2'])
+            self.assertEquals(reply, {'ok': True, 'result': "1 lights updated"})
+            self.assertTrue(self.bridge.state['lights']['2']['state']['on'])
+            self.assertEquals(cli.forward(self.socket, ['lights', 'set', '2'])['ok'], False)
+
+            code, printed, _ = self.main('lights', 'off', '2')
+            self.assertEquals((code, printed), (0, '"1 lights updated"\n'))
+            self.assertFalse(self.bridge.state['lights']['2']['state']['on'])
+        finally:
+            daemon.terminate()
+            daemon.wait()
+        self.assertFalse(os.path.exists(self.socket))
+
+    def test_stale_socket(self):
+        """ Test a socket file nobody listens on is passed over for a direct call """
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.socket)
+        stale.close()
+        self.assertEquals(cli.forward(self.socket, ['lights', 'on', '3']), None)
+
+        code, printed, _ = self.main('lights', 'on', '3')
+        self.assertEquals((code, printed), (0, '"1 lights updated"\n'))
+        self.assertTrue(self.bridge.state['lights']['3']['state']['on'])
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
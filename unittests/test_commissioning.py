@@ -0,0 +1,110 @@
+""" Test commissioning new lights on many bridges """
+
+import threading
+import unittest
+
+import commissioning
+import datastore
+import dr_hue
+
+class CommissioningTests(unittest.TestCase):
+
+    def setUp(self):
+        self.original = {}
+        self.lock     = threading.Lock()
+        self.polls    = {}
+        self.renamed  = []
+        self.taken    = set()
+
+        # Bridge .2 finishes its search on the third poll, bridge .3 never does
+        def search_for_new_lights(url, username):
+            return [{"success": {"/lights": "Searching for new devices"}}]
+
+        def get_new_lights(url, username):
+            with self.lock:
+                self.polls[url] = self.polls.get(url, 0) + 1
+                if url.endswith(".2") and self.polls[url] >= 3:
+                    return {"7": {"name": "Hue Lamp 7"}, "8": {"name": "Hue Lamp 8"},
+                            "lastscan": "2013-10-01T12:00:00"}
+                return {"lastscan": "active"}
+
+        # The bridge makes taken names unique by adding " 1"
+        def rename_light(url, light_id, light_name, username):
+            with self.lock:
+                self.renamed.append((url, light_id, light_name))
+            given = light_name + " 1" if light_name in self.taken else light_name
+            return [{"success": {"/lights/%s/name" % light_id: given}}]
+
+        for func in (search_for_new_lights, get_new_lights, rename_light):
+            self.original[func.__name__] = getattr(dr_hue, func.__name__)
+            setattr(dr_hue, func.__name__, func)
+
+    def tearDown(self):
+        for name, func in self.original.items():
+            setattr(dr_hue, name, func)
+
+    def test_commissioning(self):
+        """ Test bridges are polled until their search is over, and new lights are renamed """
+        job = commissioning.start_commissioning([("http://10.0.0.2", "user"), ("http://10.0.0.3", "user")],
+                                                namer=lambda url, light_id, name: "Office %s" % light_id,
+                                                register=False, poll_interval=0.01, max_poll_interval=0.02,
+                                                timeout=0.3)
+        try:
+            job.wait(5)
+            self.fail("Expected the second bridge to time out")
+        except commissioning.CommissioningException as exc:
+            self.assertEquals(exc.errors.keys(), ["http://10.0.0.3"])
+            results = exc.results
+
+        found = results["http://10.0.0.2"]
+        self.assertEquals(found.new_lights, {"7": "Office 7", "8": "Office 8"})
+        self.assertEquals(found.polls, 3)
+        self.assertEquals(sorted(self.renamed), [("http://10.0.0.2", "7", "Office 7"),
+                                                 ("http://10.0.0.2", "8", "Office 8")])
+        self.assertTrue(results["http://10.0.0.3"].polls > 3)
+
+    def test_default_names(self):
+        """ Test lights with the same default name on two bridges are not registered as one light """
+        datastore.setup_database()
+        self.addCleanup(datastore.purge)
+        dr_hue.get_new_lights = lambda url, username: {"1": {"name": "Hue Lamp 1"}, "lastscan": "none"}
+        bridges               = [("http://10.0.0.4", "user"), ("http://10.0.0.5", "user")]
+
+        job = commissioning.start_commissioning(bridges, poll_interval=0.01)
+        with self.assertRaises(commissioning.CommissioningException) as raised:
+            job.wait(5)
+        self.assertEquals(raised.exception.errors.keys(), ["http://10.0.0.5"])
+        self.assertEquals(raised.exception.results["http://10.0.0.5"].unregistered, {"1": "Hue Lamp 1"})
+        self.assertEquals(job.registered, 1)
+        self.assertEquals(datastore.get_lights(), {"Hue Lamp 1": 1})
+
+        # Named apart, both are registered and the first light keeps its row
+        namer   = lambda url, light_id, name: "%s lamp %s" % (url[-1], light_id)
+        results = commissioning.commission(bridges, namer=namer, poll_interval=0.01)
+        self.assertEquals(results["http://10.0.0.5"].unregistered, {})
+        self.assertEquals(datastore.get_lights(), {"4 lamp 1": 1, "5 lamp 1": 1})
+
+    def test_bridge_given_names(self):
+        """ Test lights are registered under the name the bridge gave them, not the one asked for """
+        datastore.setup_database()
+        self.addCleanup(datastore.purge)
+        self.taken = set(["Office 7"])
+
+        results = commissioning.commission([("http://10.0.0.2", "user")], poll_interval=0.01,
+                                           namer=lambda url, light_id, name: "Office %s" % light_id)
+        self.assertEquals(results["http://10.0.0.2"].renamed, {"7": "Office 7 1", "8": "Office 8"})
+        self.assertEquals(datastore.get_lights(), {"Office 7 1": 7, "Office 8": 8})
+        self.assertEquals(commissioning.given_name([{"error": {"type": 7}}], "Desk"), "Desk")
+
+    def test_search_finished(self):
+        """ Test only an active scan counts as still running """
+        self.assertFalse(commissioning.search_finished({"lastscan": "active"}))
+        self.assertTrue(commissioning.search_finished({"lastscan": "none"}))
+        self.assertEquals(commissioning.new_lights({"7": {"name": "a"}, "lastscan": "none"}), {"7": "a"})
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,6 +2,7 @@
 
 import unittest
 from datastore import *
+from multiprocessing.pool import ThreadPool
 
 MAX_LIGHTS=100
 
@@ -25,6 +26,52 @@ class DatastoreTests(unittest.TestCase):
         self.assertEquals(len(added_lights), MAX_LIGHTS)
         self.assertEquals(type(added_lights), dict)
 
+    def test_missing_tables(self):
+        """ Test tables added after the database was made are created when the engine comes up """
+        import datastore
+        BridgeSetting.table.drop(checkfirst=True)
+        Light.table.drop(checkfirst=True)
+        datastore.get_engine().execute("CREATE TABLE %s (id INTEGER PRIMARY KEY, name VARCHAR, "
+                                       "base_id INTEGER, group_id INTEGER)" % Light.table.name)
+        remove_session()
+        datastore._engine = None
+
+        self.assertEquals(get_bridge_setting("10.0.0.2", "rate", 3), 3)
+        set_bridge_setting("10.0.0.2", "rate", 5)
+        self.assertEquals(get_bridge_setting("10.0.0.2", "rate"), 5)
+        self.assertEquals(register_lights([{'name': 'Lamp', 'base_id': '1', 'bridge': "10.0.0.2"}]), [])
+        self.assertEquals(get_lights(), {'Lamp': 1})
+
+    def test_register_lights_by_bridge(self):
+        """ Test lights are registered by bridge and id and a name taken by another light is refused """
+        add_all_lights([{'name': 'Lamp', 'base_id': '1'}])
+        refused = register_lights([{'name': 'Lamp', 'base_id': '1', 'bridge': "10.0.0.2"},
+                                   {'name': 'Lamp', 'base_id': '1', 'bridge': "10.0.0.3"},
+                                   {'name': 'Desk', 'base_id': '2', 'bridge': "10.0.0.3"}])
+        self.assertEquals(refused, [{'name': 'Lamp', 'base_id': '1', 'bridge': "10.0.0.3"}])
+        self.assertEquals(get_lights(), {'Lamp': 1, 'Desk': 2})
+
+        # Renaming a light keeps its row, taking the name of another is refused
+        self.assertEquals(register_lights([{'name': 'Reading', 'base_id': '2', 'bridge': "10.0.0.3"}]), [])
+        self.assertEquals(len(register_lights([{'name': 'Lamp', 'base_id': '2', 'bridge': "10.0.0.3"}])), 1)
+        self.assertEquals(get_lights(), {'Lamp': 1, 'Reading': 2})
+
+        # Each bridge sees its own lights, and those stored before lights had a bridge
+        add_light_to_group({'name': 'Old', 'base_id': '3'}, UNCATEGORIZED)
+        self.assertEquals(get_lights("10.0.0.3"), {'Reading': 2, 'Old': 3})
+        self.assertEquals(get_lights("10.0.0.2"), {'Lamp': 1, 'Old': 3})
+        self.assertEquals(get_lights_in_group(UNCATEGORIZED, "10.0.0.3"), {'Reading': 2, 'Old': 3})
+
+    def test_light_lookup_errors(self):
+        """ Test a missing or ambiguous light or group raises like the query it replaced """
+        add_light_to_group({'name': 'Lamp', 'base_id': '1'}, UNCATEGORIZED)
+        self.assertEquals(get_light_in_group('Lamp', UNCATEGORIZED), {'Lamp': 1})
+
+        self.assertRaises(NoResultFound, get_light_in_group, 'Desk', UNCATEGORIZED)
+        self.assertRaises(NoResultFound, get_light_in_group, 'Lamp', 'Attic')
+        add_all_lights([{'name': 'Lamp', 'base_id': '2'}])
+        self.assertRaises(MultipleResultsFound, get_light_in_group, 'Lamp', UNCATEGORIZED)
+
     def test_storing_lights(self):
         """ Test storing lights """
 
@@ -81,6 +128,55 @@ class DatastoreTests(unittest.TestCase):
         self.assertEquals(len(get_lights_in_group('Group 4')), MAX_LIGHTS)
         self.assertEquals(len(get_lights_in_group('Group 3')), group_three_size)
 
+    def test_concurrent_reads(self):
+        """ Test worker threads can read group membership while another thread writes """
+
+        Group(name='Group 1')
+        add_lights_to_group([{'name':'Light %s' % i, 'base_id':'%s' % i} for i in range(0, 10)], 'Group 1')
+
+        def read(_):
+            try:
+                return len(get_lights_in_group('Group 1'))
+            finally:
+                remove_session()
+
+        pool    = ThreadPool(4)
+        results = pool.map_async(read, range(0, 40))
+        for i in range(10, 20):
+            add_light_to_group({'name':'Light %s' % i, 'base_id':'%s' % i}, 'Group 1')
+        pool.close()
+        pool.join()
+
+        self.assertTrue(all(10 <= count <= 20 for count in results.get()))
+        self.assertEquals(len(get_lights_in_group('Group 1')), 20)
+
+    def test_scenes(self):
+        """ Test storing and replacing scenes """
+
+        states = {'1': {'on': True, 'bri': 200, 'ct': 300}, '2': {'on': False}}
+        save_scene('Movie', states)
+        self.assertEquals(get_scene('Movie'), states)
+
+        save_scene('Movie', {'1': {'on': False}})
+        self.assertEquals(get_scene('Movie'), {'1': {'on': False}})
+        self.assertEquals(get_scenes(), ['Movie'])
+
+        delete_scene('Movie')
+        self.assertEquals(get_scenes(), [])
+        with self.assertRaises(Exception):
+            get_scene('Movie')
+
+    def test_register_lights(self):
+        """ Test registering lights adds new ones and moves known ones """
+
+        Group(name='Office')
+        register_lights([{'name': 'Office 7', 'base_id': '7'}, {'name': 'Office 8', 'base_id': '8'}])
+        self.assertEquals(get_lights_in_group(UNCATEGORIZED), {'Office 7': 7, 'Office 8': 8})
+
+        register_lights([{'name': 'Office 8', 'base_id': '8'}], 'Office')
+        self.assertEquals(get_lights_in_group('Office'), {'Office 8': 8})
+        self.assertEquals(len(get_lights()), 2)
+
 ################################################################################
 # Setup Testcases to run
 ################################################################################
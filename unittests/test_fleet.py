@@ -0,0 +1,70 @@
+""" Test configuration and whitelist maintenance across bridges """
+
+import unittest
+
+import fleet
+import outbound
+from fakebridge import FakeBridge, make_state
+
+def _bridge_state(whitelist, proxyport=0):
+    state = make_state(2)
+    state['config'].update({'utc': "2014-06-01T12:00:00", 'proxyport': proxyport, 'whitelist': whitelist})
+    return state
+
+def _user(name, last_used, created="2013-01-01T00:00:00"):
+    return {'name': name, 'last use date': last_used, 'create date': created}
+
+class FleetTests(unittest.TestCase):
+
+    def setUp(self):
+        self.first  = FakeBridge(state=_bridge_state({
+            'admin'   : _user("maintenance", "2013-01-01T00:00:00"),
+            'phone'   : _user("iPhone Web 1", "2014-05-30T08:00:00"),
+            'old'     : _user("Android", "2013-11-02T10:00:00"),
+            'test'    : _user("test rig 3", "2014-05-31T10:00:00"),
+            'unused'  : _user("Tablet", "none", created="2013-02-01T00:00:00")
+        })).start()
+        self.second = FakeBridge(state=_bridge_state({
+            'admin'   : _user("maintenance", "2014-06-01T11:00:00")
+        }, proxyport=8080)).start()
+        self.bridges = [(self.first.url, "admin"), (self.second.url, "admin"),
+                        ("http://127.0.0.1:9", "admin")]
+
+    def tearDown(self):
+        self.first.stop()
+        self.second.stop()
+
+    def test_dry_run_then_apply(self):
+        """ Test the plan, that a dry run changes nothing and that the plan is applied everywhere """
+        with self.assertRaises(fleet.FleetException) as raised:
+            fleet.maintain(self.bridges, config={'proxyport': 0}, stale_after=90, names=["test rig *"],
+                           dry_run=True)
+        results = raised.exception.results
+
+        self.assertEquals(raised.exception.errors.keys(), ["http://127.0.0.1:9"])
+        self.assertEquals(results[self.first.url].remove, {'old': "Android", 'test': "test rig 3",
+                                                           'unused': "Tablet"})
+        self.assertEquals(results[self.first.url].changes, {})
+        self.assertEquals(results[self.second.url].remove, {})
+        self.assertEquals(results[self.second.url].changes, {'proxyport': 0})
+        self.assertEquals(self.first.requests, {'GET': 1})
+        self.assertEquals(self.second.requests, {'GET': 1})
+
+        report = fleet.format_report(results)
+        self.assertTrue("remove old (Android)" in report)
+        self.assertTrue("would change" in report)
+        self.assertTrue("4 changes on 3 bridges, 1 could not be read" in report)
+
+        results = fleet.maintain(self.bridges[:2], config={'proxyport': 0}, stale_after=90,
+                                 names=["test rig *"], keep=["unused"])
+        self.assertTrue(all(result.applied for result in results.values()))
+        self.assertEquals(sorted(self.first.state['config']['whitelist']), ['admin', 'phone', 'unused'])
+        self.assertEquals(self.second.state['config']['proxyport'], 0)
+        self.assertEquals(self.first.requests['DELETE'], 2)
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+""" Test the local gateway against a mirror and a stubbed bridge """
+
+import json
+import socket
+import threading
+import time
+import unittest
+import urllib2
+
+import gateway
+from mirror import StateMirror
+
+STATE = {
+    'lights': {'1': {'name': 'Bedroom', 'state': {'on': False, 'bri': 10}},
+               '2': {'name': 'Kitchen', 'state': {'on': False, 'bri': 10}}},
+    'groups': {'1': {'name': 'Upstairs', 'lights': ['1'], 'action': {'on': False}}},
+    'config': {'whitelist': {'client': {'name': 'service'}}},
+    'schedules': {}
+}
+
+class GatewayTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sent     = []
+        self.release  = threading.Event()
+        self.original = gateway.json_rpc_call
+        self.interval = gateway.PING_INTERVAL
+
+        # Subscribers that went away are noticed on the next ping
+        gateway.PING_INTERVAL = 0.05
+
+        def json_rpc_call(url, method, path, body, keys):
+            self.release.wait()
+            self.sent.append((method, path, dict(body)))
+            return [{'success': {"/%s/%s" % (path, key): value}} for key, value in body.items()]
+        gateway.json_rpc_call = json_rpc_call
+
+        self.mirror        = StateMirror("http://10.0.0.2", "owner")
+        self.mirror._state = json.loads(json.dumps(STATE))
+        self.events        = []
+        self.mirror.subscribe(self.events.extend)
+
+        self.client = gateway.CoalescingClient("http://10.0.0.2", "owner", mirror=self.mirror)
+        self.server = gateway.GatewayServer(("127.0.0.1", 0), self.mirror, self.client)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base = "http://127.0.0.1:%s" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        gateway.json_rpc_call = self.original
+        gateway.PING_INTERVAL = self.interval
+
+    def request(self, path, body=None, method="GET"):
+        request = urllib2.Request(self.base + path, data=json.dumps(body) if body is not None else None)
+        request.get_method = lambda: method
+        return json.loads(urllib2.urlopen(request).read())
+
+    def test_reads_come_from_the_mirror(self):
+        """ Test reads never reach the bridge, and unknown users and resources get bridge errors """
+        self.assertEquals(self.request("/api/client/lights/2/state"), {'on': False, 'bri': 10})
+        self.assertEquals(self.request("/api/stranger/lights")[0]['error']['type'], 1)
+        self.assertEquals(self.request("/api/client/lights/9")[0]['error']['type'], 3)
+        self.assertEquals(self.sent, [])
+
+    def test_writes_update_the_mirror(self):
+        """ Test a write is sent upstream, folded into the mirror and published """
+        self.release.set()
+        self.request("/api/client/groups/1/action", {'on': True}, method="PUT")
+
+        self.assertEquals(self.sent, [('PUT', 'groups/1/action', {'on': True})])
+        self.assertEquals(self.request("/api/client/lights/1/state/on"), True)
+        self.assertEquals(self.request("/api/client/lights/2/state/on"), False)
+        self.assertTrue({'path': '/lights/1/state/on', 'value': True} in self.events)
+
+    def test_puts_are_coalesced(self):
+        """ Test waiting puts to the same path are merged into one command """
+        # Hold the sender up with a write that is already in flight
+        other = self.client.submit("PUT", "lights/2/state", {'bri': 50})
+        while self.client._queue:
+            time.sleep(0.01)
+
+        first  = self.client.submit("PUT", "lights/1/state", {'on': True})
+        second = self.client.submit("PUT", "lights/1/state", {'bri': 100})
+        third  = self.client.submit("PUT", "lights/1/state", {'bri': 200})
+        self.assertTrue(first is second is third)
+        self.release.set()
+
+        for pending in (first, second, third, other):
+            pending.wait()
+
+        self.assertEquals(self.sent, [('PUT', 'lights/2/state', {'bri': 50}),
+                                      ('PUT', 'lights/1/state', {'on': True, 'bri': 200})])
+        self.assertEquals(self.client.coalesced, 2)
+        self.assertEquals(self.mirror.get('lights/1/state'), {'on': True, 'bri': 200})
+
+    def test_puts_keep_their_order(self):
+        """ Test a put is only merged into the last waiting write, never past another one """
+        other = self.client.submit("PUT", "lights/2/state", {'bri': 50})
+        while self.client._queue:
+            time.sleep(0.01)
+
+        first  = self.client.submit("PUT", "lights/1/state", {'on': True})
+        group  = self.client.submit("PUT", "groups/1/action", {'on': False})
+        second = self.client.submit("PUT", "lights/1/state", {'bri': 200})
+        self.assertFalse(first is second)
+        self.release.set()
+
+        for pending in (other, first, group, second):
+            pending.wait()
+        self.assertEquals([path for _, path, _ in self.sent[1:]],
+                          ['lights/1/state', 'groups/1/action', 'lights/1/state'])
+        self.assertEquals(self.client.coalesced, 0)
+
+    def test_creates_do_not_hold_up_writes(self):
+        """ Test the mirror reload after a create runs beside the writes queued behind it """
+        reloaded = threading.Event()
+        self.mirror.refresh = reloaded.wait
+        self.release.set()
+
+        create = self.client.submit("POST", "groups", {'name': 'Downstairs', 'lights': ['2']})
+        write  = self.client.submit("PUT", "lights/2/state", {'on': True})
+        self.assertTrue(write.done.wait(5))
+        self.assertFalse(create.done.is_set())
+
+        reloaded.set()
+        create.wait()
+        self.assertEquals([method for method, _, _ in self.sent], ['POST', 'PUT'])
+
+    def upgrade(self, path):
+        """ Send a WebSocket handshake to path, returns the reply status and its json body if any """
+        connection = socket.create_connection(self.server.server_address)
+        try:
+            connection.sendall("GET %s HTTP/1.1\r\nHost: gateway\r\nUpgrade: websocket\r\n"
+                               "Connection: Upgrade\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+                               "Sec-WebSocket-Version: 13\r\n\r\n" % path)
+            reply   = connection.makefile('r')
+            status  = int(reply.readline().split()[1])
+            headers = dict(line.strip().lower().split(": ", 1) for line in iter(reply.readline, "\r\n"))
+            length  = int(headers.get('content-length', 0))
+            return status, json.loads(reply.read(length)) if length else None
+        finally:
+            connection.close()
+
+    def test_websocket_whitelist(self):
+        """ Test only whitelisted usernames can subscribe to the changes """
+        self.assertEquals(self.upgrade("/api/client/ws"), (101, None))
+        deadline = time.time() + 5
+        while len(self.mirror._subscribers) > 1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals(len(self.mirror._subscribers), 1)
+        self.assertEquals(self.upgrade("/api/stranger/ws")[1][0]['error']['type'], 1)
+        self.assertEquals(self.upgrade("/ws")[1][0]['error']['type'], 4)
+
+    def test_websocket_frames(self):
+        """ Test the handshake key and frame encoding """
+        self.assertEquals(gateway._websocket_accept("dGhlIHNhbXBsZSBub25jZQ=="),
+                          "s3pPLMBiTxaQ9kYGzzhZRbK+xOo=")
+        self.assertEquals(gateway._websocket_frame("hi"), "\x81\x02hi")
+        self.assertEquals(gateway._websocket_frame("x" * 200)[:4], "\x81\x7e\x00\xc8")
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
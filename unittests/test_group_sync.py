@@ -0,0 +1,167 @@
+""" Test mirroring local groups onto bridge groups """
+
+import unittest
+import datastore
+import dr_hue
+import group_sync
+from request_wrapper import JsonRpcGetException
+
+class GroupSyncTests(unittest.TestCase):
+
+    def setUp(self):
+        self.original = {}
+        self.calls    = []
+        self.groups   = {"1": {"name": "Hallway", "lights": ["1", "2"]},
+                         "2": {"name": "drh Kitchen", "lights": ["3", "4"]},
+                         "3": {"name": "drh Garage", "lights": ["9", "10"]}}
+        self.capacity = group_sync.MAX_GROUPS
+        self.full     = set()     # lights in as many groups as they can be
+        self.local    = {}
+        group_sync.forget_group_ids()
+
+        def get_all_groups(url, username):
+            self.calls.append(('get_all_groups',))
+            return dict((group_id, {'name': attrs['name']}) for group_id, attrs in self.groups.items())
+
+        def get_group_attributes(url, group_id, username):
+            return dict(self.groups[group_id])
+
+        def create_group(url, username, params):
+            self.calls.append(('create', params['name']))
+            if len(self.groups) >= self.capacity:
+                raise JsonRpcGetException("full", errors=[{'type': 301, 'address': '/groups'}])
+            group_id = str(max(int(key) for key in self.groups) + 1)
+            self.groups[group_id] = dict(params)
+            return [{"success": {"id": "/groups/%s" % group_id}}]
+
+        def delete_group(url, username, group_id):
+            self.calls.append(('delete', group_id))
+            del self.groups[group_id]
+            return [{"success": "/groups/%s deleted." % group_id}]
+
+        def set_group_attributes(url, group_id, username, params):
+            self.calls.append(('update', group_id))
+            if self.full & set(params['lights']) - set(self.groups[group_id]['lights']):
+                raise JsonRpcGetException("full", errors=[{'type': 302, 'address': '/groups'}])
+            self.groups[group_id].update(params)
+            return [{"success": {"/groups/%s/lights" % group_id: params['lights']}}]
+
+        def set_group_state(url, group_id, username, params):
+            self.calls.append(('set_group_state', group_id))
+            if group_id not in self.groups:
+                raise JsonRpcGetException("gone", errors=[{'type': 3}])
+            return [{"success": {"/groups/%s/action/on" % group_id: True}}]
+
+        def set_lights_state(url, username, params, light_ids=None):
+            self.calls.append(('set_lights_state', sorted(light_ids)))
+            return {'group': None, 'fallback': light_ids}
+
+        for func in (get_all_groups, get_group_attributes, create_group, delete_group,
+                     set_group_attributes, set_group_state, set_lights_state):
+            self.original[func.__name__] = getattr(dr_hue, func.__name__)
+            setattr(dr_hue, func.__name__, func)
+
+        def get_lights_in_group(group_name, bridge=None):
+            return dict(("Light %s" % light_id, int(light_id)) for light_id in self.local[group_name])
+        self.get_lights_in_group       = datastore.get_lights_in_group
+        datastore.get_lights_in_group = get_lights_in_group
+
+    def tearDown(self):
+        for name, func in self.original.items():
+            setattr(dr_hue, name, func)
+        datastore.get_lights_in_group = self.get_lights_in_group
+
+    def test_sync(self):
+        """ Test managed groups are created, updated and deleted while others are left alone """
+        local  = {"Kitchen": ["3", "4", "5"], "Upstairs": ["6", "7"], "Bedroom": ["6", "7", "8"]}
+        report = group_sync.sync_groups("http://10.0.0.2", "user", groups=local)
+
+        self.assertEquals(report['deleted'], ["Garage"])
+        self.assertEquals(report['updated'], ["Kitchen"])
+        self.assertEquals(sorted(report['created']), ["Bedroom", "Upstairs"])
+        self.assertEquals(self.calls[:4], [('get_all_groups',), ('delete', '3'), ('update', '2'),
+                                           ('create', 'drh Bedroom')])
+        self.assertEquals(self.groups["1"], {"name": "Hallway", "lights": ["1", "2"]})
+
+        report = group_sync.sync_groups("http://10.0.0.2", "user", groups=local)
+        self.assertEquals(sorted(report['unchanged']), ["Bedroom", "Kitchen", "Upstairs"])
+
+        # The ids from the sync are used, the groups are not read again for every command
+        del self.calls[:]
+        group_sync.set_local_group_state("http://10.0.0.2", "user", "Kitchen", {'on': True})
+        group_sync.set_local_group_state("http://10.0.0.2", "user", "Upstairs", {'on': True})
+        self.assertEquals(self.calls, [('set_group_state', '2'), ('set_group_state', '4')])
+
+    def test_skipped_groups(self):
+        """ Test groups the sync skipped are set light by light, never through a bridge group holding
+        other lights """
+        self.full   = set(["5"])
+        self.local  = {"Kitchen": ["3", "4", "5"], "Upstairs one": ["6", "7"], "Upstairs two": ["8", "9"]}
+        original    = group_sync.bridge_group_name
+        group_sync.bridge_group_name = lambda name: original(name)[:12]
+        try:
+            report = group_sync.sync_groups("http://10.0.0.2", "user", groups=self.local)
+            self.assertEquals(sorted(report['skipped']), ["Kitchen", "Upstairs two"])
+
+            del self.calls[:]
+            for name in sorted(self.local):
+                group_sync.set_local_group_state("http://10.0.0.2", "user", name, {'on': True})
+            self.assertEquals(self.calls, [('set_lights_state', [3, 4, 5]), ('set_group_state', '3'),
+                                           ('set_lights_state', [8, 9])])
+
+            # Read back from the bridge, only groups holding their local group's lights are used
+            local_groups            = group_sync.local_groups
+            group_sync.local_groups = lambda min_lights=2, url=None: self.local
+            try:
+                self.assertEquals(group_sync.managed_group_ids("http://10.0.0.2", "user", refresh=True),
+                                  {"Upstairs one": "3"})
+            finally:
+                group_sync.local_groups = local_groups
+        finally:
+            group_sync.bridge_group_name = original
+
+    def test_long_names(self):
+        """ Test long local names starting alike get bridge groups of their own that fit the bridge """
+        first, second = "Upstairs front bedroom ceiling lights", "Upstairs front bedroom reading lamps"
+        self.assertNotEquals(group_sync.bridge_group_name(first), group_sync.bridge_group_name(second))
+        self.assertEquals(len(group_sync.bridge_group_name(first)), group_sync.MAX_NAME_LENGTH)
+        self.assertEquals(group_sync.bridge_group_name(first), group_sync.bridge_group_name(first))
+
+        local  = {first: ["1", "2"], second: ["3", "4"]}
+        report = group_sync.sync_groups("http://10.0.0.2", "user", groups=local)
+        self.assertEquals(sorted(report['created']), sorted(local))
+        report = group_sync.sync_groups("http://10.0.0.2", "user", groups=local)
+        self.assertEquals(sorted(report['unchanged']), sorted(local))
+        self.assertEquals(report['updated'], [])
+
+        # Two names the bridge would see as one are reported rather than fought over
+        original = group_sync.bridge_group_name
+        group_sync.bridge_group_name = lambda name: original(name)[:10]
+        try:
+            report = group_sync.sync_groups("http://10.0.0.2", "user", groups=local, dry_run=True)
+        finally:
+            group_sync.bridge_group_name = original
+        self.assertEquals(report['skipped'].keys(), [second])
+
+    def test_group_table_full(self):
+        """ Test the largest groups get the free slots and the rest are skipped """
+        self.capacity = 3
+        local  = {"Kitchen": ["3", "4"], "Big": ["1", "2", "3", "4"], "Small": ["5", "6"]}
+        report = group_sync.sync_groups("http://10.0.0.2", "user", groups=local)
+
+        self.assertEquals(report['created'].keys(), ["Big"])
+        self.assertEquals(report['skipped'].keys(), ["Small"])
+
+        # The bridge refusing a create stops the rest as well
+        self.capacity = 2
+        self.groups   = {"1": {"name": "Hallway", "lights": ["1", "2"]}}
+        report        = group_sync.sync_groups("http://10.0.0.2", "user", groups=local)
+        self.assertEquals(report['created'], {"Big": "2"})
+        self.assertEquals(sorted(report['skipped']), ["Kitchen", "Small"])
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
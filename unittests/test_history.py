@@ -0,0 +1,73 @@
+""" Test the light state history store """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import history
+
+URL   = "http://10.0.0.2"
+START = 1380000000 // 3600 * 3600
+
+class HistoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.recorder  = history.HistoryRecorder(os.path.join(self.directory, "history.db"), batch_size=10)
+
+        # Two days of a sample a minute for two lights, light 1 on with bri 100 from 18:00 to 23:00
+        for minute in range(0, 2 * 24 * 60):
+            ts     = START + minute * 60
+            hour   = (ts // 3600) % 24
+            lights = {"1": {"state": {"on": 18 <= hour < 23, "bri": 100, "reachable": True}},
+                      "2": {"state": {"on": False, "bri": 10, "reachable": minute % 2 == 0}}}
+            self.recorder.record(URL, lights, ts=ts)
+
+    def tearDown(self):
+        self.recorder.close()
+        shutil.rmtree(self.directory)
+
+    def test_queries_survive_downsampling(self):
+        """ Test on hours and profiles are the same before and after rolling up the raw samples """
+        end     = START + 2 * 86400
+        before  = self.recorder.on_hours(start=START, end=end)
+        profile = self.recorder.brightness_profile(URL, "1", START, end)
+
+        self.assertEquals(before, {("10.0.0.2", "1"): 10.0, ("10.0.0.2", "2"): 0.0})
+        self.assertEquals(profile[20], (100.0, 1.0))
+        self.assertEquals(profile[3], (0.0, 0.0))
+
+        # Roll up the first day only, the queries span both kinds of rows
+        rolled = self.recorder.downsample(now=START + 86400, raw_retention=0)
+        self.assertEquals(rolled, 2 * 24 * 60)
+        self.assertEquals(len(self.recorder.samples(URL, "1", START, end)), 24 * 60)
+
+        self.assertEquals(self.recorder.on_hours(start=START, end=end), before)
+        self.assertEquals(self.recorder.brightness_profile(URL, "1", START, end), profile)
+        self.assertEquals(self.recorder.on_hours(URL, "1", START, START + 86400), {("10.0.0.2", "1"): 5.0})
+
+        # Pruning drops the rolled up day
+        self.assertEquals(self.recorder.prune(now=START + 86400, hourly_retention=0), 2 * 24)
+        self.assertEquals(self.recorder.on_hours(URL, "1", START, end), {("10.0.0.2", "1"): 5.0})
+
+    def test_late_samples(self):
+        """ Test samples recorded for an hour that was already rolled up do not count the hour twice """
+        self.recorder.downsample(now=START + 86400, raw_retention=0)
+        evening = START + (20 - START // 3600 % 24) * 3600
+        self.assertEquals(self.recorder.on_hours(URL, "1", evening, evening + 3600), {("10.0.0.2", "1"): 1.0})
+
+        for second in range(0, 3600, 120):
+            self.recorder.record(URL, {"1": {"state": {"on": second < 1800, "bri": 100}}},
+                                 ts=evening + second + 1)
+        self.assertEquals(self.recorder.on_hours(URL, "1", evening, evening + 3600),
+                          {("10.0.0.2", "1"): 75.0 / 90})
+        self.assertEquals(self.recorder.brightness_profile(URL, "1", evening, evening + 3600)[20],
+                          (100.0, 75.0 / 90))
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+""" Test the request instrumentation counters and hooks """
+
+import unittest
+import instrumentation
+
+class FakeResponse(object):
+    """ Just enough of a requests response for the instrumentation """
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content     = content
+
+class InstrumentationTests(unittest.TestCase):
+
+    def setUp(self):
+        instrumentation.reset_stats()
+
+    def tearDown(self):
+        instrumentation.disable_stats()
+        instrumentation.reset_stats()
+
+    def test_disabled_by_default(self):
+        """ Test that nothing is collected until asked for """
+        self.assertFalse(instrumentation.ENABLED)
+
+    def test_hooks(self):
+        """ Test the pre and post call hooks see the call details """
+        seen = []
+        pre  = lambda info: seen.append(('pre', info.endpoint, info.duration))
+        post = lambda info: seen.append(('post', info.status, info.bytes_received))
+
+        instrumentation.add_pre_call_hook(pre)
+        instrumentation.add_post_call_hook(post)
+        self.assertTrue(instrumentation.ENABLED)
+
+        info = instrumentation.start_call("PUT", "lights/<id>/state", "10.0.0.2", 12)
+        instrumentation.finish_call(info, FakeResponse(200, '[{"success":{}}]'))
+
+        instrumentation.remove_hook(pre)
+        instrumentation.remove_hook(post)
+        self.assertFalse(instrumentation.ENABLED)
+
+        self.assertEquals(seen, [('pre', "lights/<id>/state", None), ('post', 200, 16)])
+
+    def test_stats(self):
+        """ Test the counters and their prometheus rendering """
+        instrumentation.enable_stats()
+
+        for _ in range(3):
+            info = instrumentation.start_call("GET", "lights", "10.0.0.2", 2)
+            instrumentation.finish_call(info, FakeResponse(200, '{}'))
+
+        info = instrumentation.start_call("GET", "lights", "10.0.0.2", 2)
+        instrumentation.finish_call(info, None, Exception("timeout"))
+
+        stats = instrumentation.get_stats()['10.0.0.2']['GET lights']
+        self.assertEquals(stats['count'], 4)
+        self.assertEquals(stats['errors'], 1)
+        self.assertEquals(stats['bytes_sent'], 8)
+        self.assertEquals(stats['bytes_received'], 6)
+        self.assertEquals(stats['buckets'][-1], ('+Inf', 4))
+
+        text = instrumentation.prometheus_text()
+        self.assertTrue('dr_hue_request_duration_seconds_count{bridge="10.0.0.2",method="GET",'
+                        'endpoint="lights"} 4' in text)
+        self.assertTrue('dr_hue_request_errors_total{bridge="10.0.0.2",method="GET",'
+                        'endpoint="lights"} 1' in text)
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+""" Test resolving lights by name """
+
+import threading
+import time
+import unittest
+
+import datastore
+import dr_hue
+from fakebridge import FakeBridge
+from mirror     import StateMirror
+from name_index import NameIndex, NameIndexException, set_light_state_by_name
+
+class NameIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index = NameIndex()
+        self.index.load_bridge("http://10.0.0.1", {'1': {'name': "Lobby 1"}, '2': {'name': "Lobby 2"},
+                                                    '3': {'name': "Kitchen"}})
+        self.index.load_bridge("http://10.0.0.2", {'1': {'name': "kitchen"}, '2': {'name': "Office"}})
+
+    def test_lookups(self):
+        """ Test exact, prefix and fuzzy lookups and both directions """
+        self.assertEquals(self.index.resolve(" lobby  2"), ("10.0.0.1", "2"))
+        self.assertEquals(self.index.name_of("http://10.0.0.1", 2), "Lobby 2")
+        self.assertEquals(self.index.resolve("Kitchen", "http://10.0.0.2"), ("10.0.0.2", "1"))
+
+        with self.assertRaises(NameIndexException) as raised:
+            self.index.resolve("Kitchen")
+        self.assertEquals(raised.exception.matches, [("10.0.0.1", "3"), ("10.0.0.2", "1")])
+
+        with self.assertRaises(NameIndexException) as raised:
+            self.index.resolve("Ofice")
+        self.assertEquals(raised.exception.matches, [(u"office", [("10.0.0.2", "2")])])
+
+        self.assertEquals([name for name, _ in self.index.prefix("lob")], [u"lobby 1", u"lobby 2"])
+        self.assertEquals(self.index.prefix("z"), [])
+
+        self.index.load_bridge("http://10.0.0.1", {'1': {'name': "Lobby 1"}})
+        self.assertEquals(len(self.index), 3)
+        self.assertFalse("Lobby 2" in self.index)
+        self.assertEquals([name for name, _ in self.index.prefix("")], [u"kitchen", u"lobby 1", u"office"])
+
+    def test_incremental(self):
+        """ Test renames and mirror events keep the index current without reloading it """
+        bridge = FakeBridge(lights=2).start()
+        try:
+            index = NameIndex()
+            index.load_bridge(bridge.url, dr_hue.get_all_lights(bridge.url, "user"))
+            index.rename(bridge.url, "user", "1", "Lobby 3")
+            self.assertEquals(index.resolve("lobby 3"), (bridge.url[len("http://"):], "1"))
+            self.assertFalse("Hue Lamp 1" in index)
+
+            set_light_state_by_name(index, bridge.url, "user", "Lobby 3", {'on': True})
+            self.assertTrue(bridge.state['lights']['1']['state']['on'])
+
+            mirror = StateMirror(bridge.url, "user")
+            mirror.refresh()
+            index.follow(mirror)
+            bridge.state['lights']['2']['name'] = "Office"
+            bridge.state['lights']['3'] = dict(bridge.state['lights']['1'], name="Hall")
+            mirror.refresh()
+            self.assertEquals(index.name_of(bridge.url, 2), "Office")
+            self.assertEquals(index.name_of(bridge.url, 3), "Hall")
+        finally:
+            bridge.stop()
+
+    def test_load_datastore(self):
+        """ Test a bridge is loaded with the lights registered for it, not those of other bridges """
+        datastore.setup_database()
+        self.addCleanup(datastore.purge)
+        datastore.register_lights([{'name': "Porch", 'base_id': "1", 'bridge': "10.0.0.3"},
+                                   {'name': "Attic", 'base_id': "2", 'bridge': "10.0.0.4"}])
+
+        self.index.load_datastore("http://10.0.0.3")
+        self.assertEquals(self.index.resolve("porch"), ("10.0.0.3", "1"))
+        self.assertFalse("Attic" in self.index)
+
+    def test_lookups_while_changing(self):
+        """ Test lookups see a consistent set of lights while another thread renames them """
+        stop = threading.Event()
+
+        def churn():
+            while not stop.is_set():
+                for light_id in range(100):
+                    self.index.add("http://10.0.0.3", light_id, "Busy")
+                for light_id in range(100):
+                    self.index.remove("http://10.0.0.3", light_id)
+
+        thread = threading.Thread(target=churn)
+        thread.start()
+        try:
+            deadline = time.time() + 0.3
+            while time.time() < deadline:
+                self.index.lookup("busy")
+                self.index.lookup("busy", "http://10.0.0.3")
+                try:
+                    self.index.resolve("busy")
+                except NameIndexException:
+                    pass
+        finally:
+            stop.set()
+            thread.join()
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+""" Test the prioritized outbound command queue """
+
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest
+
+import outbound
+from ratelimit import RateLimiter, get_rate_limiter
+
+class OutboundTests(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = outbound.OutboundQueue("http://10.0.0.9", limiter=RateLimiter(1000, 1000), workers=1)
+
+    def test_interactive_jumps_ahead(self):
+        """ Test an interactive command runs before background commands queued earlier """
+        release = threading.Event()
+        order   = []
+
+        blocker = self.queue.submit(release.wait, priority=outbound.BACKGROUND)
+        futures = [self.queue.submit(order.append, ('background %s' % index,), priority=outbound.BACKGROUND)
+                   for index in range(3)]
+        with outbound.priority(outbound.INTERACTIVE):
+            futures.append(self.queue.submit(order.append, ('interactive',)))
+
+        release.set()
+        blocker.wait(5)
+        for future in futures:
+            future.wait(5)
+
+        self.assertEquals(order[0], 'interactive')
+        self.assertEquals(order[1:], ['background 0', 'background 1', 'background 2'])
+
+        stats = self.queue.stats()
+        self.assertEquals(stats['interactive']['count'], 1)
+        self.assertEquals(stats['background']['count'], 4)
+        self.assertEquals(stats['normal']['count'], 0)
+
+    def test_errors_are_returned(self):
+        """ Test a failing command raises from its future and map_outbound pairs it up """
+        def fail():
+            raise ValueError("no")
+
+        self.assertRaises(ValueError, self.queue.call, fail)
+
+        outcomes = outbound.map_outbound("http://10.0.0.9", lambda x: x * 2, [(1,), (2,)])
+        self.assertEquals(outcomes, [(2, None), (4, None)])
+
+    def test_concurrency_limit(self):
+        """ Test no more commands are in flight than the concurrency allows """
+        queue   = outbound.OutboundQueue("http://10.0.0.9", limiter=RateLimiter(1000, 1000), workers=4,
+                                         concurrency=2, autotune=False)
+        lock    = threading.Lock()
+        flight  = [0, 0]
+
+        def command():
+            with lock:
+                flight[0] += 1
+                flight[1]  = max(flight)
+            time.sleep(0.01)
+            with lock:
+                flight[0] -= 1
+
+        for future in [queue.submit(command) for _ in range(12)]:
+            future.wait(5)
+        self.assertEquals(flight[1], 2)
+
+        queue.set_concurrency(4)
+        flight[1] = 0
+        for future in [queue.submit(command) for _ in range(12)]:
+            future.wait(5)
+        self.assertEquals(flight[1], 4)
+        self.assertEquals(queue.stats()['concurrency'], 4)
+
+    def test_lifecycle(self):
+        """ Test idle queues are shut down unless retained, and a shut down queue still runs commands """
+        queue = outbound.get_outbound_queue("http://10.0.0.10")
+        kept  = outbound.get_outbound_queue("http://10.0.0.11", retain=True)
+        self.assertTrue(outbound.ROUTED)
+        self.assertEquals(queue.call(lambda: 1), 1)
+
+        later = time.time() + outbound.IDLE_TIMEOUT + 1
+        self.assertFalse(queue.idle())
+        self.assertTrue(queue.idle(later))
+        outbound.reap_idle_queues(now=later)
+        self.assertTrue(outbound.queue_for("10.0.0.10") is None)
+        self.assertTrue(outbound.queue_for("10.0.0.11") is kept)
+
+        for worker in queue._workers:
+            worker.join(5)
+            self.assertFalse(worker.is_alive())
+        self.assertEquals(queue.call(lambda: 2), 2)
+        self.assertFalse(outbound.get_outbound_queue("http://10.0.0.10") is queue)
+
+        kept.release()
+        outbound.shutdown_outbound_queues()
+        self.assertEquals(outbound.get_stats(), {})
+        self.assertFalse(outbound.ROUTED)
+        self.assertTrue(kept.closed)
+
+    def test_nested_calls_are_limited(self):
+        """ Test bulk calls made from a worker run inline but still wait for the bridge's rate limit """
+        get_rate_limiter("http://10.0.0.12").set_rate(20, burst=1)
+        queue = outbound.OutboundQueue("http://10.0.0.12", limiter=RateLimiter(1000, 1000), workers=1)
+
+        def bulk():
+            started = time.time()
+            outbound.map_outbound("http://10.0.0.12", lambda: None, [()] * 5)
+            return time.time() - started
+
+        self.assertTrue(queue.call(bulk) >= 0.15)
+        queue.shutdown()
+
+    def test_tuner(self):
+        """ Test the tuner keeps connections that raise throughput and backs off on errors """
+        tuner = outbound.ConcurrencyTuner(concurrency=1, maximum=4, window=10)
+        now   = [0.0]
+
+        def run_window(throughput, failed=False):
+            for _ in range(10):
+                now[0] += 1.0 / throughput
+                tuner.observe(0.3, failed, now=now[0])
+            return tuner.concurrency
+
+        # Throughput follows the concurrency up to 3, a 4th connection does not help
+        self.assertEquals(run_window(3), 2)
+        self.assertEquals(run_window(6), 3)
+        self.assertEquals(run_window(9), 4)
+        self.assertEquals(run_window(9), 3)
+        self.assertEquals(run_window(9), 3)
+
+        # Errors halve it straight away
+        self.assertEquals(run_window(9, failed=True), 1)
+
+    def test_quiet_exit(self):
+        """ Test a short lived script using a queue exits without its workers raising at shutdown """
+        script = ("import dr_hue, outbound\n"
+                  "from fakebridge import FakeBridge\n"
+                  "bridge = FakeBridge(lights=8).start()\n"
+                  "outbound.map_outbound(bridge.url, dr_hue.set_light_state,\n"
+                  "                      [(bridge.url, i, 'user', {'on': True}) for i in range(1, 9)])\n")
+        root   = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        for _ in range(3):
+            process = subprocess.Popen([sys.executable, "-c", script], cwd=root, stderr=subprocess.PIPE)
+            _, errors = process.communicate()
+            self.assertEquals((process.returncode, errors), (0, ""))
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
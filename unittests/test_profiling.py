@@ -0,0 +1,62 @@
+""" Test the opt-in profiling of the request path """
+
+import unittest
+
+import dr_hue
+import profiling
+from fakebridge import FakeBridge
+
+class ProfilingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.bridge = FakeBridge(lights=3, latency=0.01).start()
+
+    def tearDown(self):
+        self.bridge.stop()
+
+    def test_phases(self):
+        """ Test calls are split into phases, helpers are timed and nothing is kept outside a run """
+        dr_hue.get_all_lights(self.bridge.url, "user")
+
+        with profiling.profile(sample=True, interval=0.001) as run:
+            dr_hue.turn_all_lights_on(self.bridge.url, "user", sleep_interval=0.01)
+        dr_hue.get_all_lights(self.bridge.url, "user")
+
+        self.assertFalse(profiling.ACTIVE)
+        self.assertEquals(run.calls, 4)
+        phases = run.as_dict()['phases']
+        for phase in ('url', 'serialize', 'send', 'wait', 'http', 'parse'):
+            self.assertEquals(phases[phase]['count'], 4, phase)
+        self.assertEquals(phases['sleep']['count'], 3)
+        self.assertTrue(phases['wait']['seconds'] >= 0.04)
+        self.assertTrue(phases['sleep']['seconds'] >= 0.03)
+        self.assertEquals(run.as_dict()['helpers']['dr_hue.turn_all_lights_on']['count'], 1)
+
+        self.assertTrue('wait' in run.format())
+        self.assertTrue(any(line.rsplit(' ', 1)[1].isdigit() and 'test_profiling.py:test_phases' in line
+                            for line in run.collapsed().splitlines()))
+
+    def test_cprofile(self):
+        """ Test a cProfile run can be written out for pstats """
+        import os
+        import pstats
+        import tempfile
+
+        with profiling.profile(cprofile=True) as run:
+            dr_hue.get_full_state(self.bridge.url, "user")
+
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            run.write_pstats(path)
+            functions = [function for _, _, function in pstats.Stats(path).stats]
+            self.assertTrue('json_rpc_call' in functions)
+        finally:
+            os.remove(path)
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
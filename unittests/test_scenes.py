@@ -0,0 +1,49 @@
+""" Test planning of scene restores """
+
+import unittest
+from scenes import plan_restore, restorable_state
+
+def light(on, bri=254, ct=300):
+    return {'state': {'on': on, 'bri': bri, 'ct': ct, 'hue': 100, 'sat': 254, 'colormode': 'ct'}}
+
+class SceneTests(unittest.TestCase):
+
+    def test_restorable_state(self):
+        """ Test only the active color fields are kept, and nothing but 'on' for lights that are off """
+        state = light(True, bri=10)['state']
+        self.assertEquals(restorable_state(state), {'on': True, 'bri': 10, 'ct': 300})
+        self.assertEquals(restorable_state(light(False)['state']), {'on': False})
+
+    def test_all_lights_use_group_zero(self):
+        """ Test one command covers every light sharing a state """
+        full_state = {'lights': dict((str(i), light(True)) for i in range(1, 101)), 'groups': {}}
+        states     = dict((str(i), {'on': False}) for i in range(1, 101))
+        self.assertEquals(plan_restore(states, full_state), [('groups', '0', {'on': False})])
+
+    def test_matching_lights_are_skipped(self):
+        """ Test lights already in their target state get no command """
+        full_state = {'lights': {'1': light(False), '2': light(True, bri=10), '3': light(True)},
+                      'groups': {}}
+        states     = {'1': {'on': False}, '2': {'on': True, 'bri': 200, 'ct': 300}, '3': {'on': False}}
+        self.assertEquals(plan_restore(states, full_state),
+                          [('lights', '2', {'on': True, 'bri': 200, 'ct': 300}),
+                           ('lights', '3', {'on': False})])
+
+    def test_bridge_groups_are_used(self):
+        """ Test a bridge group is only used when it does not touch lights with another target """
+        full_state = {'lights': dict((str(i), light(True)) for i in range(1, 7)),
+                      'groups': {'1': {'lights': ['1', '2', '3']}, '2': {'lights': ['3', '4', '5']}}}
+        dim        = {'on': True, 'bri': 50, 'ct': 300}
+        states     = {'1': dim, '2': dim, '3': dim, '4': dim, '5': {'on': False}, '6': {'on': False}}
+        self.assertEquals(plan_restore(states, full_state),
+                          [('groups', '1', dim),
+                           ('lights', '4', dim),
+                           ('lights', '5', {'on': False}),
+                           ('lights', '6', {'on': False})])
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+""" Test compiling timelines into bridge schedules """
+
+import unittest
+from datetime import datetime, timedelta
+
+import dr_hue
+import schedules
+from schedules import light_event, group_event, compile_timeline, sync_timeline
+from schedules import ScheduleCompileException, ScheduleCache, get_schedules_bulk
+
+NOW = datetime(2013, 1, 1, 6, 0, 0)
+
+class ScheduleTests(unittest.TestCase):
+
+    def setUp(self):
+        self.store    = {"1": {"name": "Not ours", "description": ""}}
+        self.calls    = []
+        self.original = {}
+
+        def get_all_schedules(url, username):
+            return dict((key, {'name': value['name']}) for key, value in self.store.items())
+
+        def get_schedule_attributes(url, schedule_id, username):
+            self.calls.append(('get', schedule_id))
+            return dict(self.store[schedule_id])
+
+        def create_scehdule(url, username, params):
+            schedule_id = str(max(int(key) for key in self.store) + 1)
+            self.store[schedule_id] = dict(params)
+            self.calls.append(('create', params['name']))
+
+        def set_scehdule_attributes(url, schedule_id, username, params):
+            self.store[schedule_id].update(params)
+            self.calls.append(('update', schedule_id))
+
+        def delete_schedule(url, schedule_id, username):
+            del self.store[schedule_id]
+            self.calls.append(('delete', schedule_id))
+
+        for func in (get_all_schedules, get_schedule_attributes, create_scehdule,
+                     set_scehdule_attributes, delete_schedule):
+            self.original[func.__name__] = getattr(dr_hue, func.__name__)
+            setattr(dr_hue, func.__name__, func)
+
+    def tearDown(self):
+        for name, func in self.original.items():
+            setattr(dr_hue, name, func)
+
+    def timeline(self, brightness=128):
+        return [light_event("wake", NOW + timedelta(minutes=10), 1, on=True, bri=1),
+                light_event("ramp", NOW + timedelta(minutes=20), 1, bri=brightness),
+                group_event("off", NOW + timedelta(hours=8), 2, on=False),
+                light_event("past", NOW - timedelta(minutes=1), 3, on=True)]
+
+    def test_compile_event(self):
+        """ Test the schedule parameters produced for an event """
+        params = schedules.compile_event(group_event("off", NOW, 2, on=False), "user")
+        self.assertEquals(params['name'], "drh off")
+        self.assertEquals(params['time'], "2013-01-01T06:00:00")
+        self.assertEquals(params['command'], {'address': '/api/user/groups/2/action', 'method': 'PUT',
+                                              'body': {'on': False}})
+
+    def test_command_limit(self):
+        """ Test commands over the bridge limit are refused """
+        event = light_event("long", NOW, 1, on=True, bri=254, hue=65535, sat=254, transitiontime=100)
+        self.assertRaises(ScheduleCompileException, schedules.compile_event, event, "user")
+
+    def test_recompile_only_touches_changes(self):
+        """ Test a second sync only updates what changed and leaves foreign schedules alone """
+        plan = sync_timeline("http://10.0.0.2", "user", self.timeline(), now=NOW)
+        self.assertEquals(len(plan.create), 3)
+        self.assertEquals(len(self.store), 4)
+
+        self.calls = []
+        plan = compile_timeline("http://10.0.0.2", "user", self.timeline(), now=NOW)
+        self.assertEquals(len(plan), 0)
+        self.assertEquals(len(plan.unchanged), 3)
+
+        plan = sync_timeline("http://10.0.0.2", "user", self.timeline(brightness=200)[1:], now=NOW)
+        self.assertEquals(len(plan.update), 1)
+        self.assertEquals(len(plan.delete), 1)
+        self.assertEquals(len(plan.create), 0)
+        self.assertTrue("1" in self.store)
+        self.assertEquals(len(self.store), 3)
+
+    def test_bulk_read_is_cached(self):
+        """ Test schedule attributes are only fetched once per id """
+        sync_timeline("http://10.0.0.2", "user", self.timeline(), now=NOW)
+
+        cache      = ScheduleCache("http://10.0.0.2", "user")
+        self.calls = []
+        attributes = get_schedules_bulk("http://10.0.0.2", "user", cache=cache)
+        self.assertEquals(sorted(attributes.keys()), ["1", "2", "3", "4"])
+        self.assertEquals(sorted(self.calls), [('get', "1"), ('get', "2"), ('get', "3"), ('get', "4")])
+
+        self.calls = []
+        plan = compile_timeline("http://10.0.0.2", "user", self.timeline(), now=NOW, cache=cache)
+        self.assertEquals(len(plan.unchanged), 3)
+        self.assertEquals(self.calls, [])
+
+    def test_schedule_limit(self):
+        """ Test timelines that do not fit on the bridge are refused """
+        events = [light_event("e%s" % i, NOW + timedelta(minutes=i + 1), 1, on=True) for i in range(100)]
+        self.assertRaises(ScheduleCompileException, compile_timeline, "http://10.0.0.2", "user", events,
+                          now=NOW)
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+""" Test running calls on bridges spread over worker processes """
+
+import os
+import time
+import unittest
+
+import dr_hue
+import instrumentation
+import request_wrapper
+from cache      import ResponseCache
+from fakebridge import FakeBridge
+from sharding   import ShardedFleet, ShardCallException, shard_index
+
+def _process_id(url, username):
+    return os.getpid()
+
+def _inherited(url):
+    return request_wrapper._cache is not None, instrumentation.ENABLED
+
+def _unpicklable(url):
+    return lambda: url
+
+def _refuse_load():
+    raise ValueError("cannot be loaded here")
+
+class _Unloadable(object):
+    def __reduce__(self):
+        return _refuse_load, ()
+
+def _unloadable(url):
+    return _Unloadable()
+
+def _crash(url):
+    os._exit(1)
+
+def _slow(url, seconds):
+    time.sleep(seconds)
+    return seconds
+
+class ShardingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.fakes   = [FakeBridge(lights=2).start() for _ in range(4)]
+        self.bridges = [(fake.url, "user") for fake in self.fakes]
+
+    def tearDown(self):
+        for fake in self.fakes:
+            fake.stop()
+
+    def test_routing_and_results(self):
+        """ Test calls run in the process owning their bridge and come back in order """
+        with ShardedFleet(self.bridges, processes=2) as fleet:
+            pids = fleet.broadcast(_process_id)
+            self.assertFalse(os.getpid() in [pid for pid, _ in pids.values()])
+            for url, (pid, _) in pids.items():
+                owner = [other for other, (other_pid, _) in pids.items() if other_pid == pid]
+                self.assertTrue(all(shard_index(other, 2) == shard_index(url, 2) for other in owner))
+
+            calls    = [(fake.url, (light_id, "user", {'on': True})) for fake in self.fakes
+                        for light_id in ("1", "2", "9")]
+            outcomes = fleet.map(dr_hue.set_light_state, calls)
+
+            self.assertEquals(len(outcomes), 12)
+            self.assertEquals(outcomes[0], ([{'success': {'/lights/1/state/on': True}}], None))
+            self.assertTrue(isinstance(outcomes[2][1], ShardCallException))
+            self.assertEquals(outcomes[2][1].error_types, [3])
+            self.assertEquals(sum(shard['calls'] for shard in fleet.stats()), 16)
+            self.assertEquals(fleet.map(dr_hue.get_all_lights, []), [])
+
+        self.assertTrue(all(fake.state['lights'][light_id]['state']['on'] for fake in self.fakes
+                            for light_id in ("1", "2")))
+
+    def test_failures(self):
+        """ Test results that cannot be sent back, dead workers and timeouts fail their calls instead of
+        leaving map waiting """
+        with ShardedFleet(self.bridges, processes=2) as fleet:
+            url = self.fakes[0].url
+            other = [fake.url for fake in self.fakes if fleet.shard_of(fake.url) != fleet.shard_of(url)]
+
+            result, error = fleet.map(_unpicklable, [(url, ())])[0]
+            self.assertEquals((result, error.error_type), (None, "PicklingError"))
+
+            result, error = fleet.map(_unloadable, [(url, ())], timeout=10)[0]
+            self.assertEquals((result, error.error_type), (None, "ValueError"))
+            self.assertEquals(fleet.map(_slow, [(url, (0.0,))], timeout=10), [(0.0, None)])
+
+            start    = time.time()
+            outcomes = fleet.map(_slow, [(url, (0.0,)), (url, (2.0,))], timeout=0.3)
+            self.assertTrue(time.time() - start < 1.5)
+            self.assertEquals(outcomes[0], (0.0, None))
+            self.assertTrue("Timed out" in str(outcomes[1][1]))
+
+            result, error = fleet.map(_crash, [(url, ())], timeout=10)[0]
+            self.assertTrue("died" in str(error), error)
+            self.assertTrue("died" in str(fleet.map(_process_id, [(url, ("user",))])[0][1]))
+            self.assertEquals(sum(shard['alive'] for shard in fleet.stats()), 1)
+            if other:
+                self.assertEquals(fleet.map(_slow, [(other[0], (0.0,))]), [(0.0, None)])
+
+    def test_fresh_workers(self):
+        """ Test workers do not inherit the coordinator's response cache and call hooks """
+        hook = lambda info: None
+        request_wrapper.set_cache(ResponseCache())
+        instrumentation.add_post_call_hook(hook)
+        try:
+            with ShardedFleet(self.bridges[:1], processes=1) as fleet:
+                self.assertEquals(fleet.map(_inherited, [(self.fakes[0].url, ())]), [((False, False), None)])
+        finally:
+            request_wrapper.set_cache(None)
+            instrumentation.remove_hook(hook)
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
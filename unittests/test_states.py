@@ -0,0 +1,55 @@
+""" Test the compact state records """
+
+import unittest
+import states
+
+LIGHT = {"name": "Bedroom", "type": "Extended color light", "modelid": "LCT001", "swversion": "66009461",
+         "state": {"on": True, "bri": 200, "hue": 50000, "sat": 254, "xy": [0.5, 0.4], "ct": 300,
+                   "effect": "none", "alert": "none", "colormode": "hs", "reachable": True}}
+
+class StatesTests(unittest.TestCase):
+
+    def test_light_round_trip(self):
+        """ Test fields are on the record and as_dict gives back the bridge layout """
+        light = states.parse_light(1, LIGHT)
+        self.assertEquals((light.id, light.name, light.bri, light.xy), ("1", "Bedroom", 200, (0.5, 0.4)))
+        self.assertEquals(light.as_dict(), LIGHT)
+        self.assertFalse(hasattr(light, '__dict__'))
+
+        # Repeated values are stored once
+        other = states.parse_lights({"2": dict(LIGHT, modelid=u"LCT001")})["2"]
+        self.assertTrue(other.modelid is light.modelid)
+
+    def test_validation(self):
+        """ Test a field of the wrong type is refused, and a missing one is None """
+        broken = dict(LIGHT, state=dict(LIGHT['state'], bri="bright"))
+        try:
+            states.parse_light(1, broken)
+            self.fail("Expected a StateValidationException")
+        except states.StateValidationException as exc:
+            self.assertEquals((exc.field, exc.value), ("bri", "bright"))
+
+        self.assertRaises(states.StateValidationException, states.parse_light, 1, dict(LIGHT, state=[]))
+        self.assertEquals(states.parse_light(1, {"name": "Bare"}).bri, None)
+
+    def test_full_state(self):
+        """ Test every section of a full state is parsed """
+        full = states.parse_full_state({
+            'lights': {"1": LIGHT},
+            'groups': {"1": {"name": "Upstairs", "lights": ["1", "2"], "action": {"on": False}}},
+            'schedules': {"1": {"name": "Wake", "time": "2013-01-01T07:00:00",
+                                "command": {"address": "/api/u/groups/0/action", "method": "PUT",
+                                            "body": {"on": True}}}},
+            'config': {"name": "Hue", "linkbutton": False, "whitelist": {"u": {"name": "dr hue"}}}
+        })
+        self.assertEquals(full.groups["1"].lights, ("1", "2"))
+        self.assertEquals(full.schedules["1"].body, {"on": True})
+        self.assertEquals(full.config.linkbutton, False)
+        self.assertEquals(full.lights["1"], states.parse_light("1", LIGHT))
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()
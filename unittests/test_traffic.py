@@ -0,0 +1,70 @@
+""" Test recording calls and replaying them against a fake bridge """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import dr_hue
+import request_wrapper
+import traffic
+from fakebridge import FakeBridge
+
+class TrafficTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.bridges   = []
+
+    def tearDown(self):
+        request_wrapper.set_recorder(None)
+        for bridge in self.bridges:
+            bridge.stop()
+        shutil.rmtree(self.directory)
+
+    def bridge(self, **kwargs):
+        bridge = FakeBridge(**kwargs).start()
+        self.bridges.append(bridge)
+        return bridge
+
+    def test_record_and_replay(self):
+        """ Test a recording replays the same calls, with the same effect, and reports on them """
+        path     = os.path.join(self.directory, "traffic.log.gz")
+        original = self.bridge(lights=3)
+        recorder = traffic.TrafficRecorder(path)
+        request_wrapper.set_recorder(recorder)
+
+        dr_hue.get_full_state(original.url, "user")
+        dr_hue.set_light_state(original.url, 2, "user", {'on': True, 'bri': 120})
+        dr_hue.turn_light_on(original.url, 3, "user")
+        try:
+            dr_hue.get_light_attr(original.url, 9, "user")
+        except request_wrapper.JsonRpcGetException:
+            pass
+
+        request_wrapper.set_recorder(None)
+        recorder.close()
+
+        _, calls = traffic.load(path)
+        self.assertEquals([(call.method, call.template) for call in calls],
+                          [('GET', ''), ('PUT', 'lights/<id>/state'),
+                           ('PUT', 'lights/<id>/state'), ('GET', 'lights/<id>')])
+        self.assertEquals(calls[1].path, "/api/user/lights/2/state")
+        self.assertEquals(calls[3].error, "JsonRpcGetException")
+
+        target = self.bridge(lights=3, latency=0.01)
+        report = traffic.replay(path, target.url, speed=None)
+
+        self.assertEquals(target.state['lights']['2']['state']['bri'], 120)
+        self.assertTrue(target.state['lights']['3']['state']['on'])
+        self.assertEquals(target.requests, {'GET': 2, 'PUT': 2})
+        self.assertEquals((report.replayed['calls'], report.replayed['errors']), (4, 1))
+        self.assertTrue(report.replayed['p50'] >= 0.01)
+        self.assertTrue('calls/s' in report.format())
+
+################################################################################
+# Setup Testcases to run
+################################################################################
+
+if __name__ == "__main__":
+    unittest.main()